@@ -368,6 +368,40 @@ app.on('ready', async () => {
             win?.webContents.send('action', 'SaveAs');
           }
         },
+        {
+          type: 'separator'
+        },
+        {
+          id: 'CompactCatalog',
+          label: 'Compact Catalog',
+          click: function () {
+            const win = BrowserWindow.getFocusedWindow();
+            win?.webContents.send('action', 'CompactCatalog');
+          }
+        },
+        {
+          id: 'RemoveMissingFiles',
+          label: 'Remove Missing Files...',
+          click: function () {
+            const win = BrowserWindow.getFocusedWindow();
+            if (!win) {
+              return;
+            }
+
+            const choice = dialog.showMessageBoxSync(win, {
+              type: 'warning',
+              buttons: ['Remove', 'Cancel'],
+              defaultId: 1,
+              cancelId: 1,
+              title: 'Remove Missing Files',
+              message: 'Remove images whose files no longer exist from the catalog?',
+              detail: 'Their labels and ratings are removed too. Files on disconnected volumes are kept.'
+            });
+            if (choice === 0) {
+              win.webContents.send('action', 'RemoveMissingFiles');
+            }
+          }
+        },
       ]
     },
     {
@@ -67,4 +67,26 @@ export class ScanPathsAction implements Action {
       await apiServiceSingleton().scanPaths(paths);
     }
   }
-}
\ No newline at end of file
+}
+
+export class CompactCatalogAction implements Action {
+  readonly name = 'CompactCatalog';
+  readonly title = 'Compact Catalog';
+  readonly enabled = computed(() => true);
+
+  async perform(): Promise<void> {
+    await apiServiceSingleton().compactCatalog();
+  }
+}
+
+// Removes images of files that no longer exist, along with their labels and
+// ratings. Only sent by the main process once the user confirms.
+export class RemoveMissingFilesAction implements Action {
+  readonly name = 'RemoveMissingFiles';
+  readonly title = 'Remove Missing Files';
+  readonly enabled = computed(() => true);
+
+  async perform(): Promise<void> {
+    await apiServiceSingleton().compactCatalog(true);
+  }
+}
@@ -1,5 +1,5 @@
 import { ActionService } from './action-service';
-import { SaveAction, SaveAndCloseAction, SaveAsAction, ScanPathsAction } from './file';
+import { CompactCatalogAction, RemoveMissingFilesAction, SaveAction, SaveAndCloseAction, SaveAsAction, ScanPathsAction } from './file';
 import { DefaultOrientationAction, DeselectAllAction, ExportToFolderAction, FlipHorizontalAction, FlipVerticalAction, RotateCCWAction, RotateCWAction, SelectAllAction, ShowMediaFileAction, labelActions, rateActions } from './selection';
 import { SortByFileCreationTimeAscAction, SortByFileCreationTimeDescAction, SortByFileNameAscAction, SortByFileNameDescAction, SortByOriginTimeAscAction, SortByOriginTimeDescAction } from './sort';
 import { AddListColumn, DeleteListColumn } from './view';
@@ -25,6 +25,8 @@ export function registerAllActions(actionService: ActionService) {
   actionService.registerAction(new SaveAsAction());
   actionService.registerAction(new ShowMediaFileAction());
   actionService.registerAction(new ScanPathsAction());
+  actionService.registerAction(new CompactCatalogAction());
+  actionService.registerAction(new RemoveMissingFilesAction());
 
   actionService.registerAction(new SelectAllAction());
   actionService.registerAction(new DeselectAllAction());
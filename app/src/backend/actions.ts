@@ -1,7 +1,7 @@
 import { type ImageFile } from "@/store/schema";
 
 export declare interface Action {
-  action: 'FILE_REGISTERED' | 'THUMBNAIL_UPDATED' | 'LONG_OPERATION_START' | 'LONG_OPERATION_LOG' | 'LONG_OPERATION_STATUS' | 'LONG_OPERATION_SUCCESS' | 'LONG_OPERATION_ERROR' | 'BACKEND_STATE_UPDATE';
+  action: 'FILE_REGISTERED' | 'THUMBNAIL_UPDATED' | 'FILES_REMOVED' | 'LONG_OPERATION_START' | 'LONG_OPERATION_LOG' | 'LONG_OPERATION_STATUS' | 'LONG_OPERATION_SUCCESS' | 'LONG_OPERATION_ERROR' | 'LONG_OPERATION_CANCELLED' | 'BACKEND_STATE_UPDATE' | 'RESYNC' | 'BATCH';
 }
 
 export declare interface FileRegisteredAction extends Action {
@@ -14,9 +14,16 @@ export declare interface ThumbnailUpdatedAction extends Action {
   image: ImageFile;
 }
 
+export declare interface FilesRemovedAction extends Action {
+  action: 'FILES_REMOVED',
+  uids: string[];
+}
+
 export declare interface LongOperationStartAction extends Action {
   action: 'LONG_OPERATION_START',
   loid: string,
+  // Whether the operation can be stopped midway.
+  cancellable: boolean,
 }
 
 export declare interface LongOperationLogAction extends Action {
@@ -34,6 +41,14 @@ export declare interface LongOperationStatusAction extends Action {
   status: {
     status: string,
     progress: number,
+    items_done?: number,
+    items_total?: number,
+    bytes_done?: number,
+    bytes_total?: number,
+    items_per_second?: number,
+    bytes_per_second?: number,
+    // In seconds.
+    eta?: number,
   }
 }
 
@@ -47,7 +62,28 @@ export declare interface LongOperationErrorAction extends Action {
   message: string,
 }
 
+export declare interface LongOperationCancelledAction extends Action {
+  action: 'LONG_OPERATION_CANCELLED',
+  loid: string,
+}
+
+// Carries either the whole state or a patch against the previous one.
 export declare interface BackendStateUpdateAction extends Action {
   action: 'BACKEND_STATE_UPDATE',
-  state: any;
+  state?: any;
+  patch?: any;
+}
+
+// The renderer missed events (e.g. after the machine slept for long, or the
+// backend restarted) and has to reload its state.
+export declare interface ResyncAction extends Action {
+  action: 'RESYNC',
+}
+
+// Events are delivered in batches, each one is applied in a single pass.
+export declare interface BatchAction extends Action {
+  action: 'BATCH',
+  // Sequence number of the last event of the batch.
+  seq: number;
+  actions: Action[];
 }
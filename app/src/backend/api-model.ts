@@ -5,4 +5,46 @@ export declare interface OpenWithEntry {
 export declare interface OpenWithEntries {
   readonly default: OpenWithEntry;
   readonly other: ReadonlyArray<OpenWithEntry>;
-}
\ No newline at end of file
+}
+export declare interface QueryRange {
+  readonly min?: string | number;
+  readonly max?: string | number;
+}
+export declare interface ImageQuery {
+  readonly filter?: {
+    readonly labels?: ReadonlyArray<number>;
+    readonly ratings?: ReadonlyArray<number>;
+    readonly paths?: ReadonlyArray<string>;
+    readonly makes?: ReadonlyArray<string>;
+    readonly models?: ReadonlyArray<string>;
+    readonly ranges?: {
+      readonly date_time_original?: QueryRange;
+      readonly file_size?: QueryRange;
+      readonly file_ctime?: QueryRange;
+      readonly file_mtime?: QueryRange;
+    };
+  };
+  readonly sort?: {
+    readonly key: 'file_name' | 'origin_time' | 'file_ctime' | 'file_mtime' | 'file_size';
+    readonly order: 'asc' | 'desc';
+  };
+  readonly offset?: number;
+  readonly limit?: number;
+}
+export declare interface ImageQueryResult {
+  readonly total: number;
+  readonly uids: ReadonlyArray<string>;
+}
+export declare interface SearchResult {
+  readonly uids: ReadonlyArray<string>;
+  readonly has_more: boolean;
+}
+export declare interface ImageMetadataUpdate {
+  readonly label?: number;
+  readonly rating?: number;
+  readonly adjustments?: {
+    readonly rotation?: number;
+    readonly horizontalFlip?: boolean;
+    readonly verticalFlip?: boolean;
+  };
+}
@@ -1,20 +1,43 @@
 import { Migrate } from '@/store/migration';
-import { type ReadonlyState, type State } from '@/store/schema';
+import { type ImageFile, type ReadonlyState, type State } from '@/store/schema';
 import axios from 'axios';
 import * as log from 'loglevel';
-import { Observable } from 'rxjs';
-import { catchError, map } from 'rxjs/operators';
+import { Observable, defer, timer } from 'rxjs';
+import { map, mergeMap, repeat, retry, share, tap } from 'rxjs/operators';
 import { webSocket } from 'rxjs/webSocket';
-import { type Action } from './actions';
-import { type OpenWithEntries } from './api-model';
+import { type Action, type BatchAction } from './actions';
+import { type ImageMetadataUpdate, type ImageQuery, type ImageQueryResult, type OpenWithEntries, type SearchResult } from './api-model';
+import { diffState, stateToNDJSON, takeSnapshot, type StateSnapshot } from './state-diff';
 
 const GLOBAL_URL_PARAMS = new URLSearchParams(window.location.search);
 export const PORT = Number(GLOBAL_URL_PARAMS.get('port'));
 export const SECRET = GLOBAL_URL_PARAMS.get('secret') ?? '';
 export const INITIAL_SCAL_PATH = GLOBAL_URL_PARAMS.get('scan-path');
 
+// Returns the URL of a preview good enough to be displayed with the given size
+// (in CSS pixels). The backend picks the smallest preview that is big enough.
+export function previewUrl(uid: string, displaySize?: number): string {
+  const url = `http://localhost:${PORT}/images/${uid}`;
+  if (displaySize === undefined) {
+    return url;
+  }
+
+  return `${url}?max_size=${Math.ceil(displaySize * window.devicePixelRatio)}`;
+}
+
+const WEBSOCKET_RETRY_DELAY = 1000;
+
+export interface RenditionOptions {
+  format: 'jpeg' | 'webp';
+  // Maximum width and height, in pixels.
+  max_size: number;
+  quality: number;
+}
+
 export interface ExportToPathOptions {
   prefix_with_index: boolean;
+  // Resized renditions are exported instead of the originals, if set.
+  rendition?: RenditionOptions;
 }
 
 export class ApiService {
@@ -29,15 +52,35 @@ export class ApiService {
       this.scanPaths([INITIAL_SCAL_PATH]);
     }
 
-    this.ws = (ws ?? webSocket(`ws://${this.BASE_ADDRESS}/ws`)).pipe(
-      catchError(err => {
-        log.info('[API] WebSocket connection broken (retry is due): ', err);
-        // Chromium will close the websocket evert time the system goes to sleep.
-        // Thus, it's necessary to retry.
-        return webSocket(`ws://${this.BASE_ADDRESS}/ws`);
+    this.batches = (ws ?? defer(() => webSocket(this.webSocketUrl()))).pipe(
+      // Chromium will close the websocket evert time the system goes to sleep.
+      // Thus, it's necessary to retry. The backend resends events sent in the
+      // meantime.
+      retry({
+        delay: (err) => {
+          log.info('[API] WebSocket connection broken (retry is due): ', err);
+          return timer(WEBSOCKET_RETRY_DELAY);
+        },
+      }),
+      repeat({
+        delay: () => {
+          log.info('[API] WebSocket connection closed (reconnect is due)');
+          return timer(WEBSOCKET_RETRY_DELAY);
+        },
       }),
-      map(v => v as Action),
+      tap(v => {
+        const a = v as Action;
+        if (a.action === 'BATCH') {
+          this.lastSeq = (a as BatchAction).seq;
+        }
+      }),
+      map(v => {
+        const a = v as Action;
+        return a.action === 'BATCH' ? (a as BatchAction).actions : [a];
+      }),
+      share(),
     );
+    this.ws = this.batches.pipe(mergeMap(actions => actions));
 
     this.ws.subscribe({
       next(i) {
@@ -48,6 +91,17 @@ export class ApiService {
     });
   }
 
+  // Sequence number of the last batch of events received.
+  private lastSeq?: number;
+
+  private webSocketUrl(): string {
+    const url = `ws://${this.BASE_ADDRESS}/ws`;
+    return this.lastSeq === undefined ? url : `${url}?since=${this.lastSeq}`;
+  }
+
+  // Events sent by the backend, batch by batch.
+  readonly batches: Observable<Action[]>;
+  // Events sent by the backend, one by one.
   readonly ws: Observable<Action>;
 
   async scanPaths(paths: readonly string[]): Promise<void> {
@@ -60,11 +114,38 @@ export class ApiService {
     log.info('[API] Export to path response: ', response);
   }
 
+  async cancelLongOperation(loid: string): Promise<void> {
+    const response = await axios.post(this.ROOT + '/cancel-long-operation', { loid }, { headers: this.HEADERS });
+    log.info('[API] Cancel long operation response: ', response);
+  }
+
+  async compactCatalog(pruneMissingFiles = false): Promise<void> {
+    const response = await axios.post(this.ROOT + '/compact', { prune_missing_files: pruneMissingFiles }, { headers: this.HEADERS });
+    log.info('[API] Compact catalog response: ', response);
+  }
+
+  // State the backend has, as of the last fetchState()/saveStore() call.
+  private savedStateSnapshot?: StateSnapshot;
+
   async saveStore(path: string, state: ReadonlyState): Promise<void> {
-    const replacer = (key: string, value: unknown) => value === undefined ? null : value;
-    const stringified = JSON.stringify({ path, state }, replacer);
+    let response;
+    let snapshot: StateSnapshot;
+    if (this.savedStateSnapshot) {
+      const diff = diffState(this.savedStateSnapshot, state);
+      const stringified = JSON.stringify({ path, patch: diff.patch ?? {} });
+      response = await axios.post(this.ROOT + '/save', stringified, { headers: this.HEADERS });
+      snapshot = diff.snapshot;
+    } else {
+      // The whole state is sent entry by entry, so that the backend can
+      // write it to the catalog without buffering it.
+      const body = new Blob(stateToNDJSON({ path }, state));
+      response = await axios.post(this.ROOT + '/save', body, {
+        headers: { ...this.HEADERS, 'Content-Type': 'application/x-ndjson' },
+      });
+      snapshot = takeSnapshot(state);
+    }
 
-    const response = await axios.post(this.ROOT + '/save', stringified, { headers: this.HEADERS });
+    this.savedStateSnapshot = snapshot;
     log.info('[API] Save store response: ', response);
   }
 
@@ -90,13 +171,40 @@ export class ApiService {
     const response = await axios.get(this.ROOT + '/saved-state', { responseType: 'json', headers: this.HEADERS });
     log.info('[API] Fetch state response status: ', response.status);
     if (response.data['state'] == null) {
+      this.savedStateSnapshot = undefined;
       return undefined;
     } else {
+      this.savedStateSnapshot = takeSnapshot(response.data['state']);
       const state = Migrate(response.data['state']);
       return this.replaceNullWithUndefined(state);
     }
   }
 
+  async queryImages(query: ImageQuery): Promise<ImageQueryResult> {
+    const response = await axios.post(this.ROOT + '/query', query, { responseType: 'json', headers: this.HEADERS });
+    return response.data;
+  }
+
+  // Infos of the given images, as the backend has them. Unknown uids are skipped.
+  async fetchImageInfos(uids: readonly string[]): Promise<ImageFile[]> {
+    const response = await axios.post(this.ROOT + '/image-infos', { uids }, { responseType: 'json', headers: this.HEADERS });
+    return response.data['images'];
+  }
+
+  async searchImages(q: string, offset = 0, limit = 1000): Promise<SearchResult> {
+    const response = await axios.get(this.ROOT + '/search', {
+      params: { q, offset, limit },
+      responseType: 'json',
+      headers: this.HEADERS,
+    });
+    return response.data;
+  }
+
+  async updateImageMetadata(uids: readonly string[], update: ImageMetadataUpdate): Promise<number> {
+    const response = await axios.post(this.ROOT + '/metadata', { uids, set: update }, { responseType: 'json', headers: this.HEADERS });
+    return response.data['updated'];
+  }
+
   async fetchOpenWith(path: string): Promise<OpenWithEntries | undefined> {
     const response = await axios.get(this.ROOT + '/open-with-entries', {
       params: {
@@ -108,8 +216,8 @@ export class ApiService {
     return response.data['entries'];
   }
 
-  thumbnailUrl(uid: string) {
-    return this.ROOT + '/images/' + uid;
+  thumbnailUrl(uid: string, displaySize?: number) {
+    return previewUrl(uid, displaySize);
   }
 }
 
@@ -1,7 +1,35 @@
+import { applyPatch } from '@/backend/backend-mirror';
+import { expect } from 'chai';
 
 describe('BackendMirror', () => {
   it('reacts on backend state update', () => {
     // const bs = new BackendMirror();
     // console.log(bs);
   })
-});
\ No newline at end of file
+});
+describe('applyPatch', () => {
+  it('patches nested objects and removes keys set to null', () => {
+    const state = {
+      catalogPath: '/foo',
+      longOperations: {
+        a: { status: 'Starting', progress: 0 },
+        b: { status: 'Starting', progress: 0 },
+      },
+    };
+    const patch = {
+      longOperations: {
+        a: { progress: 0.5 },
+        b: null,
+      },
+    };
+
+    expect(applyPatch(state, patch)).to.deep.equal({
+      catalogPath: '/foo',
+      longOperations: {
+        a: { status: 'Starting', progress: 0.5 },
+      },
+    });
+    // The patched object is left intact.
+    expect(state.longOperations.b).to.deep.equal({ status: 'Starting', progress: 0 });
+  });
+});
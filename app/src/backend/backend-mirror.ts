@@ -9,19 +9,39 @@ export declare interface BackendState {
   readonly previewQueueSize: number;
 }
 
+// Applies a patch sent by the backend: objects are patched recursively,
+// null values stand for removed keys.
+export function applyPatch(target: { [key: string]: any }, patch: { [key: string]: any }): { [key: string]: any } {
+  const result = { ...target };
+  for (const [k, v] of Object.entries(patch)) {
+    if (v === null) {
+      delete result[k];
+    } else if (typeof v === 'object' && !Array.isArray(v) && typeof result[k] === 'object' && result[k] !== null) {
+      result[k] = applyPatch(result[k], v);
+    } else {
+      result[k] = v;
+    }
+  }
+  return result;
+}
+
 export class BackendMirror {
 
   constructor(private readonly apiService: ApiService) { }
 
-  private readonly updateBackendState$ = this.apiService.ws.pipe(
-    filter((v) => {
-      return v.action === 'BACKEND_STATE_UPDATE';
-    }),
-    map((v) => {
-      log.debug('[BackendMirror] Got state update: ', v);
+  private readonly updateBackendState$ = this.apiService.batches.pipe(
+    map((actions) => actions.filter((a): a is BackendStateUpdateAction => a.action === 'BACKEND_STATE_UPDATE')),
+    filter((aList) => aList.length > 0),
+    map((aList) => {
+      log.debug('[BackendMirror] Got state updates: ', aList);
 
-      const a = v as BackendStateUpdateAction;
-      Object.assign(this.state, a.state);
+      // Updates of a batch are applied to a copy, so that the reactive state
+      // is only changed once.
+      let state: { [key: string]: any } = { ...this.state };
+      for (const a of aList) {
+        state = a.state !== undefined ? { ...a.state } : applyPatch(state, a.patch);
+      }
+      Object.assign(this.state, state);
     }),
   ).subscribe();
 
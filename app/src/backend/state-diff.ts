@@ -0,0 +1,86 @@
+// Computes patches between renderer states, so that saving a catalog doesn't
+// require sending the whole state to the backend.
+//
+// A patch has the same shape as the state: top-level keys replace the saved
+// values, while entries of the collection sections are upserted one by one
+// (null means "delete the entry"). See backend's store_state.py.
+
+const COLLECTIONS = ['images', 'metadata', 'lists', 'paths'];
+
+const replacer = (key: string, value: unknown) => value === undefined ? null : value;
+
+// Maps "section/key" (with an empty section for top-level keys) to the
+// serialized value.
+export type StateSnapshot = ReadonlyMap<string, string>;
+
+function snapshotKey(section: string, key: string): string {
+  return section + '/' + key;
+}
+
+export function takeSnapshot(state: object): Map<string, string> {
+  const result = new Map<string, string>();
+  for (const [k, v] of Object.entries(state)) {
+    if (COLLECTIONS.includes(k)) {
+      for (const [ck, cv] of Object.entries(v ?? {})) {
+        result.set(snapshotKey(k, ck), JSON.stringify(cv, replacer));
+      }
+    } else {
+      result.set(snapshotKey('', k), JSON.stringify(v, replacer));
+    }
+  }
+  return result;
+}
+
+// Serializes the state as newline-delimited JSON accepted by backend's
+// /save: a header line followed by one [section, key, value] line per entry.
+export function stateToNDJSON(header: object, state: object): string[] {
+  const result = [JSON.stringify(header) + '\n'];
+  for (const [k, v] of Object.entries(state)) {
+    if (COLLECTIONS.includes(k)) {
+      for (const [ck, cv] of Object.entries(v ?? {})) {
+        result.push(JSON.stringify([k, ck, cv], replacer) + '\n');
+      }
+    } else {
+      result.push(JSON.stringify(['', k, v], replacer) + '\n');
+    }
+  }
+  return result;
+}
+
+export interface StateDiff {
+  // undefined if nothing has changed.
+  patch?: { [key: string]: unknown };
+  snapshot: StateSnapshot;
+}
+
+export function diffState(prev: StateSnapshot, state: object): StateDiff {
+  const snapshot = takeSnapshot(state);
+  const patch: { [key: string]: unknown } = {};
+  let changed = false;
+
+  const set = (snapshotKey: string, value: unknown) => {
+    const index = snapshotKey.indexOf('/');
+    const section = snapshotKey.substring(0, index);
+    const key = snapshotKey.substring(index + 1);
+    if (section) {
+      const collection = (patch[section] ?? (patch[section] = {})) as { [key: string]: unknown };
+      collection[key] = value;
+    } else {
+      patch[key] = value;
+    }
+    changed = true;
+  };
+
+  for (const [k, v] of snapshot) {
+    if (prev.get(k) !== v) {
+      set(k, JSON.parse(v));
+    }
+  }
+  for (const k of prev.keys()) {
+    if (!snapshot.has(k)) {
+      set(k, null);
+    }
+  }
+
+  return { patch: changed ? patch : undefined, snapshot };
+}
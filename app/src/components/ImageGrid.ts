@@ -1,4 +1,4 @@
-import { apiServiceSingleton, PORT } from '@/backend/api';
+import { apiServiceSingleton, previewUrl } from '@/backend/api';
 import { electronHelperServiceSingleton } from '@/lib/electron-helper-service';
 import { Direction, ImageViewerTab, storeSingleton, transientStoreSingleton } from '@/store';
 import { Label } from '@/store/schema';
@@ -211,7 +211,7 @@ export default defineComponent({
           uid,
           filePath: im.path,
           previewSize,
-          previewUrl: 'http://localhost:' + PORT + '/images/' + uid,
+          previewUrl: previewUrl(uid, store.state.thumbnailSettings.size),
           label: mdata.label,
           rating: mdata.rating,
           selectionType,
@@ -349,7 +349,7 @@ export default defineComponent({
         uids.add(additionalUid);
       }
       const files = Array.from(uids).map(u => store.state.images[u]);
-      dragHelperServiceSingleton().startDrag(event, files, apiService.thumbnailUrl(uid))
+      dragHelperServiceSingleton().startDrag(event, files, apiService.thumbnailUrl(uid, store.state.thumbnailSettings.size))
     }
 
     function imageBoxClicked(uid: string, event: MouseEvent) {
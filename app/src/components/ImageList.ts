@@ -174,7 +174,7 @@ export default defineComponent({
         uids.add(additionalUid);
       }
       const files = Array.from(uids).map(u => store.state.images[u]);
-      dragHelperServiceSingleton().startDrag(event, files, apiService.thumbnailUrl(uid))
+      dragHelperServiceSingleton().startDrag(event, files, apiService.thumbnailUrl(uid, maxSize.value))
     }
 
     function keyPressed(event: KeyboardEvent) {
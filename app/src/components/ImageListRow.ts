@@ -1,4 +1,4 @@
-import { PORT } from '@/backend/api';
+import { previewUrl } from '@/backend/api';
 import LabelIcon from '@/components/core/LabelIcon.vue';
 import Rating from '@/components/core/Rating.vue';
 import { storeSingleton } from '@/store';
@@ -67,7 +67,7 @@ export default defineComponent({
 
       return {
         key: `list-${props.uid}`,
-        previewUrl: 'http://localhost:' + PORT + '/images/' + props.uid,
+        previewUrl: previewUrl(props.uid, props.maxSize),
         previewAdjustments: metadata.adjustments,
         columns: store.state.listSettings.columns.map((col):ValueColumn => {
           return {
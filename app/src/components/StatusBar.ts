@@ -1,16 +1,37 @@
+import { apiServiceSingleton } from '@/backend/api';
 import { backendMirrorSingleton } from '@/backend/backend-mirror';
 import { transientStoreSingleton } from '@/store';
 import { defineComponent } from 'vue';
+import Icon from '@/components/core/Icon.vue';
 import Progress from '@/components/core/Progress.vue';
 
+function formatEta(seconds: number): string {
+  const s = Math.ceil(seconds);
+  if (s < 60) {
+    return `${s}s left`;
+  }
+  const m = Math.floor(s / 60);
+  if (m < 60) {
+    return `${m}m ${s % 60}s left`;
+  }
+  return `${Math.floor(m / 60)}h ${m % 60}m left`;
+}
+
 export default defineComponent({
   components: {
+    Icon,
     Progress,
   },
   setup() {
+    function cancel(loid: string) {
+      apiServiceSingleton().cancelLongOperation(loid);
+    }
+
     return {
       transientStoreState: transientStoreSingleton().state,
       backendState: backendMirrorSingleton().state,
+      formatEta,
+      cancel,
     }
   }
 });
\ No newline at end of file
@@ -1,6 +1,7 @@
-import { apiServiceSingleton } from '@/backend/api';
+import { apiServiceSingleton, type RenditionOptions } from '@/backend/api';
 import NmCheckbox from '@/components/core/Checkbox.vue';
 import NmProgress from '@/components/core/Progress.vue';
+import NmRadio from '@/components/core/Radio.vue';
 import { electronHelperServiceSingleton } from '@/lib/electron-helper-service';
 import { storeSingleton } from '@/store';
 import { computed, defineComponent, ref } from 'vue';
@@ -10,6 +11,7 @@ export default defineComponent({
   components: {
     NmCheckbox,
     NmProgress,
+    NmRadio,
     VueFinalModal,
   },
 
@@ -17,6 +19,10 @@ export default defineComponent({
     const closeFn = ref<Function>();
 
     const prefixWithIndex = ref<boolean>(true);
+    const renderRenditions = ref<boolean>(false);
+    const renditionFormat = ref<RenditionOptions['format']>('jpeg');
+    const renditionMaxSize = ref<number>(2048);
+    const renditionQuality = ref<number>(85);
     const destinationPath = ref<string | undefined>();
     const inProgress = ref<boolean>(false);
     const noneConstant = computed(() => '<destination folder not selected>');
@@ -50,12 +56,21 @@ export default defineComponent({
         destinationPath.value!,
         {
           prefix_with_index: prefixWithIndex.value,
+          rendition: renderRenditions.value ? {
+            format: renditionFormat.value,
+            max_size: renditionMaxSize.value,
+            quality: renditionQuality.value,
+          } : undefined,
         });
       closeFn.value!();
     }
 
     return {
       prefixWithIndex,
+      renderRenditions,
+      renditionFormat,
+      renditionMaxSize,
+      renditionQuality,
       destinationPath,
       inProgress,
       noneConstant,
@@ -1,8 +1,8 @@
-import { type Action, type FileRegisteredAction } from '@/backend/actions';
+import { type Action, type FileRegisteredAction, type FilesRemovedAction } from '@/backend/actions';
 import { ApiService } from '@/backend/api';
 import { Label, Rotation, ThumbnailRatio, type FilterSettings, type ImageFile, type ImageList, type ImageMetadata, type ListColumnName, type Rating, type ReadonlyState, type State } from '@/store/schema';
 import moment from 'moment';
-import { bufferTime, catchError, filter, map } from 'rxjs/operators';
+import { catchError, filter, map, switchMap } from 'rxjs/operators';
 import { reactive } from 'vue';
 import { dirName } from './helpers/filesystem';
 import { filterSettingsInvariant, listForFilterSettingsInvariant, updateItemInList, updateListsPresence, updateListsWithFilter } from './helpers/filtering';
@@ -22,6 +22,9 @@ export enum SortOrder {
   DESC,
 };
 
+// Images fetched per request when resyncing with the backend.
+const RESYNC_PAGE_SIZE = 1000;
+
 function _initialState(): State {
   return {
     version: 3,
@@ -111,15 +114,12 @@ export class Store {
     this._state = reactive(s);
   }
 
-  readonly registerImage$ = this.apiService.ws.pipe(
-    filter((v) => {
-      return (v as Action).action === 'FILE_REGISTERED' || (v as Action).action === 'THUMBNAIL_UPDATED';
-    }),
-    // TODO: buffer only on high throughput (implement cutsom operator).
-    // See https://netbasal.com/creating-custom-operators-in-rxjs-32f052d69457?gi=5406b4c675c2
-    bufferTime(500),
-    map((vList) => {
-      const aList = vList as FileRegisteredAction[];
+  readonly registerImage$ = this.apiService.batches.pipe(
+    map((actions) => actions.filter((a): a is FileRegisteredAction => {
+      return a.action === 'FILE_REGISTERED' || a.action === 'THUMBNAIL_UPDATED';
+    })),
+    filter((aList) => aList.length > 0),
+    map((aList) => {
       this.registerImages(aList.map(a => a.image));
     }),
     catchError((err, caught) => {  // defensive approach
@@ -128,6 +128,34 @@ export class Store {
     }),
   ).subscribe();
 
+  // Images whose files were removed are pruned from the catalog by its
+  // compaction.
+  readonly removeImages$ = this.apiService.ws.pipe(
+    filter((v) => (v as Action).action === 'FILES_REMOVED'),
+    map((v) => {
+      this.removeImages((v as FilesRemovedAction).uids);
+    }),
+    catchError((err, caught) => {  // defensive approach
+      console.log('Error: ', err);
+      return caught;
+    }),
+  ).subscribe();
+
+  // Images registered, updated or removed by events missed by the renderer
+  // are merged from the backend's live image list. The rest of the state
+  // (including edits not saved yet) is kept as it is.
+  readonly resync$ = this.apiService.ws.pipe(
+    filter((v) => (v as Action).action === 'RESYNC'),
+    switchMap(() => this.fetchLiveImages()),
+    map((images) => {
+      this.mergeLiveImages(images);
+    }),
+    catchError((err, caught) => {  // defensive approach
+      console.log('Error: ', err);
+      return caught;
+    }),
+  ).subscribe();
+
   public currentList(): ImageList {
     return listForFilterSettingsInvariant(this._state.lists, this._state.filtersInvariant);
   }
@@ -524,6 +552,44 @@ export class Store {
     updateListsPresence(this._state.lists, imageFile.uid, invariant);
   }
 
+  private removeImages(uids: readonly string[]) {
+    for (const uid of uids) {
+      delete this._state.images[uid];
+      delete this._state.metadata[uid];
+      delete this._state.selection.additional[uid];
+      if (this._state.selection.primary === uid) {
+        this.selectPrimary(undefined);
+      }
+    }
+
+    const removed = new Set(uids);
+    for (const l of Object.values(this._state.lists)) {
+      for (const uid of uids) {
+        delete l.presenceMap[uid];
+      }
+      l.items = l.items.filter(i => !removed.has(i));
+    }
+  }
+
+  private async fetchLiveImages(): Promise<ImageFile[]> {
+    const images: ImageFile[] = [];
+    for (let offset = 0; ; offset += RESYNC_PAGE_SIZE) {
+      const result = await this.apiService.queryImages({ offset, limit: RESYNC_PAGE_SIZE });
+      images.push(...await this.apiService.fetchImageInfos(result.uids));
+      if (offset + result.uids.length >= result.total || result.uids.length === 0) {
+        return images;
+      }
+    }
+  }
+
+  private mergeLiveImages(images: readonly ImageFile[]) {
+    const live = new Set(images.map(im => im.uid));
+    this.removeImages(Object.keys(this._state.images).filter(uid => !live.has(uid)));
+    for (const im of images) {
+      this.registerImage(im);
+    }
+  }
+
   private registerImages(imageFile: ImageFile[]) {
     for (const im of imageFile) {
       this.registerImage(im);
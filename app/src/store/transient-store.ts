@@ -1,4 +1,4 @@
-import { type Action, type LongOperationErrorAction, type LongOperationLogAction, type LongOperationStartAction, type LongOperationStatusAction, type LongOperationSuccessAction } from '@/backend/actions';
+import { type Action, type LongOperationCancelledAction, type LongOperationErrorAction, type LongOperationLogAction, type LongOperationStartAction, type LongOperationStatusAction, type LongOperationSuccessAction } from '@/backend/actions';
 import { type Immutable } from '@/lib/type-utils';
 import { Observable } from 'rxjs';
 import { filter } from 'rxjs/operators';
@@ -20,6 +20,7 @@ export enum LongOperationState {
   IN_PROGRESS = 0,
   SUCCESS = 1,
   ERROR = 2,
+  CANCELLED = 3,
 }
 
 export interface LongOperationLog {
@@ -31,9 +32,12 @@ export interface LongOperationLog {
 export interface LongOperation {
   state: LongOperationState;
   startTimestamp: number;
+  cancellable: boolean;
 
   status: string;
   progress: number;
+  // Estimated time left (in seconds), if known.
+  eta?: number;
 
   logCount: number;
   warningCount: number;
@@ -108,6 +112,7 @@ export class TransientStore {
       const newOp: LongOperation = {
         state: LongOperationState.IN_PROGRESS,
         startTimestamp: Date.now(),
+        cancellable: v.cancellable,
 
         status: 'Starting...',
         progress: 0,
@@ -128,6 +133,7 @@ export class TransientStore {
   ).subscribe(v => {
     this._state.longOperations[v.loid].status = v.status.status;
     this._state.longOperations[v.loid].progress = v.status.progress;
+    this._state.longOperations[v.loid].eta = v.status.eta;
   });
 
   readonly longOperationLog$ = this.actions$.pipe(
@@ -179,4 +185,16 @@ export class TransientStore {
     this._state.longOperationsArchive[v.loid] = this._state.longOperations[v.loid];
     delete this._state.longOperations[v.loid];
   });
+
+  readonly longOperationCancelled$ = this.actions$.pipe(
+    filter((v): v is LongOperationCancelledAction => {
+      return (v as Action).action === 'LONG_OPERATION_CANCELLED';
+    })
+  ).subscribe(v => {
+    this._state.longOperations[v.loid].state = LongOperationState.CANCELLED;
+    this._state.longOperations[v.loid].status = 'Cancelled';
+
+    this._state.longOperationsArchive[v.loid] = this._state.longOperations[v.loid];
+    delete this._state.longOperations[v.loid];
+  });
 }
@@ -1,17 +1,70 @@
-from typing import Dict
+import asyncio
+from typing import Any, Dict, Optional
 
 from newmedia.communicator import Communicator
 from newmedia.long_operation import Status
 from newmedia.utils.json_type import JSON
 
+# State changes are sent to the renderer at most this long after they're
+# made, so that a burst of changes results in a single update...
+STATE_UPDATE_DELAY = 0.1
+# ...while changes of the preview queue size alone are sent at most this often.
+GAUGE_UPDATE_INTERVAL = 1.0
+
+
+def _Diff(old: JSON, new: JSON) -> Dict[str, Any]:
+  """Returns a patch turning old into new, with removed keys set to None."""
+  patch: Dict[str, Any] = {}
+  for k, v in new.items():
+    old_v = old.get(k)
+    if isinstance(v, dict) and isinstance(old_v, dict):
+      sub_patch = _Diff(old_v, v)
+      if sub_patch:
+        patch[k] = sub_patch
+    elif k not in old or old_v != v:
+      patch[k] = v
+
+  for k in old:
+    if k not in new:
+      patch[k] = None
+
+  return patch
+
 
 class BackendState:
+  """Backend state mirrored by the renderer.
+
+  Changes are coalesced and sent as patches against the last sent state
+  (BACKEND_STATE_UPDATE with "patch"). The whole state is sent
+  (BACKEND_STATE_UPDATE with "state") first and whenever a renderer connects.
+  """
 
   async def _SendUpdate(self):
-    await self._communicator.SendWebSocketData({
-        "action": "BACKEND_STATE_UPDATE",
-        "state": self._ToJSON(),
-    })
+    # Updates are sent one at a time, so that every patch is computed against
+    # the state the renderer has once the previous one is applied.
+    async with self._send_lock:
+      state = self._ToJSON()
+      if self._sent_state is None:
+        data = {
+            "action": "BACKEND_STATE_UPDATE",
+            "state": state,
+        }
+      else:
+        patch = _Diff(self._sent_state, state)
+        if not patch:
+          return
+        data = {
+            "action": "BACKEND_STATE_UPDATE",
+            "patch": patch,
+        }
+
+      self._sent_state = state
+      try:
+        await self._communicator.SendWebSocketData(data)
+      except:
+        # The renderer may have missed the update: the whole state is sent next.
+        self._sent_state = None
+        raise
 
   def _ToJSON(self) -> JSON:
     long_operations: Dict[str, JSON] = {}
@@ -24,12 +77,34 @@ class BackendState:
         "longOperations": long_operations,
     }
 
+  def _ScheduleUpdate(self, delay: float) -> None:
+    loop = asyncio.get_running_loop()
+    when = loop.time() + delay
+    if self._update_handle is not None:
+      if self._update_handle.when() <= when:
+        return
+      self._update_handle.cancel()
+    self._update_handle = loop.call_at(when, self._SendScheduledUpdate)
+
+  def _SendScheduledUpdate(self) -> None:
+    self._update_handle = None
+    asyncio.create_task(self._SendUpdate())
+
   def __init__(self, communicator: Communicator):
     self._catalog_path: str = ""
     self._preview_queue_size: int = 0
     self._long_operations: Dict[str, Status] = {}
 
     self._communicator = communicator
+    # State as of the last update sent, None if the whole state is to be sent.
+    self._sent_state: Optional[JSON] = None
+    self._update_handle: Optional[asyncio.TimerHandle] = None
+    self._send_lock = asyncio.Lock()
+
+  def ResendState(self) -> None:
+    """Sends the whole state, e.g. to a newly connected renderer."""
+    self._sent_state = None
+    self._ScheduleUpdate(STATE_UPDATE_DELAY)
 
   @property
   def catalog_path(self) -> str:
@@ -37,7 +112,7 @@ class BackendState:
 
   async def ChangeCatalogPath(self, value: str):
     self._catalog_path = value
-    await self._SendUpdate()
+    self._ScheduleUpdate(STATE_UPDATE_DELAY)
 
   @property
   def preview_queue_size(self) -> int:
@@ -45,15 +120,15 @@ class BackendState:
 
   async def ChangePreviewQueueSize(self, delta: int):
     self._preview_queue_size += delta
-    await self._SendUpdate()
+    self._ScheduleUpdate(GAUGE_UPDATE_INTERVAL)
 
   async def SetLongOperationStatus(self, oid: str, status: Status):
     self._long_operations[oid] = status
-    await self._SendUpdate()
+    self._ScheduleUpdate(STATE_UPDATE_DELAY)
 
   async def UnsetLongOperationStatus(self, oid: str):
     del self._long_operations[oid]
-    await self._SendUpdate()
+    self._ScheduleUpdate(STATE_UPDATE_DELAY)
 
 
 BACKEND_STATE: BackendState
@@ -0,0 +1,107 @@
+import asyncio
+from typing import Any, List, Union
+from unittest import mock
+
+import pytest
+
+from newmedia import backend_state
+from newmedia import communicator
+from newmedia.long_operation import Status
+from newmedia.utils.json_type import JSON, ToJSONProtocol
+
+
+class _RecordingCommunicator(communicator.CommunicatorStub):
+
+  def __init__(self):
+    self.sent: List[Any] = []
+
+  async def SendWebSocketData(self, data: Union[JSON, ToJSONProtocol]):
+    self.sent.append(data)
+
+
+async def _WaitForUpdate(delay: float) -> None:
+  await asyncio.sleep(delay * 1.5)
+
+
+@pytest.mark.asyncio
+async def test_ChangesAreCoalescedAndSentAsPatches():
+  c = _RecordingCommunicator()
+  state = backend_state.BackendState(c)
+
+  await state.ChangeCatalogPath("/foo")
+  await state.SetLongOperationStatus("a", Status("Starting", 0))
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  assert c.sent == [{
+      "action": "BACKEND_STATE_UPDATE",
+      "state": {
+          "catalogPath": "/foo",
+          "previewQueueSize": 0,
+          "longOperations": {"a": {"status": "Starting", "progress": 0}},
+      },
+  }]
+
+  await state.SetLongOperationStatus("a", Status("Starting", 0.5))
+  await state.SetLongOperationStatus("b", Status("Starting", 0))
+  await state.UnsetLongOperationStatus("b")
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  assert c.sent[1:] == [{
+      "action": "BACKEND_STATE_UPDATE",
+      "patch": {"longOperations": {"a": {"progress": 0.5}}},
+  }]
+
+  # Nothing changed since the last update.
+  await state.ChangeCatalogPath("/foo")
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  assert len(c.sent) == 2
+
+  state.ResendState()
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  assert c.sent[2]["state"]["catalogPath"] == "/foo"
+
+
+@pytest.mark.asyncio
+@mock.patch.object(backend_state, "GAUGE_UPDATE_INTERVAL", 0.2)
+async def test_PreviewQueueSizeIsRateLimited():
+  c = _RecordingCommunicator()
+  state = backend_state.BackendState(c)
+
+  for _ in range(10):
+    await state.ChangePreviewQueueSize(1)
+    await state.ChangePreviewQueueSize(-1)
+  await state.ChangePreviewQueueSize(1)
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  assert c.sent == []
+
+  await _WaitForUpdate(backend_state.GAUGE_UPDATE_INTERVAL)
+  assert [m["state"]["previewQueueSize"] for m in c.sent] == [1]
+
+
+class _SlowCommunicator(_RecordingCommunicator):
+
+  def __init__(self):
+    super().__init__()
+    self.release = asyncio.Event()
+
+  async def SendWebSocketData(self, data: Union[JSON, ToJSONProtocol]):
+    await self.release.wait()
+    await super().SendWebSocketData(data)
+
+
+@pytest.mark.asyncio
+async def test_ChangesMadeWhileUpdateIsSentAreNotLost():
+  c = _SlowCommunicator()
+  c.release.set()
+  state = backend_state.BackendState(c)
+  await state.ChangeCatalogPath("/x")
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+
+  c.release.clear()
+  await state.ChangeCatalogPath("/y")
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  # The /y patch is still being sent.
+  await state.ChangeCatalogPath("/x")
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+  c.release.set()
+  await _WaitForUpdate(backend_state.STATE_UPDATE_DELAY)
+
+  assert [m.get("patch") for m in c.sent[1:]] == [{"catalogPath": "/y"}, {"catalogPath": "/x"}]
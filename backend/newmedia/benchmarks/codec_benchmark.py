@@ -0,0 +1,132 @@
+"""Compares ImageFile encode/decode rates and sizes of the available codecs.
+
+Usage: python -m newmedia.benchmarks.codec_benchmark [--records N]
+"""
+import argparse
+import dataclasses
+import datetime
+import fractions
+import json
+import time
+from typing import Any, Callable, List
+
+import bson
+
+from newmedia import store_codec
+from newmedia import store_schema
+
+PARSER = argparse.ArgumentParser(description="ImageFile codec benchmark.")
+PARSER.add_argument("--records", type=int, default=100000)
+
+
+def _MakeExifData(i: int) -> store_schema.ExifData:
+  # A mixed corpus: screenshots/PNGs without EXIF, camera JPEGs, RAWs and
+  # phone pictures with GPS data.
+  kind = i % 4
+  if kind == 0:
+    return store_schema.ExifData()
+
+  taken = datetime.datetime(2021, 5, 1, 12, 0, i % 60)
+  exif_data = store_schema.ExifData(
+      make="FUJIFILM",
+      model="X-T3",
+      orientation=1,
+      x_resolution=72.0,
+      y_resolution=72.0,
+      resolution_unit=2,
+      software="Digital Camera X-T3 Ver3.20",
+      date_time=taken,
+      exposure_time=1 / 250,
+      f_number=5.6,
+      iso_speed_ratings=400,
+      date_time_original=taken,
+      date_time_digitized=taken,
+      focal_length=23,
+  )
+  if kind == 2:
+    exif_data.exposure_program = 1
+    exif_data.exif_version = "0231"
+    exif_data.metering_mode = 5
+    exif_data.light_source = 0
+    exif_data.flash = 16
+    exif_data.exif_image_width = 6240
+    exif_data.exif_image_height = 4160
+    exif_data.exposure_bias_value = 1 / 3
+  elif kind == 3:
+    exif_data.gps_latitude_ref = "N"
+    exif_data.gpa_latitude = (fractions.Fraction(52), fractions.Fraction(31),
+                              fractions.Fraction(1234, 100))
+    exif_data.gps_longitude_ref = "E"
+    exif_data.gps_longitude = (fractions.Fraction(13), fractions.Fraction(24),
+                               fractions.Fraction(5678, 100))
+    exif_data.gps_altitude = fractions.Fraction(341, 10)
+  return exif_data
+
+
+def _MakeImageFile(i: int) -> store_schema.ImageFile:
+  return store_schema.ImageFile(
+      path=f"/Users/someone/Pictures/2021/{i:06d}.jpg",
+      uid=f"{i:032x}",
+      size=store_schema.Size(6240, 4160),
+      previews=[store_schema.ImageFilePreview(store_schema.Size(3200, 2133), 1620000000000 + i)],
+      file_size=12000000 + i,
+      file_ctime=1620000000000 + i,
+      file_mtime=1620000000000 + i,
+      file_color_tag=store_schema.FileColorTag.NONE,
+      icc_profile_description="sRGB IEC61966-2.1",
+      mime_type="JPEG",
+      exif_data=_MakeExifData(i),
+  )
+
+
+def _DenseJSON(image_file: store_schema.ImageFile) -> Any:
+  # What ToJSON() produced before EXIF was serialized sparsely.
+  result = image_file.ToJSON()
+  exif_data = {f.name: None for f in dataclasses.fields(store_schema.ExifData)}
+  exif_data.update(result["exif_data"])
+  result["exif_data"] = exif_data
+  return result
+
+
+def _AverageSize(rows: List[Any]) -> float:
+  return sum(len(r) for r in rows) / len(rows)
+
+
+def _Measure(name: str, fn: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+  start = time.perf_counter()
+  result = [fn(i) for i in items]
+  elapsed = time.perf_counter() - start
+  print(f"{name:>18}: {len(items) / elapsed:>12,.0f} records/s ({elapsed:.2f}s per {len(items):,})")
+  return result
+
+
+def main():
+  args = PARSER.parse_args()
+  records = [_MakeImageFile(i) for i in range(args.records)]
+
+  bson_rows = _Measure("bson encode", lambda r: bson.dumps(r.ToJSON()), records)
+  _Measure("bson decode", lambda d: store_schema.ImageFile.FromJSON(bson.loads(d)), bson_rows)
+
+  positional_codec = store_codec.RecordCodec(b"\x01")
+  positional_rows = _Measure("positional encode", positional_codec.Encode, records)
+  _Measure("positional decode", store_codec.Decode, positional_rows)
+
+  sparse_rows = _Measure("sparse encode", store_codec.Encode, records)
+  _Measure("sparse decode", store_codec.Decode, sparse_rows)
+
+  print("Average stored size: "
+        f"bson {_AverageSize(bson_rows):.0f} bytes, "
+        f"positional {_AverageSize(positional_rows):.0f} bytes, "
+        f"sparse {_AverageSize(sparse_rows):.0f} bytes")
+
+  dense_messages = [
+      json.dumps({"action": "FILE_REGISTERED", "image": _DenseJSON(r)}) for r in records
+  ]
+  sparse_messages = [json.dumps({"action": "FILE_REGISTERED", "image": r.ToJSON()}) for r in records]
+  print("Average FILE_REGISTERED message size: "
+        f"dense {_AverageSize(dense_messages):.0f} bytes, "
+        f"sparse {_AverageSize(sparse_messages):.0f} bytes")
+
+
+if __name__ == "__main__":
+  main()
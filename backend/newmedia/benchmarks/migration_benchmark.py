@@ -0,0 +1,77 @@
+"""Measures catalog migration time on a synthetic catalog of the first version.
+
+Usage: python -m newmedia.benchmarks.migration_benchmark [--rows N] [--batch-size N]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+import aiosqlite
+import bson
+
+from newmedia import store
+from newmedia import store_migration
+from newmedia.schemas import schema_0001
+
+PARSER = argparse.ArgumentParser(description="Catalog migration benchmark.")
+PARSER.add_argument("--rows", type=int, default=100000)
+PARSER.add_argument("--batch-size", type=int, default=store_migration.BatchedMigration.batch_size)
+
+_PREVIEW = os.urandom(16 * 1024)
+
+
+def _CreateV1Catalog(path: str, num_rows: int) -> None:
+  conn = sqlite3.connect(path)
+  conn.executescript("""
+  CREATE TABLE RendererState (id TEXT PRIMARY KEY, blob BLOB);
+  CREATE TABLE ImageData (uid TEXT PRIMARY KEY, path TEXT, info BLOB NOT NULL, blob BLOB);
+  CREATE UNIQUE INDEX ImageData_path_index ON ImageData(path);
+  """)
+  conn.execute("INSERT INTO RendererState(id, blob) VALUES ('state', ?)",
+               (bson.dumps({"version": 1, "metadata": {}}),))
+
+  def Rows():
+    for i in range(num_rows):
+      path = f"/Users/someone/Pictures/{i // 1000:03d}/{i:06d}.jpg"
+      uid = f"{i:032x}"
+      info = schema_0001.ImageFile(path, uid, schema_0001.Size(6000, 4000),
+                                   schema_0001.Size(1600, 1067), 1620000000000 + i)
+      yield uid, path, bson.dumps(info.ToJSON()), _PREVIEW
+
+  conn.executemany("INSERT INTO ImageData(uid, path, info, blob) VALUES (?, ?, ?, ?)", Rows())
+  conn.execute("PRAGMA user_version = 1")
+  conn.commit()
+  conn.close()
+
+
+async def _Migrate(path: str) -> None:
+  async with aiosqlite.connect(path) as conn:
+    for m in store.Migrations():
+      start = time.perf_counter()
+      if await store_migration.RunMigrations(conn, [m]):
+        print(f"  migration {m.version}: {time.perf_counter() - start:.2f}s")
+
+
+def main():
+  args = PARSER.parse_args()
+  store_migration.BatchedMigration.batch_size = args.batch_size
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    path = os.path.join(tmp_dir, "catalog.nmcatalog")
+    start = time.perf_counter()
+    _CreateV1Catalog(path, args.rows)
+    print(f"Created a catalog of {args.rows:,} rows in {time.perf_counter() - start:.2f}s "
+          f"({os.path.getsize(path) / 1024 / 1024:.0f} MiB)")
+
+    start = time.perf_counter()
+    asyncio.run(_Migrate(path))
+    elapsed = time.perf_counter() - start
+    print(f"Migrated in {elapsed:.2f}s ({args.rows / elapsed:,.0f} rows/s, "
+          f"batch size {args.batch_size})")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,104 @@
+"""Measures WebSocket event delivery rates for a registration-heavy scan.
+
+Every image produces FILE_REGISTERED and THUMBNAIL_UPDATED events, every
+batch of 8 images a LONG_OPERATION_STATUS one (see long_operations/scan.py).
+Events are fanned out to --sockets renderers that discard what they get.
+
+Usage: python -m newmedia.benchmarks.ws_benchmark [--images N] [--sockets N]
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any, Callable, List
+from unittest import mock
+
+from newmedia import communicator
+from newmedia import ws_codec
+from newmedia.benchmarks import codec_benchmark
+from newmedia.utils.json_type import JSON
+
+PARSER = argparse.ArgumentParser(description="WebSocket event delivery benchmark.")
+PARSER.add_argument("--images", type=int, default=20000)
+PARSER.add_argument("--sockets", type=int, default=2)
+
+
+class _DiscardingWebSocket:
+  close_code = None
+
+  def __init__(self):
+    self.received = 0
+
+  async def send_str(self, data: str) -> None:
+    self.received += len(data)
+
+  async def send_bytes(self, data: bytes) -> None:
+    self.received += len(data)
+
+  async def send_json(self, data: Any, dumps: Callable[[Any], str] = json.dumps) -> None:
+    await self.send_str(dumps(data))
+
+
+def _ScanEvents(num_images: int) -> List[JSON]:
+  events: List[JSON] = []
+  for i in range(num_images):
+    if i % 8 == 0:
+      events.append({
+          "action": "LONG_OPERATION_STATUS",
+          "loid": "scan",
+          "status": {"status": f"Processing {i}", "progress": i / num_images * 100},
+      })
+    image = codec_benchmark._MakeImageFile(i)
+    events.append({"action": "FILE_REGISTERED", "image": image.ToJSON()})
+    events.append({"action": "THUMBNAIL_UPDATED", "image": image.ToJSON()})
+  return events
+
+
+async def _PerSocketSendJSON(events: List[JSON], num_sockets: int) -> None:
+  # How events used to be sent: one message per event, encoded per socket.
+  sockets = [_DiscardingWebSocket() for _ in range(num_sockets)]
+  for e in events:
+    await asyncio.gather(*(ws.send_json(e) for ws in sockets))
+
+
+async def _Communicator(events: List[JSON], num_sockets: int, format: str) -> None:
+  c = communicator.WebSocketCommunicator()
+  for _ in range(num_sockets):
+    ws = _DiscardingWebSocket()
+    c._clients[ws] = communicator._Client(ws, ws_codec.CodecForFormat(format))  # type: ignore
+  for e in events:
+    await c.SendWebSocketData(e)
+  await c.Flush()
+  for client in c._clients.values():  # type: ignore
+    await client.Close()
+
+
+async def _Measure(name: str, coro: Any, num_events: int) -> None:
+  start = time.perf_counter()
+  await coro
+  elapsed = time.perf_counter() - start
+  print(f"{name:>28}: {num_events / elapsed:>12,.0f} events/s ({elapsed:.2f}s per {num_events:,})")
+
+
+async def Run(num_images: int, num_sockets: int) -> None:
+  events = _ScanEvents(num_images)
+  print(f"{len(events):,} events, {num_sockets} sockets")
+
+  await _Measure("per-socket send_json", _PerSocketSendJSON(events, num_sockets), len(events))
+  with mock.patch.object(ws_codec, "orjson", None):
+    await _Measure("batched json (stdlib)",
+                   _Communicator(events, num_sockets, ws_codec.JSON_FORMAT), len(events))
+  if ws_codec.orjson is not None:
+    await _Measure("batched json (orjson)",
+                   _Communicator(events, num_sockets, ws_codec.JSON_FORMAT), len(events))
+  await _Measure("batched msgpack",
+                 _Communicator(events, num_sockets, ws_codec.MSGPACK_FORMAT), len(events))
+
+
+def main():
+  args = PARSER.parse_args()
+  asyncio.run(Run(args.images, args.sockets))
+
+
+if __name__ == "__main__":
+  main()
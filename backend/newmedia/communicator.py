@@ -1,10 +1,14 @@
 import abc
 import asyncio
+import collections
+import dataclasses
+import itertools
 import logging
-from typing import Set, Union
+from typing import Deque, Dict, Hashable, List, Optional, Tuple, Union, cast
 
 from aiohttp import web, WSMsgType
 from aiohttp.web_ws import WebSocketResponse
+from newmedia import ws_codec
 from newmedia.utils.json_type import JSON, ToJSONProtocol
 
 
@@ -12,13 +16,38 @@ class Error(Exception):
   pass
 
 
-class NoWebsocketsError(Error):
-  pass
+# Events are sent to the renderer in batches: a batch is flushed this long
+# after its first event was queued...
+BATCH_FLUSH_INTERVAL = 0.05
+# ...or as soon as it has this many events.
+MAX_BATCH_SIZE = 500
+
+# Maximum number of events queued for a renderer. Once it's reached,
+# status-type events are dropped, while producers of other events wait...
+MAX_QUEUE_SIZE = 10000
+# ...for at most this long, after which the renderer is disconnected.
+SEND_TIMEOUT = 30
+
+# Number of most recent events kept to be sent again to renderers that
+# reconnect (e.g. after the machine slept) or connect late (on startup).
+RESUME_BUFFER_SIZE = 5000
+
+
+def _MergeKey(data: JSON) -> Optional[Hashable]:
+  """Returns a key of status-type events, only the latest of which matters."""
+  action = data.get("action")
+  if action == "LONG_OPERATION_STATUS":
+    return (action, data.get("loid"))
+  # BACKEND_STATE_UPDATE events are patches, coalesced by BackendState itself.
+  return None
 
 
 class Communicator(abc.ABC):
   @abc.abstractmethod
-  async def ListenToWebSocket(self, ws: WebSocketResponse) -> None:
+  async def ListenToWebSocket(self,
+                              ws: WebSocketResponse,
+                              codec: Optional[ws_codec.WebSocketCodec] = None,
+                              since: Optional[int] = None) -> None:
     raise NotImplemented()
 
   @abc.abstractmethod
@@ -26,61 +55,276 @@ class Communicator(abc.ABC):
     raise NotImplemented()
 
 
+@dataclasses.dataclass
+class ClientStats:
+  queued: int = 0
+  max_queued: int = 0
+  sent_events: int = 0
+  sent_batches: int = 0
+  # Status-type events replaced by newer ones before they were sent.
+  merged: int = 0
+  # Status-type events dropped because the queue was full.
+  dropped: int = 0
+
+  def ToJSON(self) -> JSON:
+    return dataclasses.asdict(self)
+
+
+class _Client:
+  """Queue of events to be sent to a single renderer, and its sender task."""
+
+  def __init__(self, ws: WebSocketResponse, codec: ws_codec.WebSocketCodec):
+    self.ws = ws
+    self.codec = codec
+    self.closed = False
+    self.stats = ClientStats()
+
+    # (sequence number, encoded event) in the order they're to be sent.
+    # Status-type events are keyed by their merge key, other events by a
+    # unique number.
+    self._pending: Dict[Hashable, Tuple[int, ws_codec.Message]] = {}
+    self._pending_counter = itertools.count()
+    self._sending = False
+    self._changed = asyncio.Condition()
+    self._flush_requested = False
+    self._sender = asyncio.create_task(self._SendLoop())
+
+  async def Put(self, key: Optional[Hashable], seq: int, event: ws_codec.Message) -> None:
+    async with self._changed:
+      if key is not None:
+        if key in self._pending:
+          # Moves the merged event to the end of the queue.
+          del self._pending[key]
+          self.stats.merged += 1
+        elif len(self._pending) >= MAX_QUEUE_SIZE:
+          self.stats.dropped += 1
+          return
+      else:
+        if len(self._pending) >= MAX_QUEUE_SIZE:
+          await self._WaitForRoom()
+        if self.closed:
+          return
+        key = next(self._pending_counter)
+
+      self._pending[key] = (seq, event)
+      self.stats.queued = len(self._pending)
+      self.stats.max_queued = max(self.stats.max_queued, self.stats.queued)
+      # Only wakes up the sender when there's something new for it to do.
+      if self.stats.queued == 1 or self.stats.queued == MAX_BATCH_SIZE:
+        self._changed.notify_all()
+
+  async def _WaitForRoom(self) -> None:
+    try:
+      await asyncio.wait_for(
+          self._changed.wait_for(lambda: self.closed or len(self._pending) < MAX_QUEUE_SIZE),
+          SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+      logging.warning("WebSocket client didn't receive events for %ds, disconnecting",
+                      SEND_TIMEOUT)
+      self.closed = True
+      self._sender.cancel()
+      asyncio.create_task(self.ws.close())
+
+  async def Flush(self) -> None:
+    """Waits until all queued events are sent."""
+    async with self._changed:
+      self._flush_requested = True
+      self._changed.notify_all()
+      await self._changed.wait_for(lambda: self.closed or not (self._pending or self._sending))
+
+  async def Close(self) -> None:
+    self._sender.cancel()
+    try:
+      await self._sender
+    except asyncio.CancelledError:
+      pass
+
+  async def _SendLoop(self) -> None:
+    try:
+      while True:
+        async with self._changed:
+          await self._changed.wait_for(lambda: self._pending)
+          # Gives more events a chance to make it into the batch.
+          try:
+            await asyncio.wait_for(
+                self._changed.wait_for(
+                    lambda: self._flush_requested or len(self._pending) >= MAX_BATCH_SIZE),
+                BATCH_FLUSH_INTERVAL)
+          except asyncio.TimeoutError:
+            pass
+
+          keys = list(itertools.islice(self._pending, MAX_BATCH_SIZE))
+          seqs, events = zip(*(self._pending.pop(k) for k in keys))
+          self.stats.queued = len(self._pending)
+          if not self._pending:
+            self._flush_requested = False
+          self._sending = True
+          self._changed.notify_all()
+
+        try:
+          message = self.codec.EncodeBatch(max(seqs), list(events))
+          if self.codec.binary:
+            await self.ws.send_bytes(cast(bytes, message))
+          else:
+            await self.ws.send_str(cast(str, message))
+        finally:
+          async with self._changed:
+            self._sending = False
+            self._changed.notify_all()
+        self.stats.sent_events += len(events)
+        self.stats.sent_batches += 1
+    except (ConnectionError, RuntimeError) as e:
+      logging.info("Failed to send WebSocket events, disconnecting: %s", e)
+    finally:
+      self.closed = True
+      async with self._changed:
+        self._changed.notify_all()
+
+
+class _BufferedEvent:
+  __slots__ = ("seq", "key", "data", "encoded")
+
+  def __init__(self, seq: int, key: Optional[Hashable], data: JSON):
+    self.seq = seq
+    self.key = key
+    self.data = data
+    self.encoded: Dict[ws_codec.WebSocketCodec, ws_codec.Message] = {}
+
+  def Encode(self, codec: ws_codec.WebSocketCodec) -> ws_codec.Message:
+    result = self.encoded.get(codec)
+    if result is None:
+      result = self.encoded[codec] = codec.EncodeEvent(self.data)
+    return result
+
+
 class WebSocketCommunicator(Communicator):
+  """Sends events to all connected renderers in batches.
+
+  Every renderer has its own bounded queue of events, sent by a separate
+  task as {"action": "BATCH", "actions": [...]} messages. Status-type
+  events queued for a renderer are merged, so that only the latest one of
+  every kind (e.g. per long operation) is sent.
+
+  Events are encoded once per format (see ws_codec.py) and the encoded
+  bytes are shared by the queues of all renderers using it.
+
+  Every event gets a sequence number, every batch carries the number of its
+  last event. Every event is also kept in a ring buffer of recent events,
+  whether renderers are connected or not, so that a renderer reconnecting
+  with the last number it got receives what it missed. Sending never waits
+  for the buffer: the oldest events are dropped once it's full. A renderer
+  that missed more than the buffer holds (or resumes from a number the
+  backend doesn't know, as it restarted) gets a {"action": "RESYNC"} event
+  instead, telling it to reload the images it has.
+  """
+
   def __init__(self):
-    self._websockets: Set[web.WebSocketResponse] = set()
+    self._clients: Dict[web.WebSocketResponse, _Client] = {}
+    self._seq = 0
+    self._buffer: Deque[_BufferedEvent] = collections.deque(maxlen=RESUME_BUFFER_SIZE)
+    self._ever_connected = False
 
-  async def ListenToWebSocket(self, ws: WebSocketResponse):
+  async def ListenToWebSocket(self,
+                              ws: WebSocketResponse,
+                              codec: Optional[ws_codec.WebSocketCodec] = None,
+                              since: Optional[int] = None):
     logging.info("Websocket connection opened")
-    self._websockets.add(ws)
-
-    async for msg in ws:
-      if msg.type == WSMsgType.TEXT:
-        logging.info("Got text WebSocket message: %s", msg)
-      elif msg.type == WSMsgType.CLOSING:
-        logging.info("WebSocket connection is about to close.")
-      elif msg.type == WSMsgType.ERROR:
-        logging.error('WebSocket connection closed with exception %s' % ws.exception())
-      elif msg.type == WSMsgType.CLOSED:
-        logging.info("WebSocket connection closed exiting.")
-      else:
-        logging.info("Message of type: %s %s", msg.type, msg)
+    client = _Client(ws, codec or ws_codec.CodecForFormat(ws_codec.JSON_FORMAT))
+    self._clients[ws] = client
+    await self._Resume(client, since)
 
-    self._websockets.remove(ws)
+    try:
+      async for msg in ws:
+        if msg.type == WSMsgType.TEXT:
+          logging.info("Got text WebSocket message: %s", msg)
+        elif msg.type == WSMsgType.CLOSING:
+          logging.info("WebSocket connection is about to close.")
+        elif msg.type == WSMsgType.ERROR:
+          logging.error('WebSocket connection closed with exception %s' % ws.exception())
+        elif msg.type == WSMsgType.CLOSED:
+          logging.info("WebSocket connection closed exiting.")
+        else:
+          logging.info("Message of type: %s %s", msg.type, msg)
+    finally:
+      self._clients.pop(ws, None)
+      await client.Close()
 
     logging.info("WebSocket connection closed.")
 
+  async def _Resume(self, client: _Client, since: Optional[int]) -> None:
+    """Queues buffered events the client hasn't received yet."""
+    ever_connected, self._ever_connected = self._ever_connected, True
+    if since is None:
+      # Only the first renderer gets the events sent before it connected,
+      # other renderers have (re)loaded their state in the meantime.
+      if ever_connected:
+        return
+      since = 0
+
+    if since > self._seq:
+      logging.info("WebSocket client resumes from %d, but the last event is %d (backend restarted?)",
+                   since, self._seq)
+      await self._Resync(client)
+      return
+    if self._buffer and self._buffer[0].seq > since + 1:
+      logging.warning("Events %d to %d were dropped from the buffer before the client resumed",
+                      since + 1, self._buffer[0].seq - 1)
+      await self._Resync(client)
+      return
+
+    for e in list(self._buffer):
+      if e.seq > since:
+        await client.Put(e.key, e.seq, e.Encode(client.codec))
+
+  async def _Resync(self, client: _Client) -> None:
+    """Tells a client that missed events to reload its state.
+
+    The client continues with events sent after the current one, which its
+    reloaded state already reflects.
+    """
+    event = _BufferedEvent(self._seq, None, {"action": "RESYNC"})
+    await client.Put(event.key, event.seq, event.Encode(client.codec))
+
+  def Stats(self) -> List[ClientStats]:
+    return [c.stats for c in self._clients.values()]
+
   async def SendWebSocketData(self, data: Union[JSON, ToJSONProtocol]):
-    # Remove websockets that were closed abnormally. Chromium will close local
-    # websocket connections every time the machine goes to sleep. On the backend
-    # side these websockets won't receive any notification, but their close_code
-    # property will be set correctly.
     json_data: JSON
-    if isinstance(data, ToJSONProtocol):
+    # Checking for dicts first is much cheaper than checking the protocol.
+    if not isinstance(data, dict) and isinstance(data, ToJSONProtocol):
       json_data = data.ToJSON()
     else:
       json_data = data
 
-    to_remove = set(ws for ws in self._websockets if ws.close_code is not None)
+    # Remove websockets that were closed abnormally. Chromium will close local
+    # websocket connections every time the machine goes to sleep. On the backend
+    # side these websockets won't receive any notification, but their close_code
+    # property will be set correctly.
+    to_remove = [ws for ws, c in self._clients.items() if ws.close_code is not None or c.closed]
     if to_remove:
       logging.info("Found %d dead websockets, removing", len(to_remove))
-      self._websockets.difference_update(to_remove)
+      for ws in to_remove:
+        await self._clients.pop(ws).Close()
+
+    self._seq += 1
+    event = _BufferedEvent(self._seq, _MergeKey(json_data), json_data)
+    self._buffer.append(event)
 
-    try_num = 0
-    while not self._websockets:
-      logging.info(
-          "No websockets to send data to, most likely: the app is still starting and connection wasn't established yet. Waiting.")
-      await asyncio.sleep(1)
-      try_num += 1
-      if try_num > 30:
-        raise NoWebsocketsError("Timeout while waiting for websockets to connect.")
+    # Every event is encoded once per format in use.
+    for client in list(self._clients.values()):
+      await client.Put(event.key, event.seq, event.Encode(client.codec))
 
-    coros = [asyncio.shield(ws.send_json(json_data)) for ws in self._websockets]
-    asyncio.gather(*coros)
+  async def Flush(self) -> None:
+    """Waits until all queued events are sent."""
+    for client in list(self._clients.values()):
+      await client.Flush()
 
 
 class CommunicatorStub(Communicator):
-  async def ListenToWebSocket(self, ws: WebSocketResponse):
+  async def ListenToWebSocket(self,
+                              ws: WebSocketResponse,
+                              codec: Optional[ws_codec.WebSocketCodec] = None,
+                              since: Optional[int] = None):
     pass
 
   async def SendWebSocketData(self, data: Union[JSON, ToJSONProtocol]):
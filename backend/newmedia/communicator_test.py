@@ -0,0 +1,223 @@
+import asyncio
+import json
+from typing import Any, List, Optional
+from unittest import mock
+
+import msgpack
+import pytest
+
+from newmedia import communicator
+from newmedia import ws_codec
+
+
+class _FakeWebSocket:
+
+  def __init__(self, delay: float = 0):
+    self.close_code: Optional[int] = None
+    self.sent: List[Any] = []
+    self.delay = delay
+
+  async def send_str(self, data: str) -> None:
+    await asyncio.sleep(self.delay)
+    self.sent.append(json.loads(data))
+
+  async def send_bytes(self, data: bytes) -> None:
+    await asyncio.sleep(self.delay)
+    self.sent.append(msgpack.unpackb(data))
+
+  async def close(self) -> None:
+    self.close_code = 1000
+
+
+def _Connect(c: communicator.WebSocketCommunicator,
+             delay: float = 0,
+             format: str = ws_codec.JSON_FORMAT) -> _FakeWebSocket:
+  ws = _FakeWebSocket(delay)
+  c._clients[ws] = communicator._Client(ws, ws_codec.CodecForFormat(format))  # type: ignore
+  return ws
+
+
+async def _Reconnect(c: communicator.WebSocketCommunicator,
+                     since: Optional[int]) -> _FakeWebSocket:
+  ws = _Connect(c)
+  await c._Resume(c._clients[ws], since)  # type: ignore
+  return ws
+
+
+async def _Disconnect(c: communicator.WebSocketCommunicator, ws: _FakeWebSocket) -> None:
+  await c._clients.pop(ws).Close()  # type: ignore
+
+
+def _SentImages(ws: _FakeWebSocket) -> List[List[Any]]:
+  return [[a["image"] for a in b["actions"]] for b in ws.sent]
+
+
+@pytest.mark.asyncio
+async def test_EventsAreSentInBatchesWithStatusesMerged():
+  c = communicator.WebSocketCommunicator()
+  ws = _Connect(c)
+
+  await c.SendWebSocketData({"action": "LONG_OPERATION_STATUS", "loid": "a", "status": 1})
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 1})
+  await c.SendWebSocketData({"action": "LONG_OPERATION_STATUS", "loid": "b", "status": 1})
+  await c.SendWebSocketData({"action": "LONG_OPERATION_STATUS", "loid": "a", "status": 2})
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 2})
+  assert ws.sent == []
+
+  await asyncio.sleep(communicator.BATCH_FLUSH_INTERVAL * 2)
+  assert ws.sent == [{
+      "action": "BATCH",
+      "seq": 5,
+      "actions": [
+          {"action": "FILE_REGISTERED", "image": 1},
+          {"action": "LONG_OPERATION_STATUS", "loid": "b", "status": 1},
+          {"action": "LONG_OPERATION_STATUS", "loid": "a", "status": 2},
+          {"action": "FILE_REGISTERED", "image": 2},
+      ],
+  }]
+  assert c.Stats()[0].merged == 1
+
+
+@pytest.mark.asyncio
+@mock.patch.object(communicator, "MAX_BATCH_SIZE", 2)
+async def test_FullBatchIsSentRightAway():
+  c = communicator.WebSocketCommunicator()
+  ws = _Connect(c)
+
+  for i in range(5):
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": i})
+  await asyncio.sleep(communicator.BATCH_FLUSH_INTERVAL / 5)
+  assert _SentImages(ws) == [[0, 1], [2, 3]]
+
+  await c.Flush()
+  assert _SentImages(ws) == [[0, 1], [2, 3], [4]]
+
+
+@pytest.mark.asyncio
+@mock.patch.object(communicator, "MAX_QUEUE_SIZE", 2)
+@mock.patch.object(communicator, "MAX_BATCH_SIZE", 2)
+async def test_SlowClientGetsAllDataEventsAndLatestStatuses():
+  c = communicator.WebSocketCommunicator()
+  slow = _Connect(c, delay=0.1)
+  fast = _Connect(c)
+
+  for i in range(6):
+    await c.SendWebSocketData({"action": "LONG_OPERATION_STATUS", "loid": "a", "status": i})
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": i})
+  await c.Flush()
+
+  for ws in (slow, fast):
+    actions = [a for b in ws.sent for a in b["actions"]]
+    assert [a["image"] for a in actions if "image" in a] == list(range(6))
+    assert [a["status"] for a in actions if "status" in a][-1] == 5
+
+  stats = c.Stats()[0]
+  assert stats.merged + stats.dropped > 0
+  assert stats.max_queued == 2
+  assert stats.sent_events == 12 - stats.merged - stats.dropped
+
+
+@pytest.mark.asyncio
+@mock.patch.object(communicator, "MAX_QUEUE_SIZE", 1)
+@mock.patch.object(communicator, "SEND_TIMEOUT", 0.1)
+async def test_StalledClientIsDisconnected():
+  c = communicator.WebSocketCommunicator()
+  stalled = _Connect(c, delay=60)
+  fast = _Connect(c)
+
+  for i in range(3):
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": i})
+  await asyncio.sleep(0)
+  assert stalled.close_code is not None
+
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 3})
+  await c.Flush()
+  assert [i for b in _SentImages(fast) for i in b] == [0, 1, 2, 3]
+  assert len(c.Stats()) == 1
+
+
+@pytest.mark.asyncio
+async def test_EventsAreEncodedOncePerFormat():
+  c = communicator.WebSocketCommunicator()
+  json_sockets = [_Connect(c) for _ in range(3)]
+  msgpack_socket = _Connect(c, format=ws_codec.MSGPACK_FORMAT)
+
+  with mock.patch.object(ws_codec.JSONCodec, "EncodeEvent",
+                         autospec=True,
+                         side_effect=ws_codec.JSONCodec.EncodeEvent) as encode:
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": {"uid": "a", "size": 1}})
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": {"uid": "b", "size": 2}})
+    await c.Flush()
+    assert encode.call_count == 2
+
+  for ws in json_sockets + [msgpack_socket]:
+    assert ws.sent == [{
+        "action": "BATCH",
+        "seq": 2,
+        "actions": [
+            {"action": "FILE_REGISTERED", "image": {"uid": "a", "size": 1}},
+            {"action": "FILE_REGISTERED", "image": {"uid": "b", "size": 2}},
+        ],
+    }]
+
+
+@pytest.mark.asyncio
+async def test_ReconnectingClientResumesFromLastReceivedEvent():
+  c = communicator.WebSocketCommunicator()
+
+  # Sending doesn't wait for a client to connect. Events sent before the
+  # first client connected are sent to it.
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 0})
+  first = await _Reconnect(c, None)
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 1})
+  await c.Flush()
+  assert [i for b in _SentImages(first) for i in b] == [0, 1]
+  last_seq = first.sent[-1]["seq"]
+  await _Disconnect(c, first)
+
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 2})
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 3})
+
+  resumed = await _Reconnect(c, last_seq)
+  # A new client (e.g. after the renderer was reloaded) only gets new events.
+  new = await _Reconnect(c, None)
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 4})
+  await c.Flush()
+  assert [i for b in _SentImages(resumed) for i in b] == [2, 3, 4]
+  assert [i for b in _SentImages(new) for i in b] == [4]
+  assert resumed.sent[-1]["seq"] == new.sent[-1]["seq"] == 5
+
+
+@pytest.mark.asyncio
+@mock.patch.object(communicator, "RESUME_BUFFER_SIZE", 2)
+async def test_ClientThatMissedDroppedEventsIsToldToResync():
+  c = communicator.WebSocketCommunicator()
+  first = await _Reconnect(c, None)
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 0})
+  await c.Flush()
+  last_seq = first.sent[-1]["seq"]
+  await _Disconnect(c, first)
+
+  # Events 2 and 3 are dropped from the buffer.
+  for i in range(1, 5):
+    await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": i})
+
+  resumed = await _Reconnect(c, last_seq)
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 5})
+  await c.Flush()
+  # Events sent since are applied after the state is reloaded.
+  assert resumed.sent == [{
+      "action": "BATCH",
+      "seq": 6,
+      "actions": [{"action": "RESYNC"}, {"action": "FILE_REGISTERED", "image": 5}],
+  }]
+
+
+@pytest.mark.asyncio
+async def test_ClientResumingAfterBackendRestartIsToldToResync():
+  c = communicator.WebSocketCommunicator()
+  await c.SendWebSocketData({"action": "FILE_REGISTERED", "image": 0})
+
+  resumed = await _Reconnect(c, 100)
+  await c.Flush()
+  assert resumed.sent == [{"action": "BATCH", "seq": 1, "actions": [{"action": "RESYNC"}]}]
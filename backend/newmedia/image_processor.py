@@ -5,6 +5,7 @@ import datetime
 import fractions
 import io
 import logging
+import multiprocessing
 import os
 import pathlib
 import time
@@ -17,7 +18,7 @@ import numpy
 import rawpy
 import tifffile  # allows low-level TIFF manipulation. Needed for formats not yet handled by PIL (16-bit color TIFFS)
 import xattr
-from PIL import Image, ImageCms, ImageFile, ImageMath, ExifTags, TiffImagePlugin
+from PIL import Image, ImageCms, ImageFile, ImageMath, ImageOps, ExifTags, TiffImagePlugin
 
 from newmedia import store_schema
 
@@ -32,6 +33,15 @@ class ImageProcessingError(Error):
 
 MAX_DIMENSION = 3200
 
+# Previews are rendered in several sizes (tiers), largest first. Larger tiers
+# may be evicted from the catalog to keep it within its preview budget (they
+# are rendered again when needed), while the smallest one is always kept.
+PREVIEW_TIERS = (MAX_DIMENSION, 1280, 400)
+
+# Bumped whenever previews are rendered differently (e.g. other decoding
+# options), so that previews cached by older versions aren't reused.
+PREVIEW_RENDER_VERSION = 1
+
 _SUPPORTED_PILLOW_EXTENSIONS = frozenset([
     ".jpg", ".jpeg", ".tif", ".tiff", ".png", ".bmp", ".gif", ".icns", ".ico", ".pcx", ".ppm",
     ".sgi", ".webp", ".xbm", ".psd", ".xpm"
@@ -316,7 +326,33 @@ def _GetRawPyFileInfo(path: pathlib.Path,
   ), preview_bytes
 
 
-def _ThumbnailFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes]]:
+def _RenderPreviews(
+    im: Image.Image) -> Tuple[List[store_schema.ImageFilePreview], Tuple[bytes, ...]]:
+  """Renders JPEG previews of every tier the image is bigger than, largest first.
+
+  The image is downscaled in place.
+  """
+  timestamp = int(time.time() * 1000)
+  previews = []
+  blobs = []
+  for tier in PREVIEW_TIERS:
+    # Images smaller than a tier are covered by the previous one.
+    if previews and max(im.size) <= tier:
+      continue
+
+    im.thumbnail((tier, tier))
+    out = io.BytesIO()
+    im.save(out, format='JPEG')
+
+    previews.append(
+        store_schema.ImageFilePreview(preview_size=store_schema.Size(im.width, im.height),
+                                      preview_timestamp=timestamp))
+    blobs.append(out.getvalue())
+
+  return previews, tuple(blobs)
+
+
+def _ThumbnailFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes, ...]]:
   logging.info("Thumbnailing file: %s", image_file.path)
 
   _, ext = os.path.splitext(image_file.path)
@@ -335,20 +371,22 @@ def _ThumbnailFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.Ima
     logging.info("ThumbnailFile %s took %.2fs", image_file.path, end_time - start_time)
 
 
-def _ThumbnailPillowFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes]]:
-  try:
-    stat = os.stat(image_file.path)
-  except IOError as e:
-    raise ImageProcessingError(e)
+def _DecodePillowImage(path: str, draft_size: Optional[int] = None) -> Image.Image:
+  """Decodes the image into RGB.
 
+  If draft_size is set, JPEGs are decoded at the smallest scale still bigger
+  than draft_size, which is a lot faster than decoding them fully.
+  """
   try:
-    im = Image.open(image_file.path)
+    im = Image.open(path)
+    if draft_size is not None:
+      im.draft("RGB", (draft_size, draft_size))
     # Grayscale tiffs first have to be normalized to have values ranging from 0 to 255 (IIUC, floating point values are ok).
     if im.mode == "RGBA":
       back = Image.new('RGBA', im.size, color="palegreen")
       im = Image.alpha_composite(back, im)
     elif im.mode == "RGBX" and im.format == "TIFF":
-      np: numpy.ndarray = tifffile.imread(image_file.path)  # type: ignore
+      np: numpy.ndarray = tifffile.imread(path)  # type: ignore
       # PIL doesn't support 16-bit-per-channel images well, but we can convert it to 8-bit images - that should be enough
       # for preview purposes.
       if np.dtype == "uint16":
@@ -367,28 +405,49 @@ def _ThumbnailPillowFile(image_file: store_schema.ImageFile) -> Tuple[store_sche
       im = im.convert("F")
       im = ImageMath.eval('im/256', {'im': im}).convert('L')
 
-    im = im.convert("RGB")
+    return im.convert("RGB")
   except IOError as e:
     raise ImageProcessingError(e)
 
+
+def _DecodeRawPyImage(path: str, min_size: Optional[int] = None) -> Image.Image:
+  """Decodes the RAW file into RGB.
+
+  The image is decoded at half size unless that's smaller than min_size.
+  """
   try:
-    width, height = im.size
-    im.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
-    target_width, target_height = im.size
+    with rawpy.imread(path) as raw:
+      half_size = (min_size is None or
+                   max(raw.sizes.width, raw.sizes.height) // 2 >= min_size)  # type: ignore
+      rgb = raw.postprocess(
+          half_size=half_size,
+          output_bps=8,
+          use_camera_wb=True,
+      )
+      return Image.fromarray(rgb)
+  except (IOError, rawpy.LibRawError) as e:  # type: ignore
+    logging.exception(e)
+    raise ImageProcessingError(e)
 
-    out = io.BytesIO()
-    im.save(out, format='JPEG')
+
+def _ThumbnailPillowFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes, ...]]:
+  try:
+    stat = os.stat(image_file.path)
+  except IOError as e:
+    raise ImageProcessingError(e)
+
+  im = _DecodePillowImage(image_file.path)
+
+  try:
+    width, height = im.size
+    previews, blobs = _RenderPreviews(im)
 
     return (
         store_schema.ImageFile(
             path=image_file.path,
             uid=image_file.uid,
             size=store_schema.Size(width, height),
-            previews=[
-                store_schema.ImageFilePreview(
-                    preview_size=store_schema.Size(target_width, target_height),
-                    preview_timestamp=int(time.time() * 1000))
-            ],
+            previews=previews,
 
             file_color_tag=image_file.file_color_tag,
             file_size=stat.st_size,
@@ -399,48 +458,30 @@ def _ThumbnailPillowFile(image_file: store_schema.ImageFile) -> Tuple[store_sche
             icc_profile_description=image_file.icc_profile_description,
             exif_data=image_file.exif_data,
         ),
-        (out.getvalue(),),
+        blobs,
     )
   finally:
     im.close()
 
 
-def _ThumbnailRawPyFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes]]:
+def _ThumbnailRawPyFile(image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes, ...]]:
   try:
     stat = os.stat(image_file.path)
   except IOError as e:
     raise ImageProcessingError(e)
 
-  try:
-    with rawpy.imread(image_file.path) as raw:
-      rgb = raw.postprocess(
-          half_size=True,
-          output_bps=8,
-          use_camera_wb=True,
-      )
-      im = Image.fromarray(rgb)
-  except (IOError, rawpy.LibRawError) as e:  # type: ignore
-    logging.exception(e)
-    raise ImageProcessingError(e)
+  im = _DecodeRawPyImage(image_file.path)
 
   try:
     width, height = im.size
-    im.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
-    target_width, target_height = im.size
-
-    out = io.BytesIO()
-    im.save(out, format='JPEG')
+    previews, blobs = _RenderPreviews(im)
 
     return (
         store_schema.ImageFile(
             path=image_file.path,
             uid=image_file.uid,
             size=store_schema.Size(width, height),
-            previews=[
-                store_schema.ImageFilePreview(
-                    preview_size=store_schema.Size(target_width, target_height),
-                    preview_timestamp=int(time.time() * 1000))
-            ],
+            previews=previews,
 
             file_color_tag=image_file.file_color_tag,
             file_size=stat.st_size,
@@ -452,31 +493,197 @@ def _ThumbnailRawPyFile(image_file: store_schema.ImageFile) -> Tuple[store_schem
 
             exif_data=image_file.exif_data,
         ),
-        (out.getvalue(),),
+        blobs,
     )
   finally:
     im.close()
 
 
+JPEG_RENDITION = "jpeg"
+WEBP_RENDITION = "webp"
+
+# Pillow format and file extension of every rendition format.
+_RENDITION_FORMATS = {
+    JPEG_RENDITION: ("JPEG", ".jpg"),
+    WEBP_RENDITION: ("WEBP", ".webp"),
+}
+
+# Renditions are rendered in worker processes, so that decoding doesn't
+# compete with the backend for the GIL. Every worker may use at most this
+# much memory (enforced where the OS supports it): a worker running out of it
+# fails the rendition it's working on rather than taking the machine down.
+DEFAULT_RENDITION_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+DEFAULT_RENDITION_WORKER_MEMORY = 2 * 1024 * 1024 * 1024
+# Workers are replaced after this many renditions, returning memory left
+# fragmented by large decodes to the OS.
+_RENDITIONS_PER_WORKER = 50
+
+
+@dataclasses.dataclass(frozen=True)
+class RenditionOptions:
+  format: str = JPEG_RENDITION
+  # Maximum width and height (in pixels): smaller images are not upscaled.
+  max_size: int = 2048
+  quality: int = 85
+
+  def __post_init__(self):
+    if self.format not in _RENDITION_FORMATS:
+      raise ValueError(f"Unsupported rendition format: {self.format}")
+    if self.max_size <= 0:
+      raise ValueError(f"Invalid rendition size: {self.max_size}")
+    if not 1 <= self.quality <= 100:
+      raise ValueError(f"Invalid rendition quality: {self.quality}")
+
+  @property
+  def extension(self) -> str:
+    return _RENDITION_FORMATS[self.format][1]
+
+
+@dataclasses.dataclass(frozen=True)
+class Adjustments:
+  """Adjustments of an image made in the catalog (see store_metadata.py)."""
+  # Clockwise, in degrees.
+  rotation: int = 0
+  horizontal_flip: bool = False
+  vertical_flip: bool = False
+
+
+# Transpositions rotating an image clockwise by the given number of degrees.
+_CLOCKWISE_ROTATIONS = {
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+
+def _Adjust(im: Image.Image, adjustments: Adjustments) -> Image.Image:
+  """Flips, then rotates the image, the way the renderer displays it."""
+  if adjustments.horizontal_flip:
+    im = im.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+  if adjustments.vertical_flip:
+    im = im.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+  rotation = _CLOCKWISE_ROTATIONS.get(adjustments.rotation)
+  if rotation is not None:
+    im = im.transpose(rotation)
+  return im
+
+
+def _InitRenditionWorker(memory_limit: int) -> None:
+  try:
+    import resource
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard))
+  except (ImportError, ValueError, OSError) as e:
+    logging.warning("Can't limit rendition worker memory: %s", e)
+
+
+def _RenderRendition(src: str, dest: str, options: RenditionOptions,
+                     adjustments: Adjustments) -> int:
+  """Renders a rendition of the image at src into dest, returns its size in bytes.
+
+  The rendition is oriented as the EXIF data says, then adjusted. The EXIF
+  data is kept, except for the orientation.
+  """
+  _, ext = os.path.splitext(src)
+  ext = ext.lower()
+
+  start_time = time.time()
+  try:
+    if ext in _SUPPORTED_PILLOW_EXTENSIONS:
+      im = _DecodePillowImage(src, draft_size=options.max_size)
+      # rawpy orients RAW images by itself.
+      im = ImageOps.exif_transpose(im)
+    elif ext in _SUPPORTED_RAWPY_EXTENSIONS:
+      im = _DecodeRawPyImage(src, min_size=options.max_size)
+    else:
+      raise ImageProcessingError(f"Path {src} does not have a supported extension.")
+
+    try:
+      im = _Adjust(im, adjustments)
+      im.thumbnail((options.max_size, options.max_size), Image.LANCZOS)
+      im.save(dest,
+              format=_RENDITION_FORMATS[options.format][0],
+              quality=options.quality,
+              icc_profile=im.info.get("icc_profile"),
+              exif=im.getexif())
+    except IOError as e:
+      raise ImageProcessingError(e)
+    finally:
+      im.close()
+  except MemoryError:
+    raise ImageProcessingError(f"Not enough memory to render {src}")
+
+  logging.info("Rendition of %s took %.2fs", src, time.time() - start_time)
+  return os.path.getsize(dest)
+
+
 class ImageProcessor:
-  def __init__(self):
+  def __init__(self,
+               rendition_workers: int = DEFAULT_RENDITION_WORKERS,
+               rendition_worker_memory: int = DEFAULT_RENDITION_WORKER_MEMORY):
     self._info_thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
     self._thumbnail_thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
+    self._rendition_workers = rendition_workers
+    self._rendition_worker_memory = rendition_worker_memory
+    # Started on first use.
+    self._rendition_process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+  def _RenditionProcessPool(self) -> concurrent.futures.ProcessPoolExecutor:
+    if self._rendition_process_pool is None:
+      self._rendition_process_pool = concurrent.futures.ProcessPoolExecutor(
+          max_workers=self._rendition_workers,
+          mp_context=multiprocessing.get_context("spawn"),
+          initializer=_InitRenditionWorker,
+          initargs=(self._rendition_worker_memory,),
+          max_tasks_per_child=_RENDITIONS_PER_WORKER)
+    return self._rendition_process_pool
+
+  @property
+  def rendition_workers(self) -> int:
+    return self._rendition_workers
+
   async def GetFileInfo(self, path: pathlib.Path, prev_info: Optional[store_schema.ImageFile]) -> Tuple[store_schema.ImageFile, bytes]:
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(self._info_thread_pool, _GetFileInfo, path,
                                       prev_info)
 
-  async def ThumbnailFile(self, image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes]]:
+  async def ThumbnailFile(self, image_file: store_schema.ImageFile) -> Tuple[store_schema.ImageFile, Tuple[bytes, ...]]:
     loop = asyncio.get_running_loop()
     return await loop.run_in_executor(self._thumbnail_thread_pool,
                                       _ThumbnailFile, image_file)
 
+  async def RenderRendition(self,
+                            src: str,
+                            dest: str,
+                            options: RenditionOptions,
+                            adjustments: Adjustments = Adjustments()) -> int:
+    """Renders a rendition of the image at src into dest, returns its size in bytes.
+
+    The rendition is rendered in a worker process, which keeps going if the
+    call is cancelled.
+    """
+    loop = asyncio.get_running_loop()
+    pool = self._RenditionProcessPool()
+    try:
+      return await loop.run_in_executor(pool, _RenderRendition, src, dest, options, adjustments)
+    except concurrent.futures.BrokenExecutor as e:
+      # A worker died (e.g. it was killed for using too much memory), which
+      # makes the pool unusable: a new one is started on next use.
+      if self._rendition_process_pool is pool:
+        self._rendition_process_pool = None
+        pool.shutdown(wait=False)
+      raise ImageProcessingError(e)
+
+  def Shutdown(self) -> None:
+    if self._rendition_process_pool is not None:
+      self._rendition_process_pool.shutdown(wait=False, cancel_futures=True)
+
 
 IMAGE_PROCESSOR: ImageProcessor
 
 
-def InitImageProcessor() -> None:
+def InitImageProcessor(rendition_workers: int = DEFAULT_RENDITION_WORKERS,
+                       rendition_worker_memory: int = DEFAULT_RENDITION_WORKER_MEMORY) -> None:
   global IMAGE_PROCESSOR
-  IMAGE_PROCESSOR = ImageProcessor()
+  IMAGE_PROCESSOR = ImageProcessor(rendition_workers, rendition_worker_memory)
@@ -2,7 +2,9 @@ import abc
 import dataclasses
 import enum
 import uuid
-from typing import Awaitable, Callable
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from newmedia import scheduler
 
 
 @dataclasses.dataclass
@@ -10,8 +12,30 @@ class Status:
   status: str
   progress: float
 
+  # Work done so far (all optional), throughput and ETA are derived from it.
+  items_done: Optional[int] = None
+  items_total: Optional[int] = None
+  bytes_done: Optional[int] = None
+  bytes_total: Optional[int] = None
+
+  # Filled in by LongOperationRunner.
+  items_per_second: Optional[float] = None
+  bytes_per_second: Optional[float] = None
+  # In seconds.
+  eta: Optional[float] = None
+
   def ToJSON(self):
-    return dataclasses.asdict(self)
+    # Sent on every status update, so built directly rather than with
+    # dataclasses.asdict(). Fields that aren't set are omitted.
+    result: Dict[str, Any] = {"status": self.status, "progress": self.progress}
+    for name in _OPTIONAL_STATUS_FIELDS:
+      v = getattr(self, name)
+      if v is not None:
+        result[name] = v
+    return result
+
+
+_OPTIONAL_STATUS_FIELDS = tuple(f.name for f in dataclasses.fields(Status)[2:])
 
 
 @dataclasses.dataclass
@@ -35,6 +59,15 @@ LogCallback = Callable[[LogMessage], Awaitable[None]]
 
 class LongOperation(metaclass=abc.ABCMeta):
 
+  # Priority of the operation's work when it competes for resources with other
+  # operations (see scheduler.py).
+  priority = scheduler.Priority.BACKGROUND
+
+  # Whether the operation can be stopped midway. Only operations that stop
+  # all the work they started (and leave nothing half done) when their Run()
+  # is cancelled are.
+  cancellable = False
+
   def __init__(self):
     self.operation_id = uuid.uuid4().hex
 
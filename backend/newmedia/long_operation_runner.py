@@ -1,20 +1,133 @@
+import asyncio
+import dataclasses
 import logging
-from typing import Dict
+from typing import Awaitable, Callable, Dict, Optional, Set
 
+from newmedia import scheduler
 from newmedia.communicator import Communicator
 from newmedia.long_operation import LogMessage, LongOperation, Status
 
+# Status updates of an operation are sent at most this often (in seconds) by
+# default. The last status before the operation ends is always sent.
+DEFAULT_STATUS_INTERVAL = 0.25
+
+
+class Error(Exception):
+  pass
+
+
+class NotCancellableError(Error):
+  pass
+
+
+class _Throughput:
+  """Exponentially smoothed rate of a growing counter."""
+
+  _SMOOTHING = 0.3
+
+  def __init__(self, now: float):
+    self._time = now
+    self._value = 0
+    self.rate: Optional[float] = None
+
+  def Update(self, now: float, value: int) -> Optional[float]:
+    if value < self._value:
+      # The counter was reset (e.g. a new phase of the operation started).
+      self._time, self._value, self.rate = now, value, None
+    elif now > self._time:
+      sample = (value - self._value) / (now - self._time)
+      if self.rate is None:
+        self.rate = sample
+      else:
+        self.rate = self._SMOOTHING * sample + (1 - self._SMOOTHING) * self.rate
+      self._time, self._value = now, value
+    return self.rate
+
+
+class _StatusThrottle:
+  """Sends the latest status of an operation at most once per interval."""
+
+  def __init__(self, send: Callable[[Status], Awaitable[None]], interval: float):
+    self._send = send
+    self._interval = interval
+    self._loop = asyncio.get_running_loop()
+
+    self._pending: Optional[Status] = None
+    self._last_sent = float("-inf")
+    self._flush_handle: Optional[asyncio.TimerHandle] = None
+    self._sending: Optional["asyncio.Task[None]"] = None
+
+    now = self._loop.time()
+    self._items = _Throughput(now)
+    self._bytes = _Throughput(now)
+
+  async def Report(self, status: Status) -> None:
+    self._pending = status
+    due = self._last_sent + self._interval
+    if self._loop.time() >= due:
+      await self._SendPending()
+    elif self._flush_handle is None:
+      self._flush_handle = self._loop.call_at(due, self._ScheduledSend)
+
+  async def Flush(self) -> None:
+    """Sends the latest status, if it wasn't sent yet."""
+    await self._SendPending()
+
+  def _ScheduledSend(self) -> None:
+    self._flush_handle = None
+    self._sending = asyncio.create_task(self._SendPending())
+
+  async def _SendPending(self) -> None:
+    if self._flush_handle is not None:
+      self._flush_handle.cancel()
+      self._flush_handle = None
+    # Statuses are sent in order.
+    sending, self._sending = self._sending, None
+    if sending is not None and sending is not asyncio.current_task():
+      await sending
+
+    status, self._pending = self._pending, None
+    if status is None:
+      return
+
+    now = self._loop.time()
+    self._last_sent = now
+    await self._send(self._WithThroughput(status, now))
+
+  def _WithThroughput(self, status: Status, now: float) -> Status:
+    items_per_second = bytes_per_second = eta = None
+    if status.items_done is not None:
+      items_per_second = self._items.Update(now, status.items_done)
+    if status.bytes_done is not None:
+      bytes_per_second = self._bytes.Update(now, status.bytes_done)
+
+    # Bytes make for a better estimate when items vary in size.
+    if status.bytes_total is not None and status.bytes_done is not None and bytes_per_second:
+      eta = (status.bytes_total - status.bytes_done) / bytes_per_second
+    elif status.items_total is not None and status.items_done is not None and items_per_second:
+      eta = (status.items_total - status.items_done) / items_per_second
+
+    return dataclasses.replace(status,
+                               items_per_second=items_per_second,
+                               bytes_per_second=bytes_per_second,
+                               eta=eta)
+
 
 class LongOperationRunner:
 
-  def __init__(self, communicator: Communicator):
+  def __init__(self, communicator: Communicator, status_interval: float = DEFAULT_STATUS_INTERVAL):
     self._communicator = communicator
+    self._status_interval = status_interval
     self._in_progress: Dict[str, LongOperation] = {}
+    # Tasks running the operations, and operations that were asked to stop.
+    self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+    self._cancelled: Set[str] = set()
 
   async def _RunLongOperation(self, operation: LongOperation):
     await self._communicator.SendWebSocketData({
         "action": "LONG_OPERATION_START",
-        "loid": operation.operation_id
+        "loid": operation.operation_id,
+        "cancellable": operation.cancellable,
     })
 
     async def LogCallback(log: LogMessage):
@@ -26,7 +139,7 @@ class LongOperationRunner:
           "log": log.ToJSON(),
       })
 
-    async def StatusCallback(status: Status):
+    async def SendStatus(status: Status):
       logging.debug("[LongOperationRunner] loid: %s, status: %s, progress: %.2f",
                     operation.operation_id, status.status, status.progress)
       await self._communicator.SendWebSocketData({
@@ -35,13 +148,28 @@ class LongOperationRunner:
           "status": status.ToJSON(),
       })
 
+    status_throttle = _StatusThrottle(SendStatus, self._status_interval)
     try:
-      await operation.Run(status_callback=StatusCallback, log_callback=LogCallback)
+      task = self._tasks[operation.operation_id] = asyncio.create_task(
+          operation.Run(status_callback=status_throttle.Report, log_callback=LogCallback))
+      try:
+        await task
+      finally:
+        del self._tasks[operation.operation_id]
+        await status_throttle.Flush()
 
       await self._communicator.SendWebSocketData({
           "action": "LONG_OPERATION_SUCCESS",
           "loid": operation.operation_id,
       })
+    except asyncio.CancelledError:
+      if operation.operation_id not in self._cancelled:
+        raise
+      logging.info("Long running operation %s was cancelled", operation)
+      await self._communicator.SendWebSocketData({
+          "action": "LONG_OPERATION_CANCELLED",
+          "loid": operation.operation_id,
+      })
     except Exception as e:
       logging.exception("Exception during long running operation %s: %s", operation, e)
       await self._communicator.SendWebSocketData({
@@ -53,6 +181,23 @@ class LongOperationRunner:
   async def RunLongOperation(self, operation: LongOperation):
     self._in_progress[operation.operation_id] = operation
     try:
-      await self._RunLongOperation(operation)
+      with scheduler.RunAs(operation.operation_id, operation.priority):
+        await self._RunLongOperation(operation)
     finally:
-      del self._in_progress[operation.operation_id]
\ No newline at end of file
+      del self._in_progress[operation.operation_id]
+      self._cancelled.discard(operation.operation_id)
+
+  def CancelLongOperation(self, operation_id: str) -> bool:
+    """Stops the operation, returns False if there's no such operation running.
+
+    Raises NotCancellableError if the operation can't be stopped midway.
+    """
+    task = self._tasks.get(operation_id)
+    if task is None:
+      return False
+    if not self._in_progress[operation_id].cancellable:
+      raise NotCancellableError(operation_id)
+
+    self._cancelled.add(operation_id)
+    task.cancel()
+    return True
@@ -0,0 +1,111 @@
+import asyncio
+from typing import Any, List, Union
+
+import pytest
+
+from newmedia import communicator
+from newmedia.long_operation import LogCallback, LongOperation, Status, StatusCallback
+from newmedia.long_operation_runner import LongOperationRunner, NotCancellableError
+from newmedia.utils.json_type import JSON, ToJSONProtocol
+
+
+class _RecordingCommunicator(communicator.CommunicatorStub):
+
+  def __init__(self):
+    self.sent: List[Any] = []
+
+  async def SendWebSocketData(self, data: Union[JSON, ToJSONProtocol]):
+    self.sent.append(data)
+
+
+class _CountingOperation(LongOperation):
+
+  def __init__(self, count: int, delay: float):
+    super().__init__()
+    self.count = count
+    self.delay = delay
+
+  async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
+    for i in range(1, self.count + 1):
+      await asyncio.sleep(self.delay)
+      await status_callback(
+          Status(f"Item {i}",
+                 i / self.count * 100,
+                 items_done=i,
+                 items_total=self.count,
+                 bytes_done=i * 1000,
+                 bytes_total=self.count * 1000))
+
+
+class _CancellableCountingOperation(_CountingOperation):
+  cancellable = True
+
+
+@pytest.mark.asyncio
+async def test_StatusesAreThrottledAndTheLastOneIsDelivered():
+  c = _RecordingCommunicator()
+  runner = LongOperationRunner(c, status_interval=0.05)
+
+  await runner.RunLongOperation(_CountingOperation(100, 0.002))
+
+  actions = [m["action"] for m in c.sent]
+  assert actions[0] == "LONG_OPERATION_START"
+  assert actions[-1] == "LONG_OPERATION_SUCCESS"
+  statuses = [m["status"] for m in c.sent if m["action"] == "LONG_OPERATION_STATUS"]
+  assert 1 < len(statuses) < 20
+  assert statuses[-1]["status"] == "Item 100"
+  assert statuses[-1]["eta"] == 0
+
+  # Roughly 500 items/s: not exact, as sleep() can take longer.
+  assert 50 < statuses[-2]["items_per_second"] < 1000
+  assert statuses[-2]["bytes_per_second"] == pytest.approx(statuses[-2]["items_per_second"] * 1000)
+  assert statuses[-2]["eta"] > 0
+
+
+@pytest.mark.asyncio
+async def test_UnthrottledStatusesAreAllDelivered():
+  c = _RecordingCommunicator()
+  runner = LongOperationRunner(c, status_interval=0)
+
+  await runner.RunLongOperation(_CountingOperation(10, 0))
+
+  statuses = [m["status"]["status"] for m in c.sent if m["action"] == "LONG_OPERATION_STATUS"]
+  assert statuses == [f"Item {i}" for i in range(1, 11)]
+
+
+@pytest.mark.asyncio
+async def test_CancelledOperationIsStopped():
+  c = _RecordingCommunicator()
+  runner = LongOperationRunner(c, status_interval=0)
+  operation = _CancellableCountingOperation(1000, 0.01)
+
+  run = asyncio.create_task(runner.RunLongOperation(operation))
+  await asyncio.sleep(0.05)
+  assert runner.CancelLongOperation(operation.operation_id)
+  await run
+
+  actions = [m["action"] for m in c.sent]
+  assert actions[0] == "LONG_OPERATION_START"
+  assert actions[-1] == "LONG_OPERATION_CANCELLED"
+  assert 1 < actions.count("LONG_OPERATION_STATUS") < 1000
+  assert not runner.CancelLongOperation(operation.operation_id)
+
+
+@pytest.mark.asyncio
+async def test_OperationsAreOnlyCancelledIfCancellable():
+  c = _RecordingCommunicator()
+  runner = LongOperationRunner(c, status_interval=0)
+  operation = _CountingOperation(10, 0.01)
+
+  run = asyncio.create_task(runner.RunLongOperation(operation))
+  await asyncio.sleep(0.05)
+  with pytest.raises(NotCancellableError):
+    runner.CancelLongOperation(operation.operation_id)
+  await run
+
+  assert c.sent[0] == {
+      "action": "LONG_OPERATION_START",
+      "loid": operation.operation_id,
+      "cancellable": False,
+  }
+  assert c.sent[-1]["action"] == "LONG_OPERATION_SUCCESS"
@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from typing import Tuple
+
+from newmedia import scheduler
+from newmedia import store
+from newmedia.communicator import Communicator
+from newmedia.long_operation import LogCallback, LogMessage, LongOperation, Status, StatusCallback
+
+
+def _FormatSize(size: int) -> str:
+  if size < 1024:
+    return f"{size} bytes"
+
+  value = float(size)
+  for unit in ("KiB", "MiB"):
+    value /= 1024
+    if value < 1024:
+      return f"{value:.1f} {unit}"
+  return f"{value / 1024:.1f} GiB"
+
+
+class CompactCatalogOperation(LongOperation):
+  """Prunes orphaned previews (and optionally removed files) from the catalog, then vacuums it."""
+
+  def __init__(self, prune_missing_files: bool, communicator: Communicator):
+    super().__init__()
+    self.prune_missing_files = prune_missing_files
+    self.communicator = communicator
+
+  async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
+    logging.info("Compacting the catalog")
+
+    q: "asyncio.Queue[Tuple[str, float]]" = asyncio.Queue()
+    async with scheduler.SCHEDULER.Acquire(scheduler.Resource.DB_WRITE):
+      compact_task = asyncio.create_task(
+          store.DATA_STORE.CompactCatalog(self.prune_missing_files,
+                                          progress=lambda status, p: q.put_nowait((status, p))))
+
+      while True:
+        get_task = asyncio.create_task(q.get())
+        done, _ = await asyncio.wait([compact_task, get_task],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if compact_task in done:
+          get_task.cancel()
+          break
+        else:
+          status, progress = get_task.result()
+          await status_callback(Status(status, progress))
+
+      result = compact_task.result()
+    if result.removed_uids:
+      await self.communicator.SendWebSocketData({
+          "action": "FILES_REMOVED",
+          "uids": result.removed_uids,
+      })
+
+    await log_callback(
+        LogMessage(
+            LogMessage.Kind.LOG,
+            f"Pruned {result.pruned_previews} previews and {len(result.removed_uids)} removed "
+            f"files, reclaimed {_FormatSize(result.bytes_reclaimed)} "
+            f"({_FormatSize(result.size_before)} -> {_FormatSize(result.size_after)}) "
+            f"in {result.elapsed:.1f}s"))
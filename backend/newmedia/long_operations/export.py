@@ -1,12 +1,169 @@
+import asyncio
+import collections
+import concurrent.futures
+import errno
 import logging
+import os
 import pathlib
 import shutil
+import sys
+import threading
+from typing import BinaryIO, Callable, Collection, Deque, List, Optional, Tuple
 
-from typing import Collection
-from newmedia.long_operation import LogCallback, LongOperation, Status, StatusCallback
+from newmedia import image_processor
+from newmedia import scheduler
+from newmedia import store
+from newmedia import store_metadata
+from newmedia.long_operation import LogCallback, LogMessage, LongOperation, Status, StatusCallback
+
+if sys.platform.startswith("linux"):
+  import fcntl
+else:
+  fcntl = None
+
+# Files are copied in parallel, off the event loop.
+_PARALLEL_COPIES = scheduler.DEFAULT_LIMITS[scheduler.Resource.DISK_IO]
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=_PARALLEL_COPIES,
+                                                  thread_name_prefix="export")
+
+# Bytes copied at a time: copies are cancelled in between.
+_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Progress is reported this often (in seconds).
+_STATUS_INTERVAL = 0.1
+
+# Makes the destination share the source's data (copy-on-write), from linux/fs.h.
+_FICLONE = 0x40049409
+
+# A copy method returns the number of bytes copied, 0 at the end of the source.
+_CopyMethod = Callable[[int, int, int], int]
+
+
+class _CopyCancelledError(Exception):
+  pass
+
+
+def _CopyFileRange(src_fd: int, dest_fd: int, count: int) -> int:
+  return os.copy_file_range(src_fd, dest_fd, count)
+
+
+def _SendFile(src_fd: int, dest_fd: int, count: int) -> int:
+  return os.sendfile(dest_fd, src_fd, None, count)
+
+
+def _CopyMethods() -> List[_CopyMethod]:
+  """Returns kernel-assisted copy methods available on the platform."""
+  methods: List[_CopyMethod] = []
+  if hasattr(os, "copy_file_range"):
+    methods.append(_CopyFileRange)
+  # Only Linux can sendfile() to a regular file.
+  if fcntl is not None and hasattr(os, "sendfile"):
+    methods.append(_SendFile)
+  return methods
+
+
+def _Reflink(src: BinaryIO, dest: BinaryIO) -> bool:
+  if fcntl is None or os.fstat(src.fileno()).st_dev != os.fstat(dest.fileno()).st_dev:
+    return False
+
+  try:
+    fcntl.ioctl(dest.fileno(), _FICLONE, src.fileno())
+  except OSError:
+    # Not supported by the filesystem.
+    return False
+  return True
+
+
+class _FileCopy:
+  """Copies a file (in a worker thread), keeping track of bytes copied."""
+
+  def __init__(self, src: pathlib.Path, dest: pathlib.Path, size: int):
+    self.src = src
+    self.dest = dest
+    self.size = size
+    self.bytes_done = 0
+
+  def Run(self, cancelled: threading.Event) -> None:
+    try:
+      with open(self.src, "rb") as src, open(self.dest, "wb") as dest:
+        if _Reflink(src, dest):
+          self.bytes_done = os.fstat(src.fileno()).st_size
+        else:
+          self._Copy(src, dest, cancelled)
+      shutil.copymode(self.src, self.dest)
+    except BaseException:
+      # No partially copied files are left behind.
+      try:
+        os.remove(self.dest)
+      except OSError:
+        pass
+      raise
+
+  def _Copy(self, src: BinaryIO, dest: BinaryIO, cancelled: threading.Event) -> None:
+    methods = _CopyMethods()
+    while True:
+      if cancelled.is_set():
+        raise _CopyCancelledError()
+
+      while methods:
+        try:
+          copied = methods[0](src.fileno(), dest.fileno(), _CHUNK_SIZE)
+          break
+        except OSError as e:
+          # The method isn't supported for these files (e.g. copying across
+          # filesystems on older kernels): the next one is tried.
+          if self.bytes_done or e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                                                errno.EOPNOTSUPP, errno.ENOTSUP):
+            raise
+          methods.pop(0)
+      else:
+        chunk = src.read(_CHUNK_SIZE)
+        dest.write(chunk)
+        copied = len(chunk)
+
+      if not copied:
+        return
+      self.bytes_done += copied
+
+
+def _DestPaths(srcs: Collection[str],
+               dest: str,
+               prefix_with_index: bool,
+               extension: Optional[str] = None) -> List[pathlib.Path]:
+  """Returns paths the sources are exported to, optionally with a different extension."""
+  number_length = max(2, len(str(len(srcs))))
+  dest_path = pathlib.Path(dest)
+
+  result = []
+  for index, src in enumerate(srcs):
+    src_path = pathlib.Path(src)
+    dest_name = src_path.name if extension is None else src_path.stem + extension
+
+    if prefix_with_index:
+      dest_name = f"{str(index).zfill(number_length)}_{dest_name}"
+
+    result.append(dest_path / dest_name)
+  return result
+
+
+def _Adjustments(row: Optional[store_metadata.MetadataRow]) -> image_processor.Adjustments:
+  if row is None:
+    return image_processor.Adjustments()
+  _, _, rotation, horizontal_flip, vertical_flip = row
+  return image_processor.Adjustments(rotation, bool(horizontal_flip), bool(vertical_flip))
+
+
+def _FileSize(path: str) -> int:
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
 
 
 class ExportToPathOperation(LongOperation):
+  """Copies files to a folder, in parallel and cancellably, reporting bytes copied."""
+
+  cancellable = True
 
   def __init__(self, srcs: Collection[str], dest: str, prefix_with_index: bool):
     super().__init__()
@@ -14,18 +171,138 @@ class ExportToPathOperation(LongOperation):
     self.dest = dest
     self.prefix_with_index = prefix_with_index
 
+  def _Copies(self) -> List[_FileCopy]:
+    dest_paths = _DestPaths(self.srcs, self.dest, self.prefix_with_index)
+    return [
+        _FileCopy(pathlib.Path(src), dest_path, _FileSize(src))
+        for src, dest_path in zip(self.srcs, dest_paths)
+    ]
+
+  async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
+    copies = self._Copies()
+    bytes_total = sum(c.size for c in copies)
+    num_done = 0
+
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    queue: Deque[_FileCopy] = collections.deque(copies)
+    running: List["asyncio.Future[None]"] = []
+
+    async def Worker():
+      nonlocal num_done
+      while queue:
+        c = queue.popleft()
+        async with scheduler.SCHEDULER.Acquire(scheduler.Resource.DISK_IO):
+          logging.info("Copying %s -> %s", c.src, c.dest)
+          future = loop.run_in_executor(_EXECUTOR, c.Run, cancelled)
+          running.append(future)
+          # Cancelling the worker doesn't stop the copy: it's waited for below.
+          await asyncio.shield(future)
+        num_done += 1
+
+    async def ReportStatus(current: Optional[_FileCopy]):
+      bytes_done = sum(c.bytes_done for c in copies)
+      name = f" {current.dest.name}" if current is not None else ""
+      await status_callback(
+          Status(f"Exporting{name}",
+                 float(bytes_done) / (bytes_total or 1) * 100,
+                 items_done=num_done,
+                 items_total=len(copies),
+                 bytes_done=bytes_done,
+                 bytes_total=bytes_total))
+
+    workers = [asyncio.create_task(Worker()) for _ in range(min(_PARALLEL_COPIES, len(copies)))]
+    try:
+      pending = set(workers)
+      while pending:
+        done, pending = await asyncio.wait(pending,
+                                           timeout=_STATUS_INTERVAL,
+                                           return_when=asyncio.FIRST_EXCEPTION)
+        for w in done:
+          # Fails the export on the first failed copy.
+          w.result()
+        in_flight = [c for c in copies if 0 < c.bytes_done < c.size]
+        await ReportStatus(in_flight[-1] if in_flight else None)
+    finally:
+      cancelled.set()
+      for w in workers:
+        w.cancel()
+      await asyncio.gather(*workers, *running, return_exceptions=True)
+
+
+class ExportRenditionsOperation(LongOperation):
+  """Renders resized JPEG/WebP renditions of images into a folder.
+
+  Renditions are rendered in parallel by the image processor's worker
+  processes, holding CPU_DECODE slots like other decoding. They're rotated
+  and flipped as in the catalog. Images that fail to render are logged and
+  skipped.
+  """
+
+  cancellable = True
+
+  def __init__(self, srcs: Collection[str], dest: str, prefix_with_index: bool,
+               options: image_processor.RenditionOptions):
+    super().__init__()
+    self.srcs = srcs
+    self.dest = dest
+    self.prefix_with_index = prefix_with_index
+    self.options = options
+
   async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
-    number_length = max(2, len(str(len(self.srcs))))
+    srcs = list(self.srcs)
+    dest_paths = _DestPaths(srcs, self.dest, self.prefix_with_index, self.options.extension)
+    # Progress is measured in bytes of the originals, as decoding takes most
+    # of the time.
+    sizes = [_FileSize(src) for src in srcs]
+    metadata = await store.DATA_STORE.ReadMetadataByPath(srcs)
+    bytes_total = sum(sizes)
+    bytes_done = 0
+    num_done = 0
+
+    queue: Deque[int] = collections.deque(range(len(srcs)))
+    # Renditions are rendered into temporary files, renamed once complete.
+    running: List[Tuple["asyncio.Future[int]", pathlib.Path]] = []
 
-    dest_path = pathlib.Path(self.dest)
-    for index, src in enumerate(self.srcs):
-      src_path = pathlib.Path(src)
-      dest_name = src_path.name
+    async def Worker():
+      nonlocal bytes_done, num_done
+      while queue:
+        index = queue.popleft()
+        src, dest_path = srcs[index], dest_paths[index]
+        part_path = dest_path.with_name(f".{dest_path.name}.part")
 
-      if self.prefix_with_index:
-        dest_name = f"{str(index).zfill(number_length)}_{dest_name}"
+        try:
+          async with scheduler.SCHEDULER.Acquire(scheduler.Resource.CPU_DECODE):
+            future = asyncio.ensure_future(
+                image_processor.IMAGE_PROCESSOR.RenderRendition(src, str(part_path), self.options,
+                                                                _Adjustments(metadata.get(src))))
+            running.append((future, part_path))
+            # Cancelling the worker doesn't stop the rendering: it's waited for below.
+            await asyncio.shield(future)
+          os.replace(part_path, dest_path)
+        except image_processor.ImageProcessingError as e:
+          await log_callback(LogMessage(LogMessage.Kind.ERROR, f"Failed rendering {src}: {e}"))
 
-      logging.info("Copying %s -> %s/%s", src_path, dest_path, dest_name)
-      shutil.copy(src_path, dest_path / dest_name, follow_symlinks=True)
+        bytes_done += sizes[index]
+        num_done += 1
+        await status_callback(
+            Status(f"Exporting {dest_path.name}",
+                   float(bytes_done) / (bytes_total or 1) * 100,
+                   items_done=num_done,
+                   items_total=len(srcs),
+                   bytes_done=bytes_done,
+                   bytes_total=bytes_total))
 
-      await status_callback(Status(f"Exporting {dest_name}", float(index) / len(self.srcs)))
+    num_workers = min(image_processor.IMAGE_PROCESSOR.rendition_workers, len(srcs))
+    workers = [asyncio.create_task(Worker()) for _ in range(num_workers)]
+    try:
+      await asyncio.gather(*workers)
+    finally:
+      for w in workers:
+        w.cancel()
+      await asyncio.gather(*workers, *(f for f, _ in running), return_exceptions=True)
+      for _, part_path in running:
+        try:
+          os.remove(part_path)
+        except OSError:
+          pass
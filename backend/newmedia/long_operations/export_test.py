@@ -0,0 +1,176 @@
+import asyncio
+import os
+import pathlib
+import time
+from typing import List
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from newmedia import backend_state
+from newmedia import communicator
+from newmedia import image_processor
+from newmedia import store
+from newmedia import store_metadata
+from newmedia.long_operation import LogMessage, Status
+from newmedia.long_operations import export
+
+
+def _MakeFiles(path: pathlib.Path, count: int, size: int) -> List[str]:
+  srcs = []
+  for i in range(count):
+    src = path / f"{i}.raw"
+    src.write_bytes(os.urandom(size))
+    srcs.append(str(src))
+  return srcs
+
+
+async def _IgnoreLog(log: LogMessage):
+  pass
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("reflink", [True, False])
+async def test_FilesAreCopiedWithIndexPrefix(tmp_path: pathlib.Path, reflink: bool):
+  (tmp_path / "src").mkdir()
+  (tmp_path / "dest").mkdir()
+  srcs = _MakeFiles(tmp_path / "src", 12, 100 * 1024)
+  statuses: List[Status] = []
+
+  async def StatusCallback(status: Status):
+    statuses.append(status)
+
+  with mock.patch.object(export, "_CHUNK_SIZE", 16 * 1024):
+    with mock.patch.object(export, "_Reflink", export._Reflink if reflink else lambda s, d: False):
+      await export.ExportToPathOperation(srcs, str(tmp_path / "dest"),
+                                         prefix_with_index=True).Run(StatusCallback, _IgnoreLog)
+
+  for i, src in enumerate(srcs):
+    dest = tmp_path / "dest" / f"{i:02d}_{i}.raw"
+    assert dest.read_bytes() == pathlib.Path(src).read_bytes()
+  assert statuses[-1].items_done == 12
+  assert statuses[-1].bytes_done == statuses[-1].bytes_total == 12 * 100 * 1024
+
+
+@pytest.mark.asyncio
+async def test_CancelledExportLeavesNoPartialFiles(tmp_path: pathlib.Path):
+  (tmp_path / "src").mkdir()
+  (tmp_path / "dest").mkdir()
+  srcs = _MakeFiles(tmp_path / "src", 8, 1024 * 1024)
+
+  def SlowCopy(src_fd: int, dest_fd: int, count: int) -> int:
+    time.sleep(0.001)
+    return os.write(dest_fd, os.read(src_fd, count))
+
+  async def CancelOnProgress(status: Status):
+    if status.bytes_done:
+      asyncio.current_task().cancel()
+
+  with mock.patch.object(export, "_CHUNK_SIZE", 16 * 1024), mock.patch.object(
+      export, "_Reflink", lambda s, d: False), mock.patch.object(export, "_CopyMethods",
+                                                                 lambda: [SlowCopy]):
+    with pytest.raises(asyncio.CancelledError):
+      await export.ExportToPathOperation(srcs, str(tmp_path / "dest"),
+                                         prefix_with_index=False).Run(CancelOnProgress, _IgnoreLog)
+
+  copied = sorted(os.listdir(tmp_path / "dest"))
+  assert len(copied) < len(srcs)
+  for name in copied:
+    assert (tmp_path / "dest" / name).read_bytes() == (tmp_path / "src" / name).read_bytes()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_RenditionsAreRenderedAndFailuresSkipped(tmp_path: pathlib.Path):
+  (tmp_path / "src").mkdir()
+  (tmp_path / "dest").mkdir()
+  srcs = []
+  for i in range(3):
+    src = tmp_path / "src" / f"{i}.jpg"
+    Image.effect_noise((1200, 900), 64).convert("RGB").save(src)
+    srcs.append(str(src))
+  (tmp_path / "src" / "1.jpg").write_bytes(b"garbage")
+
+  logs: List[LogMessage] = []
+  statuses: List[Status] = []
+
+  async def StatusCallback(status: Status):
+    statuses.append(status)
+
+  async def LogCallback(log: LogMessage):
+    logs.append(log)
+
+  processor = image_processor.ImageProcessor(rendition_workers=2)
+  db = store.DataStore()
+  try:
+    with mock.patch.object(image_processor, "IMAGE_PROCESSOR", processor, create=True), \
+         mock.patch.object(store, "DATA_STORE", db, create=True):
+      await export.ExportRenditionsOperation(
+          srcs, str(tmp_path / "dest"), True,
+          image_processor.RenditionOptions(format=image_processor.WEBP_RENDITION,
+                                           max_size=400)).Run(StatusCallback, LogCallback)
+  finally:
+    processor.Shutdown()
+    await db.Close()
+
+  assert sorted(os.listdir(tmp_path / "dest")) == ["00_0.webp", "02_2.webp"]
+  with Image.open(tmp_path / "dest" / "02_2.webp") as im:
+    assert (im.format, im.size) == ("WEBP", (400, 300))
+  assert [l.kind for l in logs] == [LogMessage.Kind.ERROR]
+  assert statuses[-1].items_done == 3
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_RenditionsAreOrientedAndAdjusted(tmp_path: pathlib.Path):
+  (tmp_path / "src").mkdir()
+  (tmp_path / "dest").mkdir()
+  # Red on the left, blue on the right, displayed rotated by 90 degrees
+  # clockwise (EXIF orientation 6): red on top.
+  im = Image.new("RGB", (1200, 900), "blue")
+  im.paste("red", (0, 0, 600, 900))
+  exif = Image.Exif()
+  exif[0x0112] = 6
+  srcs = []
+  for name in ("exif.jpg", "exif_and_catalog.jpg"):
+    im.save(tmp_path / "src" / name, exif=exif)
+    srcs.append(str(tmp_path / "src" / name))
+
+  async def IgnoreStatus(status: Status):
+    pass
+
+  processor = image_processor.ImageProcessor(rendition_workers=1)
+  db = store.DataStore()
+  try:
+    with mock.patch.object(image_processor, "IMAGE_PROCESSOR", processor, create=True), \
+         mock.patch.object(store, "DATA_STORE", db, create=True):
+      image_file = await db.RegisterFile(pathlib.Path(srcs[1]))
+      # Rotated by another 90 degrees clockwise in the catalog: red on the right.
+      await db.UpdateImageMetadata(store_metadata.MetadataUpdate(uids=[image_file.uid], rotation=90))
+
+      await export.ExportRenditionsOperation(srcs, str(tmp_path / "dest"), False,
+                                             image_processor.RenditionOptions(max_size=400)).Run(
+                                                 IgnoreStatus, _IgnoreLog)
+  finally:
+    processor.Shutdown()
+    await db.Close()
+
+  with Image.open(tmp_path / "dest" / "exif.jpg") as rendition:
+    assert rendition.size == (300, 400)
+    assert rendition.getexif().get(0x0112) is None
+    red, _, blue = rendition.getpixel((150, 50))
+    assert red > 200 and blue < 50
+
+  with Image.open(tmp_path / "dest" / "exif_and_catalog.jpg") as rendition:
+    assert rendition.size == (400, 300)
+    red, _, blue = rendition.getpixel((350, 150))
+    assert red > 200 and blue < 50
@@ -0,0 +1,32 @@
+import asyncio
+import logging
+from typing import Tuple
+
+from newmedia import scheduler
+from newmedia import store
+from newmedia.long_operation import LogCallback, LongOperation, Status, StatusCallback
+
+
+class OpenCatalogOperation(LongOperation):
+  """Opens the catalog, reporting progress of its migrations (if any)."""
+
+  # The user waits for it to finish.
+  priority = scheduler.Priority.INTERACTIVE
+
+  async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
+    logging.info("Opening the catalog")
+
+    q: "asyncio.Queue[Tuple[int, float]]" = asyncio.Queue()
+    open_task = asyncio.create_task(
+        store.DATA_STORE.Open(progress=lambda version, p: q.put_nowait((version, p))))
+
+    while True:
+      get_task = asyncio.create_task(q.get())
+      done, _ = await asyncio.wait([open_task, get_task], return_when=asyncio.FIRST_COMPLETED)
+      if open_task in done:
+        get_task.cancel()
+        open_task.result()
+        return
+      else:
+        version, progress = get_task.result()
+        await status_callback(Status(f"Upgrading catalog (version {version})", progress))
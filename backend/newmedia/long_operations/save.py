@@ -1,6 +1,8 @@
 import asyncio
 import logging
+from typing import Optional
 
+from newmedia import scheduler
 from newmedia import store
 from newmedia.long_operation import LogCallback, LongOperation, Status, StatusCallback
 from newmedia.utils.json_type import JSON
@@ -8,7 +10,10 @@ from newmedia.utils.json_type import JSON
 
 class SaveOperation(LongOperation):
 
-  def __init__(self, state: JSON, path: str):
+  # The user waits for it to finish.
+  priority = scheduler.Priority.INTERACTIVE
+
+  def __init__(self, state: Optional[JSON], path: str):
     super().__init__()
     self.state = state
     self.path = path
@@ -21,17 +26,21 @@ class SaveOperation(LongOperation):
     async def Progress(p: float):
       await q.put(p)
 
+    # Replacing the state takes the DB_WRITE slot itself, after the lock
+    # serializing state replacements (as streamed saves do).
+    if self.state is not None:
+      await store.DATA_STORE.ReplaceStateFromJSON(self.state)
+
     loop = asyncio.get_running_loop()
-    save_task = asyncio.create_task(
-        store.DATA_STORE.SaveStore(
-            self.path,
-            self.state,
-            progress=lambda p: asyncio.run_coroutine_threadsafe(Progress(p), loop)))
-
-    while True:
-      get_task = asyncio.create_task(q.get())
-      done, _ = await asyncio.wait([save_task, get_task], return_when=asyncio.FIRST_COMPLETED)
-      if save_task in done:
-        return
-      else:
-        await status_callback(Status("Saving", get_task.result()))
+    async with scheduler.SCHEDULER.Acquire(scheduler.Resource.DB_WRITE):
+      save_task = asyncio.create_task(
+          store.DATA_STORE.SaveStore(
+              self.path, progress=lambda p: asyncio.run_coroutine_threadsafe(Progress(p), loop)))
+
+      while True:
+        get_task = asyncio.create_task(q.get())
+        done, _ = await asyncio.wait([save_task, get_task], return_when=asyncio.FIRST_COMPLETED)
+        if save_task in done:
+          return
+        else:
+          await status_callback(Status("Saving", get_task.result()))
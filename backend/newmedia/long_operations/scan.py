@@ -8,29 +8,11 @@ from typing import Iterable, Set
 from asyncio.futures import Future
 from newmedia.communicator import Communicator
 from newmedia.long_operation import LogCallback, LongOperation, Status, StatusCallback
-from newmedia import backend_state
 from newmedia import image_processor
 from newmedia import store
+from newmedia import store_jobs
 from newmedia import store_schema
-
-
-async def ThumbnailFile(image_file: store_schema.ImageFile, communicator: Communicator):
-  # TODO: improve the logic to correctly process RAW files with existing thumbnails.
-  # We might want to rerender them sometimes.
-  if image_file.previews:
-    return
-
-  await backend_state.BACKEND_STATE.ChangePreviewQueueSize(1)
-
-  try:
-    thumbnail_file = await store.DATA_STORE.UpdateFileThumbnail(image_file.uid)
-  finally:
-    await backend_state.BACKEND_STATE.ChangePreviewQueueSize(-1)
-
-  await communicator.SendWebSocketData({
-      "action": "THUMBNAIL_UPDATED",
-      "image": thumbnail_file.ToJSON(),
-  })
+from newmedia.long_operations import thumbnail_jobs
 
 
 async def ScanFilesBatch(paths: Iterable[str], communicator: Communicator) -> Iterable[Task]:
@@ -40,6 +22,19 @@ async def ScanFilesBatch(paths: Iterable[str], communicator: Communicator) -> It
 
   coros = (store.DATA_STORE.RegisterFile(pathlib.Path(p)) for p in paths)
   results = await asyncio.gather(*coros, return_exceptions=True)
+
+  # Jobs are persisted before they're run, so that the ones still pending
+  # when the app is closed are run on the next start.
+  # TODO: improve the logic to correctly process RAW files with existing thumbnails.
+  # We might want to rerender them sometimes.
+  jobs = {
+      r.uid: store_jobs.ThumbnailJob(r.uid)
+      for r in results
+      if isinstance(r, store_schema.ImageFile) and not r.previews
+  }
+  if jobs:
+    await store.DATA_STORE.WriteThumbnailJobs(list(jobs.values()))
+
   tasks = []
   for p, r in zip(paths, results):
     if isinstance(r, Exception):
@@ -54,7 +49,11 @@ async def ScanFilesBatch(paths: Iterable[str], communicator: Communicator) -> It
           "action": "FILE_REGISTERED",
           "image": r.ToJSON(),
       })
-      tasks.append(asyncio.create_task(ThumbnailFile(r, communicator)))
+      job = jobs.get(r.uid)
+      if job is None:
+        tasks.append(asyncio.create_task(DoNothing()))
+      else:
+        tasks.append(asyncio.create_task(thumbnail_jobs.RunThumbnailJob(job, communicator)))
     else:
       raise AssertionError("This else branch shouldn't have been reached.")
 
@@ -90,7 +89,11 @@ class ScanPathsOperation(LongOperation):
     for i in range(0, len(paths), batch_size):
       chunk = paths[i:i + batch_size]
 
-      await status_callback(Status(f"Processing {chunk[0]}", float(i) / len(paths_to_process) * 50))
+      await status_callback(
+          Status(f"Processing {chunk[0]}",
+                 float(i) / len(paths_to_process) * 50,
+                 items_done=i,
+                 items_total=len(paths_to_process)))
       new_tasks = await ScanFilesBatch(chunk, self.communicator)
       preview_tasks.update(new_tasks)
 
@@ -100,7 +103,9 @@ class ScanPathsOperation(LongOperation):
     while True:
       await status_callback(
           Status(f"Thumbnail {num_done_tasks} out of {num_preview_tasks}",
-                 float(num_done_tasks) / num_preview_tasks * 50 + 50))
+                 float(num_done_tasks) / num_preview_tasks * 50 + 50,
+                 items_done=num_done_tasks,
+                 items_total=num_preview_tasks))
 
       done, pending = await asyncio.wait(preview_tasks, return_when=asyncio.FIRST_COMPLETED)
       num_done_tasks += len(done)
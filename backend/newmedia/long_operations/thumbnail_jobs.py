@@ -0,0 +1,115 @@
+import asyncio
+import dataclasses
+import logging
+import time
+from typing import Dict, List, Optional
+
+from newmedia import backend_state
+from newmedia import store
+from newmedia import store_jobs
+from newmedia.communicator import Communicator
+from newmedia.long_operation import LogCallback, LogMessage, LongOperation, Status, StatusCallback
+
+# Number of jobs run at a time. Rendering itself is limited by the scheduler.
+_BATCH_SIZE = 32
+
+# Jobs being run by this process, by uid.
+_RUNNING: Dict[str, "asyncio.Future[store_jobs.ThumbnailJob]"] = {}
+
+
+async def _RunThumbnailJob(job: store_jobs.ThumbnailJob,
+                           communicator: Communicator) -> store_jobs.ThumbnailJob:
+  # An interrupted job is still pending. A successful one is deleted along
+  # with writing the thumbnail.
+  await backend_state.BACKEND_STATE.ChangePreviewQueueSize(1)
+  try:
+    thumbnail_file = await store.DATA_STORE.UpdateFileThumbnail(job.uid)
+  except Exception as e:
+    logging.error("Failed rendering thumbnail of %s: %s", job.uid, e)
+    result = job.Failed(str(e), int(time.time()))
+    await store.DATA_STORE.WriteThumbnailJobs([result])
+    return result
+  finally:
+    await backend_state.BACKEND_STATE.ChangePreviewQueueSize(-1)
+
+  result = dataclasses.replace(job, state=store_jobs.DONE, error=None)
+  await communicator.SendWebSocketData({
+      "action": "THUMBNAIL_UPDATED",
+      "image": thumbnail_file.ToJSON(),
+  })
+  return result
+
+
+async def RunThumbnailJob(job: store_jobs.ThumbnailJob,
+                          communicator: Communicator) -> store_jobs.ThumbnailJob:
+  """Renders the job's thumbnail, deleting the job or recording its failure in the catalog."""
+  running = _RUNNING.get(job.uid)
+  if running is not None:
+    return await running
+
+  running = _RUNNING[job.uid] = asyncio.ensure_future(_RunThumbnailJob(job, communicator))
+  try:
+    return await running
+  finally:
+    del _RUNNING[job.uid]
+
+
+async def UnfinishedJobs() -> List[store_jobs.ThumbnailJob]:
+  """Returns jobs that are still to be run, including failed ones to be retried."""
+  jobs = await store.DATA_STORE.ReadThumbnailJobs([store_jobs.PENDING, store_jobs.FAILED])
+  return [
+      j for j in jobs if j.state != store_jobs.FAILED or j.attempts < store_jobs.MAX_ATTEMPTS
+  ]
+
+
+def _IsDue(job: store_jobs.ThumbnailJob, now: int) -> bool:
+  return job.state != store_jobs.FAILED or job.next_attempt_at <= now
+
+
+async def NextAttemptDelay() -> Optional[int]:
+  """Returns seconds until an unfinished job is due (0 if one is), None if there are none."""
+  jobs = await UnfinishedJobs()
+  if not jobs:
+    return None
+  now = int(time.time())
+  if any(_IsDue(j, now) for j in jobs):
+    return 0
+  return min(j.next_attempt_at for j in jobs) - now
+
+
+class ThumbnailJobsOperation(LongOperation):
+  """Runs unfinished thumbnail jobs, e.g. the ones left over by an interrupted scan.
+
+  Jobs interrupted by closing the app are still pending. Failed jobs are
+  retried while their backoff has expired. The operation doesn't wait for
+  the others: it's started again once they're due (see NextAttemptDelay).
+  """
+
+  def __init__(self, communicator: Communicator):
+    super().__init__()
+    self.communicator = communicator
+
+  async def Run(self, status_callback: StatusCallback, log_callback: LogCallback) -> None:
+    num_failed = 0
+    while True:
+      now = int(time.time())
+      due = [j for j in await UnfinishedJobs() if _IsDue(j, now)]
+      if not due:
+        break
+
+      for i in range(0, len(due), _BATCH_SIZE):
+        await status_callback(
+            Status(f"Thumbnail {i} out of {len(due)}",
+                   float(i) / len(due) * 100,
+                   items_done=i,
+                   items_total=len(due)))
+        results = await asyncio.gather(
+            *(RunThumbnailJob(j, self.communicator) for j in due[i:i + _BATCH_SIZE]))
+        num_failed += sum(1 for r in results
+                          if r.state == store_jobs.FAILED and r.attempts >= store_jobs.MAX_ATTEMPTS)
+
+    if num_failed:
+      await log_callback(
+          LogMessage(LogMessage.Kind.ERROR,
+                     f"Gave up rendering {num_failed} thumbnails after "
+                     f"{store_jobs.MAX_ATTEMPTS} attempts"))
@@ -2,26 +2,38 @@ import argparse
 import asyncio
 import json
 import logging
+import multiprocessing
 import os
 import pathlib
 import socket
 import sys
 import uuid
-from typing import Awaitable, Callable, Dict, Iterable, List, Union, cast
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Union, cast
 
 import aiojobs.aiohttp
-from aiohttp import web
+from aiohttp import StreamReader, web
 from aiojobs.aiohttp import spawn
 from multidict import istr
 
 from newmedia import backend_state
 from newmedia import image_processor
+from newmedia import preview_cache
+from newmedia import scheduler
 from newmedia import store
+from newmedia import store_metadata
+from newmedia import store_query
+from newmedia import store_state
+from newmedia import ws_codec
 from newmedia.communicator import Communicator, WebSocketCommunicator
-from newmedia.long_operation_runner import LongOperationRunner
-from newmedia.long_operations.export import ExportToPathOperation
+from newmedia.long_operation import LongOperation
+from newmedia.long_operation_runner import DEFAULT_STATUS_INTERVAL, LongOperationRunner, NotCancellableError
+from newmedia.long_operations.compact import CompactCatalogOperation
+from newmedia.long_operations.export import ExportRenditionsOperation, ExportToPathOperation
+from newmedia.long_operations.open_catalog import OpenCatalogOperation
 from newmedia.long_operations.save import SaveOperation
+from newmedia.long_operations import thumbnail_jobs
 from newmedia.long_operations.scan import ScanPathsOperation
+from newmedia.long_operations.thumbnail_jobs import ThumbnailJobsOperation
 from newmedia.utils import macos
 
 
@@ -29,6 +41,32 @@ PARSER = argparse.ArgumentParser(description='Newmedia backend server.')
 PARSER.add_argument("--port", type=int, default=0)
 PARSER.add_argument("--cors-allow-origin", type=str, default="app://.")
 PARSER.add_argument("--db-file", type=pathlib.Path, default=None)
+# Total size of previews kept in the catalog (in bytes), 0 for no limit.
+PARSER.add_argument("--preview-budget", type=int, default=0)
+# Keep rendered previews in a user-level cache shared by all catalogs.
+PARSER.add_argument("--preview-cache", action="store_true", default=False)
+PARSER.add_argument("--preview-cache-dir", type=pathlib.Path, default=None)
+# Total size of the preview cache (in bytes).
+PARSER.add_argument("--preview-cache-budget", type=int, default=preview_cache.DEFAULT_BUDGET)
+# Minimum interval between status updates of a long operation (in seconds).
+PARSER.add_argument("--status-interval", type=float, default=DEFAULT_STATUS_INTERVAL)
+# Worker processes rendering export renditions, and memory (in bytes) each one may use.
+PARSER.add_argument("--rendition-workers",
+                    type=int,
+                    default=image_processor.DEFAULT_RENDITION_WORKERS)
+PARSER.add_argument("--rendition-worker-memory",
+                    type=int,
+                    default=image_processor.DEFAULT_RENDITION_WORKER_MEMORY)
+# Number of concurrent users of each resource (see scheduler.py).
+PARSER.add_argument("--disk-io-slots",
+                    type=int,
+                    default=scheduler.DEFAULT_LIMITS[scheduler.Resource.DISK_IO])
+PARSER.add_argument("--cpu-decode-slots",
+                    type=int,
+                    default=scheduler.DEFAULT_LIMITS[scheduler.Resource.CPU_DECODE])
+PARSER.add_argument("--db-write-slots",
+                    type=int,
+                    default=scheduler.DEFAULT_LIMITS[scheduler.Resource.DB_WRITE])
 
 
 CORS_HEADERS: Dict[Union[str, istr], str] = {
@@ -49,21 +87,125 @@ async def AllowCorsHandler(request: web.Request) -> web.Response:
   return web.Response(headers=CORS_HEADERS)
 
 
-async def SavedStateHandler(request: web.Request) -> web.Response:
-  state = await store.DATA_STORE.GetSavedState()
-  return web.json_response({"state": state}, content_type="application/json", headers=CORS_HEADERS)
+_STATE_CHUNK_LENGTH = 65536
 
 
-async def WebSocketHandler(request: web.Request) -> web.WebSocketResponse:
+async def SavedStateHandler(request: web.Request) -> web.StreamResponse:
+  headers = dict(CORS_HEADERS.items())
+  headers["Content-Type"] = "application/json"
+
+  # The state is produced incrementally from the catalog and sent as
+  # compressed chunks (if the client accepts it).
+  response = web.StreamResponse(headers=headers)
+  response.enable_compression()
+  response.enable_chunked_encoding()
+  await response.prepare(request)
+
+  buf = bytearray()
+  async for piece in store.DATA_STORE.StreamSavedState():
+    buf += piece
+    if len(buf) >= _STATE_CHUNK_LENGTH:
+      await response.write(bytes(buf))
+      buf.clear()
+  await response.write(bytes(buf))
+  await response.write_eof()
+
+  return response
+
+
+async def QueryHandler(request: web.Request) -> web.Response:
+  try:
+    query = store_query.ImageQuery.FromJSON(await request.json())
+  except json.JSONDecodeError as e:
+    return web.Response(status=400, text=f"Invalid JSON: {e}", headers=CORS_HEADERS)
+  except store_query.InvalidQueryError as e:
+    return web.Response(status=400, text=str(e), headers=CORS_HEADERS)
+
+  result = await store.DATA_STORE.QueryImages(query)
+  return web.json_response(result.ToJSON(), content_type="application/json", headers=CORS_HEADERS)
+
+
+async def SearchHandler(request: web.Request) -> web.Response:
+  try:
+    query = store_query.SearchQuery.FromQueryParams(request.query)
+  except store_query.InvalidQueryError as e:
+    return web.Response(status=400, text=str(e), headers=CORS_HEADERS)
+
+  result = await store.DATA_STORE.SearchImages(query)
+  return web.json_response(result.ToJSON(), content_type="application/json", headers=CORS_HEADERS)
+
+
+async def ImageInfosHandler(request: web.Request) -> web.Response:
+  try:
+    data = await request.json()
+  except json.JSONDecodeError as e:
+    return web.Response(status=400, text=f"Invalid JSON: {e}", headers=CORS_HEADERS)
+  uids = data.get("uids") if isinstance(data, dict) else None
+  if not isinstance(uids, list) or not all(isinstance(u, str) for u in uids):
+    return web.Response(status=400, text="Request has no uids", headers=CORS_HEADERS)
+  if len(uids) > store_query.MAX_LIMIT:
+    return web.Response(status=400, text=f"Too many uids: {len(uids)}", headers=CORS_HEADERS)
+
+  images = await store.DATA_STORE.ReadFileInfos(uids)
+  return web.json_response({"images": [i.ToJSON() for i in images]},
+                           content_type="application/json",
+                           headers=CORS_HEADERS)
+
+
+async def UpdateMetadataHandler(request: web.Request) -> web.Response:
+  data = await request.json()
+  try:
+    update = store_metadata.MetadataUpdate.FromJSON(data)
+  except store_metadata.InvalidMetadataUpdateError as e:
+    return web.Response(status=400, text=str(e), headers=CORS_HEADERS)
+
+  updated = await store.DATA_STORE.UpdateImageMetadata(update)
+  return web.json_response({"updated": updated},
+                           content_type="application/json",
+                           headers=CORS_HEADERS)
+
+
+async def WebSocketHandler(request: web.Request) -> web.StreamResponse:
+  # Events are sent as JSON by default, clients may opt into binary
+  # (msgpack) messages with ?format=msgpack.
+  try:
+    codec = ws_codec.CodecForFormat(request.query.get("format", ws_codec.JSON_FORMAT))
+  except ws_codec.UnknownFormatError as e:
+    return web.Response(status=400, text=f"Unknown format: {e}", headers=CORS_HEADERS)
+  # Reconnecting clients pass the sequence number of the last batch they got
+  # to receive the events they missed.
+  since = None
+  if "since" in request.query:
+    try:
+      since = int(request.query["since"])
+    except ValueError:
+      return web.Response(status=400, text="Invalid since", headers=CORS_HEADERS)
+
   ws = web.WebSocketResponse(compress=False)
   await ws.prepare(request)
 
   communicator = cast(Communicator, request.app["communicator"])
-  await communicator.ListenToWebSocket(ws)
+  # The renderer's mirror of the backend state is only patched afterwards.
+  backend_state.BACKEND_STATE.ResendState()
+  await communicator.ListenToWebSocket(ws, codec, since)
 
   return ws
 
 
+async def WebSocketStatsHandler(request: web.Request) -> web.Response:
+  communicator = cast(WebSocketCommunicator, request.app["communicator"])
+  return web.json_response({"clients": [stats.ToJSON() for stats in communicator.Stats()]},
+                           content_type="application/json",
+                           headers=CORS_HEADERS)
+
+
+async def SchedulerStatsHandler(request: web.Request) -> web.Response:
+  return web.json_response(
+      {k: v.ToJSON() for k, v in scheduler.SCHEDULER.Stats().items()},
+      content_type="application/json",
+      headers=CORS_HEADERS)
+
+
 async def ScanPathsHandler(request: web.Request) -> web.Response:
   data = await request.json()
   paths: Iterable[str] = data["paths"]
@@ -71,8 +213,12 @@ async def ScanPathsHandler(request: web.Request) -> web.Response:
   communicator = cast(Communicator, request.app["communicator"])
   long_operation_runner = cast(LongOperationRunner, request.app["long_operation_runner"])
 
-  await spawn(request,
-              long_operation_runner.RunLongOperation(ScanPathsOperation(paths, communicator)))
+  async def ScanPaths():
+    await long_operation_runner.RunLongOperation(ScanPathsOperation(paths, communicator))
+    # Thumbnails that failed to render are retried in the background.
+    await RunThumbnailJobs(request.app)
+
+  await spawn(request, ScanPaths())
 
   return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
 
@@ -83,12 +229,37 @@ async def ExportToPathHandler(request: web.Request) -> web.Response:
   srcs: List[str] = data["srcs"]
   dest: str = data["dest"]
   prefix_with_index: bool = data["options"]["prefix_with_index"]
+  rendition: Optional[Dict[str, Any]] = data["options"].get("rendition")
+
+  operation: LongOperation
+  if rendition is None:
+    operation = ExportToPathOperation(srcs, dest, prefix_with_index)
+  else:
+    try:
+      options = image_processor.RenditionOptions(**rendition)
+    except (TypeError, ValueError) as e:
+      return web.Response(status=400, text=str(e), headers=CORS_HEADERS)
+    operation = ExportRenditionsOperation(srcs, dest, prefix_with_index, options)
 
   long_operation_runner = cast(LongOperationRunner, request.app["long_operation_runner"])
 
-  await spawn(
-      request,
-      long_operation_runner.RunLongOperation(ExportToPathOperation(srcs, dest, prefix_with_index)))
+  await spawn(request, long_operation_runner.RunLongOperation(operation))
+
+  return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
+
+
+async def CancelLongOperationHandler(request: web.Request) -> web.Response:
+  data = await request.json()
+  loid: str = data["loid"]
+
+  long_operation_runner = cast(LongOperationRunner, request.app["long_operation_runner"])
+  try:
+    if not long_operation_runner.CancelLongOperation(loid):
+      return web.Response(status=404, text=f"No such operation: {loid}", headers=CORS_HEADERS)
+  except NotCancellableError:
+    return web.Response(status=409,
+                        text=f"Operation can't be cancelled: {loid}",
+                        headers=CORS_HEADERS)
 
   return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
 
@@ -101,7 +272,18 @@ async def GetImageHandler(request: web.Request) -> web.StreamResponse:
   if uid is None:
     raise ValueError("'uid' parameter is missing")
 
-  io_stream = await store.DATA_STORE.ReadFileBlob(uid)
+  # The smallest preview at least this big is returned (the largest one by
+  # default): the renderer passes the size the image is displayed with.
+  max_size: Optional[int] = None
+  if "max_size" in request.query:
+    try:
+      max_size = int(request.query["max_size"])
+    except ValueError:
+      return web.Response(status=400,
+                          text=f"Invalid max_size: {request.query['max_size']}",
+                          headers=CORS_HEADERS)
+
+  io_stream = await store.DATA_STORE.ReadFileBlob(uid, max_size)
 
   try:
     headers = dict(CORS_HEADERS.items())
@@ -122,14 +304,95 @@ async def GetImageHandler(request: web.Request) -> web.StreamResponse:
   return response
 
 
+async def _ReadLines(stream: StreamReader) -> AsyncIterator[bytes]:
+  # StreamReader.readline() fails on lines longer than its buffer limit,
+  # while a single state entry (e.g. a big image list) may be megabytes long.
+  buf = bytearray()
+  async for chunk in stream.iter_any():
+    scan_from = len(buf)
+    buf += chunk
+    start = 0
+    while (end := buf.find(b"\n", scan_from)) != -1:
+      line = bytes(buf[start:end])
+      if line.strip():
+        yield line
+      start = scan_from = end + 1
+    del buf[:start]
+
+  if buf.strip():
+    yield bytes(buf)
+
+
+async def _StateChanges(lines: AsyncIterator[bytes]) -> AsyncIterator[store_state.StateChange]:
+  async for line in lines:
+    try:
+      data = json.loads(line)
+    except ValueError as e:
+      raise store_state.InvalidStateChangeError(f"Invalid JSON: {e}")
+    yield store_state.ChangeFromJSON(data)
+
+
 async def SaveHandler(request: web.Request) -> web.Response:
+  long_operation_runner = cast(LongOperationRunner, request.app["long_operation_runner"])
+
+  # A whole state is streamed as newline-delimited JSON: a {"path": ...}
+  # header followed by one [section, key, value] line per state entry. The
+  # entries are written to the catalog as they are read.
+  if request.content_type == "application/x-ndjson":
+    lines = _ReadLines(request.content)
+    try:
+      header = json.loads(await lines.__anext__())
+    except StopAsyncIteration:
+      return web.Response(status=400, text="Empty request", headers=CORS_HEADERS)
+    except ValueError as e:
+      return web.Response(status=400, text=f"Invalid header: {e}", headers=CORS_HEADERS)
+    if not isinstance(header, dict) or not isinstance(header.get("path"), str):
+      return web.Response(status=400, text="Header has no path", headers=CORS_HEADERS)
+
+    try:
+      await store.DATA_STORE.ReplaceState(_StateChanges(lines))
+    except (store_state.InvalidStateChangeError, store_metadata.InvalidMetadataUpdateError) as e:
+      # The saved state is left as it was.
+      return web.Response(status=400, text=str(e), headers=CORS_HEADERS)
+    await spawn(request,
+                long_operation_runner.RunLongOperation(SaveOperation(None, header["path"])))
+
+    return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
+
+  try:
+    data = await request.json()
+  except json.JSONDecodeError as e:
+    return web.Response(status=400, text=f"Invalid JSON: {e}", headers=CORS_HEADERS)
+  if not isinstance(data, dict) or not isinstance(data.get("path"), str):
+    return web.Response(status=400, text="Request has no path", headers=CORS_HEADERS)
+  path = data["path"]
+  # The renderer either sends its whole state or a patch against the state
+  # it has last loaded or saved.
+  state = data.get("state")
+  patch = data.get("patch")
+  if patch is not None and not isinstance(patch, dict):
+    return web.Response(status=400, text="Patch is not an object", headers=CORS_HEADERS)
+  if patch:
+    await store.DATA_STORE.AppendStatePatch(patch)
+
+  await spawn(request, long_operation_runner.RunLongOperation(SaveOperation(state, path)))
+
+  return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
+
+
+async def CompactCatalogHandler(request: web.Request) -> web.Response:
   data = await request.json()
-  path: str = data["path"]
-  state = data["state"]
+  # Removing images of missing files drops their labels and ratings too:
+  # the renderer only asks for it once the user confirms.
+  prune_missing_files = bool(data.get("prune_missing_files", False))
 
+  communicator = cast(Communicator, request.app["communicator"])
   long_operation_runner = cast(LongOperationRunner, request.app["long_operation_runner"])
 
-  await spawn(request, long_operation_runner.RunLongOperation(SaveOperation(state, path)))
+  await spawn(
+      request,
+      long_operation_runner.RunLongOperation(
+          CompactCatalogOperation(prune_missing_files, communicator)))
 
   return web.Response(text="ok", content_type="text", headers=CORS_HEADERS)
 
@@ -158,6 +421,73 @@ async def DieIfParentDies():
     await asyncio.sleep(1)
 
 
+async def OpenCatalogOnStartup(app: web.Application) -> None:
+  long_operation_runner = cast(LongOperationRunner, app["long_operation_runner"])
+  # Requests that need the catalog wait until it's open.
+  app["open_catalog_task"] = asyncio.create_task(
+      long_operation_runner.RunLongOperation(OpenCatalogOperation()))
+
+  app["resume_thumbnail_jobs_task"] = asyncio.create_task(ResumeThumbnailJobs(app))
+
+
+async def RunThumbnailJobs(app: web.Application) -> None:
+  """Runs unfinished thumbnail jobs (if any), unless they're being run already.
+
+  Failed jobs still backing off are run later, by a timer armed once the
+  due ones are done.
+  """
+  lock = cast(asyncio.Lock, app["thumbnail_jobs_lock"])
+  if lock.locked():
+    return
+
+  async with lock:
+    if await thumbnail_jobs.UnfinishedJobs():
+      communicator = cast(Communicator, app["communicator"])
+      long_operation_runner = cast(LongOperationRunner, app["long_operation_runner"])
+      await long_operation_runner.RunLongOperation(ThumbnailJobsOperation(communicator))
+    delay = await thumbnail_jobs.NextAttemptDelay()
+
+  timer = cast(Optional[asyncio.TimerHandle], app["thumbnail_jobs_timer"])
+  if timer is not None:
+    timer.cancel()
+  app["thumbnail_jobs_timer"] = None
+  if delay is not None:
+
+    def Resume():
+      app["thumbnail_jobs_timer"] = None
+      app["resume_thumbnail_jobs_task"] = asyncio.create_task(ResumeThumbnailJobs(app))
+
+    app["thumbnail_jobs_timer"] = asyncio.get_running_loop().call_later(delay, Resume)
+
+
+async def ResumeThumbnailJobs(app: web.Application) -> None:
+  # Jobs left over from the last run (e.g. by an interrupted scan).
+  await app["open_catalog_task"]
+  try:
+    await RunThumbnailJobs(app)
+  except Exception as e:
+    logging.exception("Failed resuming thumbnail jobs: %s", e)
+
+
+async def CancelThumbnailJobsTimerOnShutdown(app: web.Application) -> None:
+  timer = cast(Optional[asyncio.TimerHandle], app["thumbnail_jobs_timer"])
+  if timer is not None:
+    timer.cancel()
+
+
+async def FlushJournalOnShutdown(app: web.Application) -> None:
+  await store.DATA_STORE.FlushJournal()
+
+
+async def StopRenditionWorkersOnShutdown(app: web.Application) -> None:
+  image_processor.IMAGE_PROCESSOR.Shutdown()
+
+
+async def ClosePreviewCacheOnShutdown(app: web.Application) -> None:
+  if preview_cache.PREVIEW_CACHE is not None:
+    await preview_cache.PREVIEW_CACHE.Close()
+
+
 def SecretCheckWrapper(
     fn: Callable[[web.Request], Awaitable[web.Response]]
 ) -> Callable[[web.Request], Awaitable[web.Response]]:
@@ -179,29 +509,51 @@ def main():
   CORS_HEADERS["Access-Control-Allow-Origin"] = args.cors_allow_origin
   logging.info("Allowing requests from: %s", args.cors_allow_origin)
 
-  image_processor.InitImageProcessor()
-  store.InitDataStore(args.db_file)
+  scheduler.InitScheduler({
+      scheduler.Resource.DISK_IO: args.disk_io_slots,
+      scheduler.Resource.CPU_DECODE: args.cpu_decode_slots,
+      scheduler.Resource.DB_WRITE: args.db_write_slots,
+  })
+  image_processor.InitImageProcessor(args.rendition_workers, args.rendition_worker_memory)
+  store.InitDataStore(args.db_file, preview_budget=args.preview_budget)
+  if args.preview_cache:
+    preview_cache.InitPreviewCache(args.preview_cache_dir, args.preview_cache_budget)
 
   communicator = WebSocketCommunicator()
-  long_operation_runner = LongOperationRunner(communicator)
+  long_operation_runner = LongOperationRunner(communicator, status_interval=args.status_interval)
 
-  # TODO: max request size is 1 Gb. This creates a natural
-  # limit on the library size. We should look into how to
-  # do streaming updates.
-  app = web.Application(client_max_size=1024 * 1024 * 1024)
+  # Whole states are streamed to /save as ndjson, which this limit does not
+  # apply to: it only bounds the JSON bodies, the largest being state patches.
+  app = web.Application(client_max_size=64 * 1024 * 1024)
   app.add_routes([
       web.get("/", RootHandler),
       # Store and state methods.
       web.get("/ws", WebSocketHandler),
+      web.options("/ws-stats", AllowCorsHandler),
+      web.get("/ws-stats", SecretCheckWrapper(WebSocketStatsHandler)),
+      web.options("/scheduler-stats", AllowCorsHandler),
+      web.get("/scheduler-stats", SecretCheckWrapper(SchedulerStatsHandler)),
       web.options("/saved-state", AllowCorsHandler),
       web.get("/saved-state", SecretCheckWrapper(SavedStateHandler)),
+      web.options("/query", AllowCorsHandler),
+      web.post("/query", SecretCheckWrapper(QueryHandler)),
+      web.options("/image-infos", AllowCorsHandler),
+      web.post("/image-infos", SecretCheckWrapper(ImageInfosHandler)),
+      web.options("/search", AllowCorsHandler),
+      web.get("/search", SecretCheckWrapper(SearchHandler)),
+      web.options("/metadata", AllowCorsHandler),
+      web.post("/metadata", SecretCheckWrapper(UpdateMetadataHandler)),
       web.options("/scan-paths", AllowCorsHandler),
       web.post("/scan-paths", SecretCheckWrapper(ScanPathsHandler)),
       web.options("/save", AllowCorsHandler),
       web.post("/save", SecretCheckWrapper(SaveHandler)),
+      web.options("/compact", AllowCorsHandler),
+      web.post("/compact", SecretCheckWrapper(CompactCatalogHandler)),
       web.options("/move-path", AllowCorsHandler),
       web.options("/export-to-path", AllowCorsHandler),
       web.post("/export-to-path", SecretCheckWrapper(ExportToPathHandler)),
+      web.options("/cancel-long-operation", AllowCorsHandler),
+      web.post("/cancel-long-operation", SecretCheckWrapper(CancelLongOperationHandler)),
       web.get("/images/{uid}", GetImageHandler),
       # OS helper methods.
       web.options("/open-with-entries", AllowCorsHandler),
@@ -209,6 +561,13 @@ def main():
   ])
   app["communicator"] = communicator
   app["long_operation_runner"] = long_operation_runner
+  app["thumbnail_jobs_lock"] = asyncio.Lock()
+  app["thumbnail_jobs_timer"] = None
+  app.on_startup.append(OpenCatalogOnStartup)
+  app.on_shutdown.append(CancelThumbnailJobsTimerOnShutdown)
+  app.on_shutdown.append(FlushJournalOnShutdown)
+  app.on_shutdown.append(ClosePreviewCacheOnShutdown)
+  app.on_shutdown.append(StopRenditionWorkersOnShutdown)
   aiojobs.aiohttp.setup(app)
 
   # Die if the parent process dies.
@@ -233,4 +592,6 @@ def main():
 
 
 if __name__ == '__main__':
+  # Rendition workers are started by running the (frozen) backend binary.
+  multiprocessing.freeze_support()
   main()
@@ -0,0 +1,29 @@
+from newmedia import store_codec
+from newmedia.schemas import schema_0003
+
+# ImageData.info codecs of the schema_0003 layout. Migrations use these
+# rather than store_codec's, which follow the current store_schema: catalogs
+# being migrated still have to be read and written in the layout they had at
+# the time, however ImageFile changes later on.
+
+# Positional records (catalogs written before sparse EXIF encoding).
+_POSITIONAL = store_codec.RecordCodec(b"\x01", record_class=schema_0003.ImageFile)
+# Records with sparse ExifData.
+_SPARSE = store_codec.RecordCodec(b"\x02",
+                                  sparse=(schema_0003.ExifData,),
+                                  record_class=schema_0003.ImageFile)
+
+_CODECS = {c.tag: c for c in (_POSITIONAL, _SPARSE)}
+
+
+def Encode(image_file: schema_0003.ImageFile) -> bytes:
+  return _SPARSE.Encode(image_file)
+
+
+def Decode(data: bytes) -> schema_0003.ImageFile:
+  try:
+    codec = _CODECS[data[:1]]
+  except KeyError:
+    raise store_codec.UnsupportedFormatError(f"Unknown ImageFile encoding: {data[:1]!r}")
+
+  return codec.Decode(data)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import aiosqlite
 import bson
 
@@ -6,38 +8,55 @@ from newmedia.schemas import schema_0001
 from newmedia.schemas import schema_0002
 
 
-class Migration0002(store_migration.Migration):
+class Migration0002(store_migration.BatchedMigration):
   @property
   def version(self) -> int:
     return 2
 
-  async def Migrate(self, conn: aiosqlite.Connection) -> None:
-    await conn.executescript("""
+  async def Prepare(self, conn: aiosqlite.Connection) -> None:
+    await conn.execute("""
     CREATE TABLE ImagePreview (
       uid TEXT NOT NULL,
       width INTEGER NOT NULL,
       height INTEGER NOT NULL,
       blob BLOB
-    );
-
-    CREATE INDEX ImagePreview_uid
-    ON ImagePreview(uid);
+    )
     """)
+    await conn.execute("""
+    CREATE INDEX ImagePreview_uid
+    ON ImagePreview(uid)""")
 
-    async with conn.execute("SELECT uid, info, blob FROM ImageData") as cursor:
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT COUNT(*) FROM ImageData") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    updates = []
+    previews = []
+    async with conn.execute(
+        "SELECT uid, info, blob FROM ImageData WHERE uid > ? ORDER BY uid LIMIT ?",
+        (after_key or "", limit)) as cursor:
       async for row in cursor:
         uid = row[0]
         prev_info = schema_0001.ImageFile.FromJSON(bson.loads(row[1]))
-        prev_blob = row[2]
         new_info = schema_0002.ImageFile.FromV1(prev_info)
-        serialized = bson.dumps(new_info.ToJSON())
 
-        await conn.execute_insert("UPDATE ImageData SET info = ? WHERE uid = ?", (uid, serialized))
+        updates.append((bson.dumps(new_info.ToJSON()), uid))
         if prev_info.preview_size:
-          await conn.execute_insert("INSERT OR REPLACE INTO ImagePreview(uid, width, height, blob) VALUES(?, ?, ?, ?)", (uid, prev_info.preview_size.width, prev_info.preview_size.height, prev_blob))
-        await conn.commit()
+          previews.append(
+              (uid, prev_info.preview_size.width, prev_info.preview_size.height, row[2]))
 
-    await conn.executescript("""
-    ALTER TABLE ImageData DROP COLUMN blob;
-    """)
-    await conn.commit()
+    if not updates:
+      return None
+
+    await conn.executemany("UPDATE ImageData SET info = ? WHERE uid = ?", updates)
+    await conn.executemany(
+        "INSERT INTO ImagePreview(uid, width, height, blob) VALUES(?, ?, ?, ?)", previews)
+    return updates[-1][1]
+
+  async def Finish(self, conn: aiosqlite.Connection) -> None:
+    if await store_migration.HasColumn(conn, "ImageData", "blob"):
+      await conn.execute("ALTER TABLE ImageData DROP COLUMN blob")
@@ -0,0 +1,64 @@
+from typing import Optional
+
+import aiosqlite
+import bson
+
+from newmedia import store_image_data
+from newmedia import store_migration
+from newmedia.schemas import schema_0002
+
+
+class Migration0003(store_migration.BatchedMigration):
+  @property
+  def version(self) -> int:
+    return 3
+
+  async def Prepare(self, conn: aiosqlite.Connection) -> None:
+    for column in [
+        "file_size INTEGER",
+        "file_ctime INTEGER",
+        "file_mtime INTEGER",
+        "date_time_original TEXT",
+        "make TEXT",
+        "model TEXT",
+        "mime_type TEXT",
+        "dir TEXT",
+    ]:
+      await conn.execute(f"ALTER TABLE ImageData ADD COLUMN {column}")
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT COUNT(*) FROM ImageData") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    updates = []
+    async with conn.execute("SELECT uid, info FROM ImageData WHERE uid > ? ORDER BY uid LIMIT ?",
+                            (after_key or "", limit)) as cursor:
+      async for row in cursor:
+        image_file = schema_0002.ImageFile.FromJSON(bson.loads(row[1]))
+        updates.append(store_image_data.IndexedColumns(image_file) + (row[0],))
+
+    if not updates:
+      return None
+
+    await conn.executemany(
+        f"""
+    UPDATE ImageData
+    SET {", ".join(f"{c} = ?" for c in store_image_data.COLUMNS)}
+    WHERE uid = ?
+    """, updates)
+    return updates[-1][-1]
+
+  async def Finish(self, conn: aiosqlite.Connection) -> None:
+    for index in [
+        "ImageData_file_mtime_index ON ImageData(file_mtime)",
+        "ImageData_file_size_index ON ImageData(file_size)",
+        "ImageData_date_time_original_index ON ImageData(date_time_original)",
+        "ImageData_make_model_index ON ImageData(make, model)",
+        "ImageData_mime_type_index ON ImageData(mime_type)",
+        "ImageData_dir_index ON ImageData(dir)",
+    ]:
+      await conn.execute(f"CREATE INDEX IF NOT EXISTS {index}")
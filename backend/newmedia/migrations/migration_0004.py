@@ -0,0 +1,33 @@
+import aiosqlite
+import bson
+
+from newmedia import store_migration
+
+
+class Migration0004(store_migration.Migration):
+  @property
+  def version(self) -> int:
+    return 4
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await conn.executescript("""
+    CREATE TABLE ImageMetadata (
+      uid TEXT PRIMARY KEY,
+      label INTEGER NOT NULL DEFAULT 0,
+      rating INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE INDEX ImageMetadata_label_index ON ImageMetadata(label);
+    CREATE INDEX ImageMetadata_rating_index ON ImageMetadata(rating);
+    """)
+
+    rows = []
+    async with conn.execute("SELECT blob FROM RendererState WHERE id = 'state'") as cursor:
+      async for row in cursor:
+        state = bson.loads(row[0])
+        for uid, mdata in (state.get("metadata") or {}).items():
+          rows.append((uid, mdata.get("label") or 0, mdata.get("rating") or 0))
+
+    await conn.executemany("INSERT OR REPLACE INTO ImageMetadata(uid, label, rating) VALUES (?, ?, ?)",
+                           rows)
+    await conn.commit()
@@ -0,0 +1,70 @@
+import os
+from typing import Optional
+
+import aiosqlite
+import bson
+
+from newmedia import store_migration
+from newmedia.schemas import schema_0002
+
+
+class Migration0005(store_migration.BatchedMigration):
+  @property
+  def version(self) -> int:
+    return 5
+
+  async def Prepare(self, conn: aiosqlite.Connection) -> None:
+    # ImageSearchDoc gives every uid a stable integer id that is used as
+    # the ImageSearch rowid (ImageData rowids are not stable across VACUUM).
+    await conn.execute("""
+    CREATE TABLE ImageSearchDoc (
+      id INTEGER PRIMARY KEY,
+      uid TEXT NOT NULL UNIQUE
+    )
+    """)
+    await conn.execute("""
+    CREATE VIRTUAL TABLE ImageSearch USING fts5(
+      path,
+      name,
+      make,
+      model,
+      software,
+      icc_profile_description,
+      tokenize = 'unicode61',
+      prefix = '2 3'
+    )
+    """)
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT COUNT(*) FROM ImageData") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    docs = []
+    async with conn.execute("SELECT uid, info FROM ImageData WHERE uid > ? ORDER BY uid LIMIT ?",
+                            (after_key or "", limit)) as cursor:
+      async for row in cursor:
+        image_file = schema_0002.ImageFile.FromJSON(bson.loads(row[1]))
+        docs.append((
+            row[0],
+            os.path.dirname(image_file.path),
+            os.path.basename(image_file.path),
+            image_file.exif_data.make,
+            image_file.exif_data.model,
+            image_file.exif_data.software,
+            image_file.icc_profile_description,
+        ))
+
+    if not docs:
+      return None
+
+    await conn.executemany("INSERT INTO ImageSearchDoc(uid) VALUES (?)", ((d[0],) for d in docs))
+    await conn.executemany(
+        """
+    INSERT INTO ImageSearch(rowid, path, name, make, model, software, icc_profile_description)
+    SELECT id, ?, ?, ?, ?, ?, ? FROM ImageSearchDoc WHERE uid = ?
+    """, (d[1:] + (d[0],) for d in docs))
+    return docs[-1][0]
@@ -0,0 +1,36 @@
+from typing import Optional
+
+import aiosqlite
+import bson
+
+from newmedia import store_migration
+from newmedia.migrations import codec_0003
+from newmedia.schemas import schema_0002
+from newmedia.schemas import schema_0003
+
+
+class Migration0006(store_migration.BatchedMigration):
+  @property
+  def version(self) -> int:
+    return 6
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT COUNT(*) FROM ImageData") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    updates = []
+    async with conn.execute("SELECT uid, info FROM ImageData WHERE uid > ? ORDER BY uid LIMIT ?",
+                            (after_key or "", limit)) as cursor:
+      async for row in cursor:
+        v2 = schema_0002.ImageFile.FromJSON(bson.loads(row[1]))
+        updates.append((codec_0003.Encode(schema_0003.ImageFile.FromV2(v2)), row[0]))
+
+    if not updates:
+      return None
+
+    await conn.executemany("UPDATE ImageData SET info = ? WHERE uid = ?", updates)
+    return updates[-1][1]
@@ -0,0 +1,39 @@
+from typing import Optional
+
+import aiosqlite
+
+from newmedia import store_migration
+from newmedia.migrations import codec_0003
+
+
+class Migration0007(store_migration.BatchedMigration):
+  # Re-encodes positional records with the sparse ExifData codec.
+
+  @property
+  def version(self) -> int:
+    return 7
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute(
+        "SELECT COUNT(*) FROM ImageData WHERE substr(info, 1, 1) = x'01'") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    updates = []
+    async with conn.execute(
+        """
+    SELECT uid, info FROM ImageData
+    WHERE uid > ? AND substr(info, 1, 1) = x'01'
+    ORDER BY uid LIMIT ?
+        """, (after_key or "", limit)) as cursor:
+      async for row in cursor:
+        updates.append((codec_0003.Encode(codec_0003.Decode(row[1])), row[0]))
+
+    if not updates:
+      return None
+
+    await conn.executemany("UPDATE ImageData SET info = ? WHERE uid = ?", updates)
+    return updates[-1][1]
@@ -0,0 +1,38 @@
+import aiosqlite
+import bson
+
+from newmedia import store_migration
+from newmedia import store_state
+
+
+class Migration0008(store_migration.Migration):
+  @property
+  def version(self) -> int:
+    return 8
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await conn.executescript("""
+    CREATE TABLE RendererStateEntry (
+      section TEXT NOT NULL,
+      key TEXT NOT NULL,
+      value BLOB NOT NULL,
+      PRIMARY KEY (section, key)
+    );
+
+    CREATE TABLE RendererStateLog (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      patch BLOB NOT NULL
+    );
+    """)
+
+    async with conn.execute("SELECT blob FROM RendererState WHERE id = 'state'") as cursor:
+      async for row in cursor:
+        state = bson.loads(row[0])
+        await conn.executemany(
+            "INSERT INTO RendererStateEntry(section, key, value) VALUES (?, ?, ?)",
+            ((s, k, v) for s, k, v in store_state.ExplodeState(state) if v is not None))
+
+    await conn.executescript("""
+    DROP TABLE RendererState;
+    """)
+    await conn.commit()
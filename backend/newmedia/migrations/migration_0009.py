@@ -0,0 +1,44 @@
+import json
+
+import aiosqlite
+
+from newmedia import store_metadata
+from newmedia import store_migration
+from newmedia import store_state
+
+
+class Migration0009(store_migration.Migration):
+  @property
+  def version(self) -> int:
+    return 9
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await conn.executescript("""
+    ALTER TABLE ImageMetadata ADD COLUMN rotation INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE ImageMetadata ADD COLUMN horizontal_flip INTEGER NOT NULL DEFAULT 0;
+    ALTER TABLE ImageMetadata ADD COLUMN vertical_flip INTEGER NOT NULL DEFAULT 0;
+    """)
+
+    # Per-image metadata now lives in ImageMetadata only: move the renderer
+    # state's "metadata" entries there (including pending patches).
+    metadata: dict = {}
+    async with conn.execute(
+        "SELECT key, value FROM RendererStateEntry WHERE section = 'metadata'") as cursor:
+      async for row in cursor:
+        metadata[row[0]] = json.loads(row[1])
+
+    patches = []
+    async with conn.execute("SELECT seq, patch FROM RendererStateLog ORDER BY seq") as cursor:
+      async for row in cursor:
+        patch = json.loads(row[1])
+        metadata.update(patch.pop("metadata", None) or {})
+        patches.append((store_state.Dumps(patch), row[0]))
+
+    await conn.execute("DELETE FROM ImageMetadata")
+    await conn.executemany(
+        f"INSERT INTO ImageMetadata(uid, {', '.join(store_metadata.COLUMNS)}) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((uid,) + store_metadata.RowFromJSON(m) for uid, m in metadata.items() if m is not None))
+    await conn.execute("DELETE FROM RendererStateEntry WHERE section = 'metadata'")
+    await conn.executemany("UPDATE RendererStateLog SET patch = ? WHERE seq = ?", patches)
+    await conn.commit()
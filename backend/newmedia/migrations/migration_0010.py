@@ -0,0 +1,16 @@
+import aiosqlite
+
+from newmedia import store_migration
+
+
+class Migration0010(store_migration.Migration):
+  # Used to switch the catalog to incremental auto-vacuum with a full VACUUM,
+  # while previews were still in the catalog file. This is done by migration
+  # 0014 now, once migration 0012 has moved the previews out.
+
+  @property
+  def version(self) -> int:
+    return 10
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    pass
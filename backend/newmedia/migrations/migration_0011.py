@@ -0,0 +1,23 @@
+import aiosqlite
+
+from newmedia import store_migration
+
+
+class Migration0011(store_migration.Migration):
+  # Tracks when previews of every image were last viewed, so that the least
+  # recently viewed ones are evicted first when over the preview budget.
+
+  @property
+  def version(self) -> int:
+    return 11
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await conn.executescript("""
+    CREATE TABLE PreviewAccess (
+      uid TEXT PRIMARY KEY,
+      accessed_at INTEGER NOT NULL
+    );
+
+    CREATE INDEX PreviewAccess_accessed_at_index ON PreviewAccess(accessed_at);
+    """)
+    await conn.commit()
@@ -0,0 +1,61 @@
+from typing import Optional
+
+import aiosqlite
+
+from newmedia import store_migration
+from newmedia import store_shards
+
+
+class Migration0012(store_migration.BatchedMigration):
+  # Moves previews out of the catalog file into preview shards.
+
+  # Rows are copied within SQLite, but each of them holds a preview.
+  batch_size = 200
+
+  @property
+  def version(self) -> int:
+    return 12
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    # Called on every (possibly resumed) run before the rows are migrated.
+    await store_shards.AttachPreviewShards(conn)
+    await conn.create_function("nm_preview_shard",
+                               1,
+                               store_shards.PreviewShardIndex,
+                               deterministic=True)
+
+    async with conn.execute("SELECT COUNT(*) FROM main.ImagePreview") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    after_rowid = int(after_key or 0)
+    last_rowid = None
+    async with conn.execute(
+        """
+    SELECT MAX(rowid) FROM (
+      SELECT rowid FROM main.ImagePreview WHERE rowid > ? ORDER BY rowid LIMIT ?)
+        """, (after_rowid, limit)) as cursor:
+      async for row in cursor:
+        last_rowid = row[0]
+
+    if last_rowid is None:
+      return None
+
+    for i, schema in enumerate(store_shards.PreviewShardSchemas()):
+      await conn.execute(
+          f"""
+    INSERT INTO {schema}.ImagePreview(uid, width, height, blob)
+    SELECT uid, width, height, blob FROM main.ImagePreview
+    WHERE rowid > ? AND rowid <= ? AND nm_preview_shard(uid) = ?
+          """, (after_rowid, last_rowid, i))
+    return str(last_rowid)
+
+  async def Finish(self, conn: aiosqlite.Connection) -> None:
+    await conn.execute("DROP TABLE IF EXISTS main.ImagePreview")
+    # Returns the pages freed by the previews to the filesystem. Catalogs
+    # without incremental auto-vacuum yet are vacuumed by migration 0014.
+    async with conn.execute("PRAGMA main.incremental_vacuum") as cursor:
+      await cursor.fetchall()
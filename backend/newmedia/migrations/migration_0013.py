@@ -0,0 +1,25 @@
+import aiosqlite
+
+from newmedia import store_migration
+
+
+class Migration0013(store_migration.Migration):
+  # Keeps track of thumbnails still to be rendered (see store_jobs.py).
+
+  @property
+  def version(self) -> int:
+    return 13
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await conn.executescript("""
+    CREATE TABLE ThumbnailJob (
+      uid TEXT PRIMARY KEY,
+      state TEXT NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt_at INTEGER NOT NULL DEFAULT 0,
+      error TEXT
+    );
+
+    CREATE INDEX ThumbnailJob_state_index ON ThumbnailJob(state, next_attempt_at);
+    """)
+    await conn.commit()
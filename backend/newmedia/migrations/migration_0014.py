@@ -0,0 +1,30 @@
+import aiosqlite
+
+from newmedia import store_migration
+
+# auto_vacuum of a database using incremental auto-vacuum.
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+class Migration0014(store_migration.Migration):
+  # Switches the catalog to incremental auto-vacuum, so that pages freed by
+  # catalog compaction can be returned to the filesystem without rewriting
+  # the whole file. Changing auto_vacuum of an existing database only takes
+  # effect after a full VACUUM, which is done once here: previews are in
+  # their shards by now, so only metadata is rewritten.
+
+  @property
+  def version(self) -> int:
+    return 14
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    # Catalogs migrated by the former migration 0010 were vacuumed already.
+    async with conn.execute("PRAGMA main.auto_vacuum") as cursor:
+      async for row in cursor:
+        if row[0] == _AUTO_VACUUM_INCREMENTAL:
+          return
+
+    # VACUUM can't run within a transaction.
+    await conn.commit()
+    await conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+    await conn.execute("VACUUM main")
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import logging
+import os
+import pathlib
+import time
+from typing import Optional, Tuple
+
+import aiosqlite
+import msgpack
+
+from newmedia import image_processor
+from newmedia import store_schema
+
+# A user-level cache of rendered previews shared by all catalogs, so that
+# files already thumbnailed for one catalog aren't decoded again for another.
+#
+# Entries are keyed by a fingerprint of the file's contents and by the
+# parameters previews are rendered with, so moved or copied files still hit
+# the cache, while changed files or a change in rendering don't. Least
+# recently used entries are evicted when the cache grows over its budget.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS CachedPreviews (
+  key TEXT PRIMARY KEY,
+  accessed_at INTEGER NOT NULL,
+  bytes INTEGER NOT NULL,
+  entry BLOB NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS CachedPreviews_accessed_at_index
+ON CachedPreviews(accessed_at, bytes);
+"""
+
+# Once over the budget, entries are evicted until the cache takes up this
+# fraction of it.
+_BUDGET_LOW_WATERMARK = 0.9
+
+# Files are fingerprinted by their size and by chunks of this size taken from
+# their beginning, middle and end: hashing whole files would read every RAW
+# file twice (once for the fingerprint and once to decode it).
+_FINGERPRINT_CHUNK_SIZE = 64 * 1024
+
+DEFAULT_BUDGET = 2 * 1024 * 1024 * 1024
+
+
+def DefaultCacheDir() -> pathlib.Path:
+  cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return pathlib.Path(cache_home) / "newmedia"
+
+
+def _RenderParams() -> str:
+  tiers = ",".join(str(t) for t in image_processor.PREVIEW_TIERS)
+  return f"v{image_processor.PREVIEW_RENDER_VERSION}:{tiers}"
+
+
+def _FileFingerprint(path: str) -> str:
+  h = hashlib.blake2b(digest_size=20)
+  with open(path, "rb") as fd:
+    size = os.fstat(fd.fileno()).st_size
+    h.update(size.to_bytes(8, "little"))
+    if size <= 3 * _FINGERPRINT_CHUNK_SIZE:
+      h.update(fd.read())
+    else:
+      for offset in (0, (size - _FINGERPRINT_CHUNK_SIZE) // 2, size - _FINGERPRINT_CHUNK_SIZE):
+        fd.seek(offset)
+        h.update(fd.read(_FINGERPRINT_CHUNK_SIZE))
+  return h.hexdigest()
+
+
+class PreviewCache:
+  """Previews (and what's learned when rendering them) keyed by file contents."""
+
+  def __init__(self, cache_dir: pathlib.Path, budget: int = DEFAULT_BUDGET):
+    self._db_path = cache_dir / "previews.db"
+    self._budget = budget
+    self._conn: Optional[aiosqlite.Connection] = None
+    self._conn_lock = asyncio.Lock()
+
+  async def _GetConn(self) -> aiosqlite.Connection:
+    async with self._conn_lock:
+      if self._conn is None:
+        self._db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = await aiosqlite.connect(self._db_path)
+        # The cache is shared by backends of all open catalogs.
+        await conn.execute("PRAGMA journal_mode = WAL")
+        await conn.execute("PRAGMA busy_timeout = 5000")
+        await conn.executescript(_SCHEMA)
+        await conn.commit()
+        self._conn = conn
+      return self._conn
+
+  async def Close(self) -> None:
+    if self._conn is not None:
+      await self._conn.close()
+      self._conn = None
+
+  async def Key(self, image_file: store_schema.ImageFile) -> Optional[str]:
+    """Returns the cache key of the file, None if it can't be read."""
+    try:
+      fingerprint = await asyncio.get_running_loop().run_in_executor(
+          None, _FileFingerprint, image_file.path)
+    except IOError:
+      return None
+    return f"{fingerprint}:{_RenderParams()}"
+
+  async def Get(
+      self, key: str, image_file: store_schema.ImageFile
+  ) -> Optional[Tuple[store_schema.ImageFile, Tuple[bytes, ...]]]:
+    """Returns the image file updated with the cached previews and the previews' blobs."""
+    conn = await self._GetConn()
+    entry = None
+    async with conn.execute("SELECT entry FROM CachedPreviews WHERE key = ?", (key,)) as cursor:
+      async for row in cursor:
+        entry = row[0]
+    if entry is None:
+      return None
+
+    await conn.execute("UPDATE CachedPreviews SET accessed_at = ? WHERE key = ?",
+                       (int(time.time() * 1000), key))
+    await conn.commit()
+
+    (width, height), mime_type, icc_profile_description, previews = msgpack.unpackb(entry)
+    try:
+      file_size = os.stat(image_file.path).st_size
+    except IOError:
+      return None
+
+    timestamp = int(time.time() * 1000)
+    return (
+        store_schema.ImageFile(
+            path=image_file.path,
+            uid=image_file.uid,
+            size=store_schema.Size(width, height),
+            previews=[
+                store_schema.ImageFilePreview(preview_size=store_schema.Size(w, h),
+                                              preview_timestamp=timestamp)
+                for w, h, _ in previews
+            ],
+            file_color_tag=image_file.file_color_tag,
+            file_size=file_size,
+            file_ctime=image_file.file_ctime,
+            file_mtime=image_file.file_mtime,
+            mime_type=mime_type,
+            icc_profile_description=icc_profile_description,
+            exif_data=image_file.exif_data,
+        ),
+        tuple(blob for _, _, blob in previews),
+    )
+
+  async def Put(self, key: str, image_file: store_schema.ImageFile,
+                blobs: Tuple[bytes, ...]) -> None:
+    entry = msgpack.packb([
+        (image_file.size.width, image_file.size.height),
+        image_file.mime_type,
+        image_file.icc_profile_description,
+        [(p.preview_size.width, p.preview_size.height, blob)
+         for p, blob in zip(image_file.previews, blobs)],
+    ], use_bin_type=True)
+
+    conn = await self._GetConn()
+    await conn.execute(
+        "INSERT OR REPLACE INTO CachedPreviews(key, accessed_at, bytes, entry) VALUES (?, ?, ?, ?)",
+        (key, int(time.time() * 1000), len(entry), entry))
+    await conn.commit()
+    await self._EnforceBudget(conn, key)
+
+  async def _EnforceBudget(self, conn: aiosqlite.Connection, written_key: str) -> None:
+    async with conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM CachedPreviews") as cursor:
+      total = [r[0] async for r in cursor][0]
+    if total <= self._budget:
+      return
+
+    target = int(self._budget * _BUDGET_LOW_WATERMARK)
+    evicted = []
+    async with conn.execute(
+        "SELECT key, bytes FROM CachedPreviews WHERE key != ? ORDER BY accessed_at",
+        (written_key,)) as cursor:
+      async for key, size in cursor:
+        if total <= target:
+          break
+        evicted.append((key,))
+        total -= size
+
+    await conn.executemany("DELETE FROM CachedPreviews WHERE key = ?", evicted)
+    await conn.commit()
+    logging.info("Evicted %d cached previews to stay within the preview cache budget",
+                 len(evicted))
+
+
+PREVIEW_CACHE: Optional[PreviewCache] = None
+
+
+def InitPreviewCache(cache_dir: Optional[pathlib.Path] = None,
+                     budget: int = DEFAULT_BUDGET) -> None:
+  global PREVIEW_CACHE
+  PREVIEW_CACHE = PreviewCache(cache_dir or DefaultCacheDir(), budget)
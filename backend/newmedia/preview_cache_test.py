@@ -0,0 +1,141 @@
+import pathlib
+import shutil
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+from newmedia import backend_state
+from newmedia import communicator
+from newmedia import image_processor
+from newmedia import preview_cache
+from newmedia import store
+from newmedia import store_schema
+
+
+def _MakeImageFile(path: pathlib.Path) -> store_schema.ImageFile:
+  return store_schema.ImageFile(
+      path=str(path),
+      uid="abc",
+      size=store_schema.Size(10, 10),
+      previews=[store_schema.ImageFilePreview(store_schema.Size(10, 10), 1600000000000)],
+      file_size=1,
+      file_ctime=1500000000000,
+      file_mtime=1500000001000,
+      file_color_tag=store_schema.FileColorTag.NONE,
+      icc_profile_description="",
+      mime_type="image/jpeg",
+      exif_data=store_schema.ExifData(),
+  )
+
+
+async def _RegisterAndThumbnail(db: store.DataStore, path: pathlib.Path) -> str:
+  image_file = await db.RegisterFile(path)
+  await db.UpdateFileThumbnail(image_file.uid)
+  return image_file.uid
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_PreviewsAreReusedAcrossCatalogs(tmp_path: pathlib.Path):
+  cache = preview_cache.PreviewCache(tmp_path / "cache")
+  src = tmp_path / "a.jpg"
+  Image.effect_noise((2000, 1500), 64).convert("RGB").save(src)
+  # Same contents, different path.
+  copy = tmp_path / "b.jpg"
+  shutil.copy(src, copy)
+
+  with mock.patch.object(preview_cache, "PREVIEW_CACHE", cache):
+    first = store.DataStore()
+    second = store.DataStore()
+    try:
+      await _RegisterAndThumbnail(first, src)
+      with mock.patch.object(image_processor.IMAGE_PROCESSOR, "ThumbnailFile") as thumbnail:
+        uid = await _RegisterAndThumbnail(second, copy)
+        thumbnail.assert_not_called()
+
+      image_file = await second.ReadFileInfo(uid)
+      assert image_file.path == str(copy)
+      assert image_file.size.width == 2000
+      assert [p.preview_size.width for p in image_file.previews] == [2000, 1280, 400]
+      with Image.open(await second.ReadFileBlob(uid, max_size=1000)) as im:
+        assert im.size == (1280, 960)
+    finally:
+      await first.Close()
+      await second.Close()
+      await cache.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(image_processor, "PREVIEW_RENDER_VERSION", image_processor.PREVIEW_RENDER_VERSION)
+async def test_ChangedFilesAndRenderParamsMissTheCache(tmp_path: pathlib.Path):
+  cache = preview_cache.PreviewCache(tmp_path / "cache")
+  path = tmp_path / "a.jpg"
+  path.write_bytes(b"1")
+  image_file = _MakeImageFile(path)
+  try:
+    key = await cache.Key(image_file)
+    assert key is not None
+    await cache.Put(key, image_file, (b"preview",))
+    assert await cache.Get(key, image_file) is not None
+
+    path.write_bytes(b"2")
+    assert await cache.Key(image_file) != key
+    path.write_bytes(b"1")
+    assert await cache.Key(image_file) == key
+
+    image_processor.PREVIEW_RENDER_VERSION += 1
+    assert await cache.Key(image_file) != key
+
+    path.unlink()
+    assert await cache.Key(image_file) is None
+  finally:
+    await cache.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(preview_cache, "_FINGERPRINT_CHUNK_SIZE", 4)
+async def test_LargeFilesAreFingerprintedBySizeAndSampledChunks(tmp_path: pathlib.Path):
+  cache = preview_cache.PreviewCache(tmp_path / "cache")
+  path = tmp_path / "a.nef"
+  image_file = _MakeImageFile(path)
+  try:
+    path.write_bytes(b"head" + b"." * 20 + b"midl" + b"." * 20 + b"tail")
+    key = await cache.Key(image_file)
+
+    # Bytes between the sampled chunks aren't read.
+    path.write_bytes(b"head" + b"x" * 20 + b"midl" + b"x" * 20 + b"tail")
+    assert await cache.Key(image_file) == key
+
+    for changed in (b"HEAD" + b"." * 20 + b"midl" + b"." * 20 + b"tail",
+                    b"head" + b"." * 20 + b"MIDL" + b"." * 20 + b"tail",
+                    b"head" + b"." * 20 + b"midl" + b"." * 20 + b"TAIL",
+                    b"head" + b"." * 20 + b"midl" + b"." * 21 + b"tail"):
+      path.write_bytes(changed)
+      assert await cache.Key(image_file) != key
+  finally:
+    await cache.Close()
+
+
+@pytest.mark.asyncio
+async def test_LeastRecentlyUsedEntriesAreEvicted(tmp_path: pathlib.Path):
+  cache = preview_cache.PreviewCache(tmp_path / "cache", budget=2500)
+  image_file = _MakeImageFile(tmp_path)
+  try:
+    with mock.patch("time.time", side_effect=range(100, 200)):
+      for key in ("a", "b"):
+        await cache.Put(key, image_file, (b"x" * 1000,))
+      # "a" is now used more recently than "b".
+      assert await cache.Get("a", image_file) is not None
+      await cache.Put("c", image_file, (b"x" * 1000,))
+
+    assert await cache.Get("a", image_file) is not None
+    assert await cache.Get("b", image_file) is None
+    assert await cache.Get("c", image_file) is not None
+  finally:
+    await cache.Close()
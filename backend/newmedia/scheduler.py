@@ -0,0 +1,162 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import enum
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+# Concurrent long operations (scans, exports, saves) compete for the same
+# resources: the disk, the thumbnailing thread pool and the catalog's
+# connection. Work using a resource acquires a slot of its class first.
+# Slots are handed out to operations in turn, so that one operation can't
+# starve another, and interactive work (e.g. rendering a preview the user is
+# looking at) goes before background work (e.g. thumbnailing a scan).
+
+
+class Resource(enum.Enum):
+  DISK_IO = "disk_io"
+  CPU_DECODE = "cpu_decode"
+  DB_WRITE = "db_write"
+
+
+class Priority(enum.IntEnum):
+  INTERACTIVE = 0
+  BACKGROUND = 1
+
+
+DEFAULT_LIMITS = {
+    # Matches the number of image info threads.
+    Resource.DISK_IO: 4,
+    # Matches the number of thumbnailing threads.
+    Resource.CPU_DECODE: 2,
+    # Held by every write to the catalog: writers share a single connection,
+    # so they'd commit each other's transactions otherwise.
+    Resource.DB_WRITE: 1,
+}
+
+# Operation the current task works for (None for work done on behalf of
+# request handlers) and its priority. Set by LongOperationRunner.
+CURRENT_OWNER: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("owner",
+                                                                              default=None)
+CURRENT_PRIORITY: contextvars.ContextVar[Priority] = contextvars.ContextVar(
+    "priority", default=Priority.INTERACTIVE)
+
+
+@dataclasses.dataclass
+class ResourceStats:
+  limit: int
+  in_use: int
+  waiting: int
+
+  def ToJSON(self):
+    return dataclasses.asdict(self)
+
+
+_WaiterKey = Tuple[Priority, Optional[str]]
+
+
+class _ResourceSlots:
+
+  def __init__(self, limit: int):
+    self.limit = limit
+    self.in_use = 0
+    # Waiters of every owner, and owners with waiters of every priority in
+    # the order they're to be served.
+    self._waiters: Dict[_WaiterKey, Deque["asyncio.Future[None]"]] = {}
+    self._owners: Dict[Priority, Deque[_WaiterKey]] = {p: collections.deque() for p in Priority}
+
+  @property
+  def waiting(self) -> int:
+    return sum(1 for w in self._waiters.values() for f in w if not f.done())
+
+  async def Acquire(self, owner: Optional[str], priority: Priority) -> None:
+    if self.in_use < self.limit and not self._waiters:
+      self.in_use += 1
+      return
+
+    key = (priority, owner)
+    waiters = self._waiters.get(key)
+    if waiters is None:
+      waiters = self._waiters[key] = collections.deque()
+      self._owners[priority].append(key)
+    future = asyncio.get_running_loop().create_future()
+    waiters.append(future)
+
+    try:
+      await future
+    except asyncio.CancelledError:
+      if future.done() and not future.cancelled():
+        # The slot was handed over just before the cancellation.
+        self.Release()
+      raise
+
+  def Release(self) -> None:
+    future = self._Next()
+    if future is None:
+      self.in_use -= 1
+    else:
+      # The slot is handed over directly.
+      future.set_result(None)
+
+  def _Next(self) -> Optional["asyncio.Future[None]"]:
+    for priority in Priority:
+      owners = self._owners[priority]
+      while owners:
+        key = owners.popleft()
+        waiters = self._waiters[key]
+        while waiters:
+          future = waiters.popleft()
+          if future.done():  # Cancelled.
+            continue
+          # The owner goes to the back of the line.
+          if waiters:
+            owners.append(key)
+          else:
+            del self._waiters[key]
+          return future
+        del self._waiters[key]
+    return None
+
+
+class Scheduler:
+
+  def __init__(self, limits: Optional[Dict[Resource, int]] = None):
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+    self._slots = {r: _ResourceSlots(limits[r]) for r in Resource}
+
+  @contextlib.asynccontextmanager
+  async def Acquire(self, resource: Resource) -> AsyncIterator[None]:
+    """Holds a slot of the resource on behalf of the current operation."""
+    slots = self._slots[resource]
+    await slots.Acquire(CURRENT_OWNER.get(), CURRENT_PRIORITY.get())
+    try:
+      yield
+    finally:
+      slots.Release()
+
+  def Stats(self) -> Dict[str, ResourceStats]:
+    return {
+        r.value: ResourceStats(limit=s.limit, in_use=s.in_use, waiting=s.waiting)
+        for r, s in self._slots.items()
+    }
+
+
+@contextlib.contextmanager
+def RunAs(owner: str, priority: Priority):
+  """Makes work done within (and in tasks created within) count as owner's."""
+  owner_token = CURRENT_OWNER.set(owner)
+  priority_token = CURRENT_PRIORITY.set(priority)
+  try:
+    yield
+  finally:
+    CURRENT_PRIORITY.reset(priority_token)
+    CURRENT_OWNER.reset(owner_token)
+
+
+SCHEDULER = Scheduler()
+
+
+def InitScheduler(limits: Optional[Dict[Resource, int]] = None) -> None:
+  global SCHEDULER
+  SCHEDULER = Scheduler(limits)
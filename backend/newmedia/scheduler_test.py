@@ -0,0 +1,95 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from newmedia import scheduler
+
+
+async def _Use(s: scheduler.Scheduler, resource: scheduler.Resource, owner: str,
+               priority: scheduler.Priority, order: List[str], hold: "asyncio.Event"):
+  with scheduler.RunAs(owner, priority):
+    async with s.Acquire(resource):
+      order.append(owner)
+      await hold.wait()
+
+
+async def _Settle():
+  for _ in range(10):
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_LimitIsEnforced():
+  s = scheduler.Scheduler({scheduler.Resource.DISK_IO: 2})
+  order: List[str] = []
+  hold = asyncio.Event()
+
+  tasks = [
+      asyncio.create_task(
+          _Use(s, scheduler.Resource.DISK_IO, f"op{i}", scheduler.Priority.BACKGROUND, order,
+               hold)) for i in range(5)
+  ]
+  await _Settle()
+  assert len(order) == 2
+  assert s.Stats()["disk_io"] == scheduler.ResourceStats(limit=2, in_use=2, waiting=3)
+
+  hold.set()
+  await asyncio.gather(*tasks)
+  assert len(order) == 5
+  assert s.Stats()["disk_io"] == scheduler.ResourceStats(limit=2, in_use=0, waiting=0)
+
+
+@pytest.mark.asyncio
+async def test_InteractiveWorkGoesFirstAndOwnersTakeTurns():
+  s = scheduler.Scheduler({scheduler.Resource.CPU_DECODE: 1})
+  order: List[str] = []
+  released = asyncio.Event()
+  released.set()
+
+  def Use(owner: str, priority: scheduler.Priority) -> "asyncio.Task[None]":
+    return asyncio.create_task(
+        _Use(s, scheduler.Resource.CPU_DECODE, owner, priority, order, released))
+
+  blocker = asyncio.Event()
+  first = asyncio.create_task(
+      _Use(s, scheduler.Resource.CPU_DECODE, "first", scheduler.Priority.BACKGROUND, order,
+           blocker))
+  await _Settle()
+
+  # A scan queues a lot of work before the other operations get to it.
+  tasks = [Use("scan", scheduler.Priority.BACKGROUND) for _ in range(3)]
+  await _Settle()
+  tasks += [Use("export", scheduler.Priority.BACKGROUND) for _ in range(2)]
+  await _Settle()
+  tasks += [Use("preview", scheduler.Priority.INTERACTIVE)]
+  await _Settle()
+
+  blocker.set()
+  await asyncio.gather(first, *tasks)
+  assert order == ["first", "preview", "scan", "export", "scan", "export", "scan"]
+
+
+@pytest.mark.asyncio
+async def test_CancelledWaiterDoesNotHoldSlot():
+  s = scheduler.Scheduler({scheduler.Resource.DB_WRITE: 1})
+  order: List[str] = []
+  hold = asyncio.Event()
+
+  holder = asyncio.create_task(
+      _Use(s, scheduler.Resource.DB_WRITE, "save", scheduler.Priority.INTERACTIVE, order, hold))
+  waiter = asyncio.create_task(
+      _Use(s, scheduler.Resource.DB_WRITE, "scan", scheduler.Priority.BACKGROUND, order, hold))
+  await _Settle()
+
+  waiter.cancel()
+  hold.set()
+  await holder
+  with pytest.raises(asyncio.CancelledError):
+    await waiter
+
+  assert order == ["save"]
+  assert s.Stats()["db_write"] == scheduler.ResourceStats(limit=1, in_use=0, waiting=0)
+
+  async with s.Acquire(scheduler.Resource.DB_WRITE):
+    assert s.Stats()["db_write"].in_use == 1
@@ -17,8 +17,9 @@ class ImageFilePreview:
 
   @classmethod
   def FromJSON(cls, data):
+    # ToJSON() writes "preview_size", older code expected "size".
     return ImageFilePreview(
-        Size.FromJSON(data["size"]) or Size(0, 0),
+        Size.FromJSON(data.get("preview_size") or data.get("size")) or Size(0, 0),
         data["preview_timestamp"],
     )
 
@@ -0,0 +1,219 @@
+import dataclasses
+import datetime
+import fractions
+from typing import Any, List, Optional, Tuple
+
+from newmedia.schemas import schema_0002
+from newmedia.utils.json_type import JSON
+
+# Same fields as schema_0002, but the classes use __slots__: catalogs hold
+# hundreds of thousands of these records and slots make them both smaller and
+# faster to access. Binary (de)serialization lives in store_codec.
+
+FileColorTag = schema_0002.FileColorTag
+
+_DATE_KEYS = ("date_time", "date_time_original", "date_time_digitized", "gps_date_stamp")
+_GPS_KEYS = ("gpa_latitude", "gps_longitude", "gps_time_stamp")
+_FRACTION_KEYS = ("gps_altitude",)
+
+
+@dataclasses.dataclass(slots=True)
+class Size:
+  width: int
+  height: int
+
+  @classmethod
+  def FromJSON(cls, data):
+    if not data:
+      return None
+    else:
+      return Size(data["width"], data["height"])
+
+  def ToJSON(self):
+    return {"width": self.width, "height": self.height}
+
+
+@dataclasses.dataclass(slots=True)
+class ImageFilePreview:
+  preview_size: Size
+  preview_timestamp: int
+
+  @classmethod
+  def FromJSON(cls, data):
+    return ImageFilePreview(
+        Size.FromJSON(data["preview_size"]) or Size(0, 0),
+        data["preview_timestamp"],
+    )
+
+  def ToJSON(self):
+    return {
+        "preview_size": self.preview_size.ToJSON(),
+        "preview_timestamp": self.preview_timestamp,
+    }
+
+
+@dataclasses.dataclass(slots=True)
+class ExifData:
+  # See https://www.media.mit.edu/pia/Research/deepview/exif.html
+
+  # Tags used by IFD0 (main image)
+  make: Optional[str] = None
+  model: Optional[str] = None
+  orientation: Optional[int] = None
+  x_resolution: Optional[float] = None
+  y_resolution: Optional[float] = None
+  resolution_unit: Optional[int] = None
+  software: Optional[str] = None
+  date_time: Optional[datetime.datetime] = None
+  exposure_time: Optional[float] = None
+  f_number: Optional[float] = None
+
+  # Tags used by Exif SubIFD
+  exposure_program: Optional[int] = None
+  iso_speed_ratings: Optional[int] = None
+  exif_version: Optional[str] = None
+  date_time_original: Optional[datetime.datetime] = None
+  date_time_digitized: Optional[datetime.datetime] = None
+  shutter_speed_value: Optional[float] = None
+  aperture_value: Optional[float] = None
+  brightness_value: Optional[float] = None
+  exposure_bias_value: Optional[float] = None
+  max_aperture_value: Optional[float] = None
+  subject_distance: Optional[float] = None
+  metering_mode: Optional[int] = None
+  light_source: Optional[int] = None
+  flash: Optional[int] = None
+  focal_length: Optional[int] = None
+  exif_image_width: Optional[int] = None
+  exif_image_height: Optional[int] = None
+  focal_plane_x_resolution: Optional[float] = None
+  focal_plane_y_resolution: Optional[float] = None
+
+  # Tags used by IFD1 (thumbnail image)
+  image_width: Optional[int] = None
+  image_height: Optional[int] = None
+  bits_per_sample: Optional[int] = None
+  compression: Optional[int] = None
+  photometric_interpretation: Optional[int] = None
+
+  # GPS Ifd tags (see https://www.awaresystems.be/imaging/tiff/tifftags/privateifd/gps.html)
+  gps_version_id: Optional[str] = None
+  gps_latitude_ref: Optional[str] = None
+  gpa_latitude: Optional[Tuple[fractions.Fraction, fractions.Fraction, fractions.Fraction]] = None
+  gps_longitude_ref: Optional[str] = None
+  gps_longitude: Optional[Tuple[fractions.Fraction, fractions.Fraction, fractions.Fraction]] = None
+  gps_altitude_ref: Optional[int] = None
+  gps_altitude: Optional[fractions.Fraction] = None
+  gps_time_stamp: Optional[Tuple[fractions.Fraction, fractions.Fraction, fractions.Fraction]] = None
+  gps_date_stamp: Optional[datetime.datetime] = None
+
+  @classmethod
+  def FromV2(cls, v2: schema_0002.ExifData) -> "ExifData":
+    return ExifData(**{f.name: getattr(v2, f.name) for f in dataclasses.fields(cls)})
+
+  @classmethod
+  def FromJSON(cls, json_data: JSON) -> "ExifData":
+    data: Any = dict(json_data or {})
+
+    for k in _DATE_KEYS:
+      if data.get(k):
+        data[k] = datetime.datetime.strptime(data[k], "%Y:%m:%d %H:%M:%S")
+
+    for k in _GPS_KEYS:
+      if data.get(k):
+        data[k] = tuple(fractions.Fraction(i) for i in data[k])
+
+    for k in _FRACTION_KEYS:
+      if data.get(k):
+        data[k] = fractions.Fraction(data[k])
+
+    return ExifData(**data)
+
+  def ToJSON(self) -> JSON:
+    # Only set tags are serialized: most of them are None for PNGs,
+    # screenshots and the like. FromJSON() fills in the defaults.
+    result: Any = {}
+    for name in _FIELD_NAMES:
+      v = getattr(self, name)
+      if v is None:
+        continue
+      elif isinstance(v, fractions.Fraction):
+        v = str(v)
+      elif isinstance(v, datetime.datetime):
+        v = v.strftime("%Y:%m:%d %H:%M:%S")
+      elif isinstance(v, tuple):
+        v = [str(i) for i in v]
+      result[name] = v
+
+    return result
+
+
+_FIELD_NAMES = tuple(f.name for f in dataclasses.fields(ExifData))
+
+
+@dataclasses.dataclass(slots=True)
+class ImageFile:
+  path: str
+  uid: str
+
+  size: Size
+  previews: List[ImageFilePreview]
+
+  file_size: int
+  file_ctime: int
+  file_mtime: int
+  file_color_tag: FileColorTag
+
+  icc_profile_description: str
+  mime_type: str
+  exif_data: ExifData
+
+  @classmethod
+  def FromV2(cls, v2: schema_0002.ImageFile) -> "ImageFile":
+    return ImageFile(
+        path=v2.path,
+        uid=v2.uid,
+        size=Size(v2.size.width, v2.size.height),
+        previews=[
+            ImageFilePreview(Size(p.preview_size.width, p.preview_size.height),
+                             p.preview_timestamp) for p in v2.previews
+        ],
+        file_size=v2.file_size,
+        file_ctime=v2.file_ctime,
+        file_mtime=v2.file_mtime,
+        file_color_tag=v2.file_color_tag,
+        icc_profile_description=v2.icc_profile_description,
+        mime_type=v2.mime_type,
+        exif_data=ExifData.FromV2(v2.exif_data),
+    )
+
+  @classmethod
+  def FromJSON(cls, data):
+    return ImageFile(
+        path=data["path"],
+        uid=data["uid"],
+        size=Size.FromJSON(data["size"]) or Size(0, 0),
+        previews=[ImageFilePreview.FromJSON(v) for v in data["previews"]],
+        file_size=data["file_size"],
+        file_ctime=data["file_ctime"],
+        file_mtime=data["file_mtime"],
+        file_color_tag=FileColorTag(data["file_color_tag"]),
+        icc_profile_description=data["icc_profile_description"],
+        mime_type=data["mime_type"],
+        exif_data=ExifData.FromJSON(data["exif_data"]),
+    )
+
+  def ToJSON(self):
+    return {
+        "path": self.path,
+        "uid": self.uid,
+        "size": self.size.ToJSON(),
+        "previews": [v.ToJSON() for v in self.previews],
+        "file_size": self.file_size,
+        "file_ctime": self.file_ctime,
+        "file_mtime": self.file_mtime,
+        "file_color_tag": self.file_color_tag,
+        "icc_profile_description": self.icc_profile_description,
+        "mime_type": self.mime_type,
+        "exif_data": self.exif_data.ToJSON(),
+    }
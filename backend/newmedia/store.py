@@ -1,19 +1,46 @@
 import asyncio
+import contextlib
+import dataclasses
 import io
+import json
 import logging
 import os
 import pathlib
-from typing import Any, Callable, Dict, List, Optional, cast
+import sqlite3
+import time
+from typing import (Any, AsyncContextManager, AsyncIterable, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set,
+                    Tuple, cast)
 
 import aiosqlite
-import bson
 
 from newmedia import backend_state
 from newmedia import image_processor
+from newmedia import preview_cache
+from newmedia import scheduler
+from newmedia import store_codec
+from newmedia import store_image_data
+from newmedia import store_jobs
+from newmedia import store_journal
+from newmedia import store_metadata
 from newmedia import store_migration
+from newmedia import store_query
 from newmedia import store_schema
+from newmedia import store_shards
+from newmedia import store_state
 from newmedia.migrations import migration_0001
 from newmedia.migrations import migration_0002
+from newmedia.migrations import migration_0003
+from newmedia.migrations import migration_0004
+from newmedia.migrations import migration_0005
+from newmedia.migrations import migration_0006
+from newmedia.migrations import migration_0007
+from newmedia.migrations import migration_0008
+from newmedia.migrations import migration_0009
+from newmedia.migrations import migration_0010
+from newmedia.migrations import migration_0011
+from newmedia.migrations import migration_0012
+from newmedia.migrations import migration_0013
+from newmedia.migrations import migration_0014
 
 
 class Error(Exception):
@@ -44,14 +71,185 @@ class DestinationFileExistsError(Error):
   pass
 
 
+# Renderer state patches are folded into RendererStateEntry once there are
+# more than this many of them in RendererStateLog.
+STATE_LOG_COMPACTION_THRESHOLD = 32
+
+# Tables keyed by image uid. Incremental saves copy the rows of the images
+# changed since the last save. Previews are kept in preview shards instead,
+# which are written to directly (see store_shards.py).
+_PER_IMAGE_TABLES = ("ImageData", "ImageMetadata", "PreviewAccess", "ThumbnailJob")
+
+# Once over the preview budget, previews are evicted until they take up this
+# fraction of it, so that the budget isn't exceeded again right away.
+_PREVIEW_BUDGET_LOW_WATERMARK = 0.9
+
+# Previews are evicted this many at a time.
+_PREVIEW_EVICTION_BATCH_SIZE = 256
+
+# Number of rows written to the staging tables at a time when replacing the
+# renderer state.
+_STATE_STAGING_BATCH_SIZE = 1000
+
+_SEARCH_COLUMNS = "path, name, make, model, software, icc_profile_description"
+
+# Number of rows (previews or images) looked at in one go when compacting the
+# catalog. Every batch is a separate transaction.
+_COMPACTION_BATCH_SIZE = 500
+
+# Called with (status, fraction of the current step done).
+CompactionProgressCallback = Callable[[str, float], Any]
+
+
+@dataclasses.dataclass
+class CompactionResult:
+  # Number of ImagePreview rows removed because their image is gone or
+  # because they were superseded by newer previews of the same size.
+  pruned_previews: int = 0
+  # Images removed from the (in-memory) catalog because their files no
+  # longer exist. Only done if asked for.
+  removed_uids: List[str] = dataclasses.field(default_factory=list)
+  # Size of the catalog file (or of the in-memory catalog if it was never
+  # saved) and of its preview shards before and after the compaction.
+  size_before: int = 0
+  size_after: int = 0
+  elapsed: float = 0.0
+
+  @property
+  def bytes_reclaimed(self) -> int:
+    return max(0, self.size_before - self.size_after)
+
+
+def _PickPreview(previews: List[store_schema.ImageFilePreview],
+                 max_size: Optional[int]) -> Optional[store_schema.Size]:
+  """Picks the smallest preview at least max_size big, or the largest one."""
+  sizes = sorted((p.preview_size for p in previews), key=lambda s: s.width * s.height)
+  if not sizes:
+    return None
+
+  if max_size is not None:
+    for size in sizes:
+      if max(size.width, size.height) >= max_size:
+        return size
+  return sizes[-1]
+
+
+def _FindMissingFiles(rows: List[Tuple[str, str]]) -> List[str]:
+  """Returns uids of the files that were removed.
+
+  A file only counts as removed if its directory still exists: files on
+  disconnected volumes are kept in the catalog.
+  """
+  return [
+      uid for uid, path in rows
+      if not os.path.exists(path) and os.path.isdir(os.path.dirname(path))
+  ]
+
+
+_UID_FILTER = "uid IN (SELECT value FROM json_each(?))"
+
+
+def _PruneImageStatements(uids: List[str]) -> Iterator[Tuple[str, Tuple[Any, ...]]]:
+  """Yields statements removing the catalog rows (but not previews) of the images.
+
+  Their previews are orphaned and get pruned by the next compaction.
+  """
+  params = (json.dumps(uids),)
+  yield f"""
+DELETE FROM ImageSearch
+WHERE rowid IN (SELECT id FROM ImageSearchDoc WHERE {_UID_FILTER})""", params
+  yield f"DELETE FROM ImageSearchDoc WHERE {_UID_FILTER}", params
+  for t in _PER_IMAGE_TABLES:
+    yield f"DELETE FROM {t} WHERE {_UID_FILTER}", params
+
+
+def _ThumbnailJobRecord(job: store_jobs.ThumbnailJob) -> List[Any]:
+  return [
+      store_journal.RECORD_THUMBNAIL_JOB, job.uid, job.state, job.attempts, job.next_attempt_at,
+      job.error
+  ]
+
+
+async def _CreatePreviewView(conn: aiosqlite.Connection) -> None:
+  """Creates a read-only ImagePreview view of all the preview shards."""
+  union = " UNION ALL ".join(f"SELECT uid, width, height, blob FROM {shard}.ImagePreview"
+                             for shard in store_shards.PreviewShardSchemas())
+  await conn.execute(f"CREATE TEMP VIEW IF NOT EXISTS ImagePreview AS {union}")
+  await conn.commit()
+
+
+def Migrations() -> List[store_migration.Migration]:
+  return [
+      migration_0001.Migration0001(),
+      migration_0002.Migration0002(),
+      migration_0003.Migration0003(),
+      migration_0004.Migration0004(),
+      migration_0005.Migration0005(),
+      migration_0006.Migration0006(),
+      migration_0007.Migration0007(),
+      migration_0008.Migration0008(),
+      migration_0009.Migration0009(),
+      migration_0010.Migration0010(),
+      migration_0011.Migration0011(),
+      migration_0012.Migration0012(),
+      migration_0013.Migration0013(),
+      migration_0014.Migration0014(),
+  ]
+
+
 class DataStore:
 
-  def __init__(self, db_path: Optional[pathlib.Path] = None):
+  def __init__(self, db_path: Optional[pathlib.Path] = None, preview_budget: int = 0):
     self._db_path = db_path and str(db_path) or ""
     self._conn: Optional[aiosqlite.Connection] = None
     self._conn_lock = asyncio.Lock()
 
-  async def _GetConnImpl(self) -> aiosqlite.Connection:
+    # The in-memory catalog is written to disk on save. If it's saved to the
+    # same file it was last synced with, only the changes made since the
+    # last sync are written.
+    self._synced_path: Optional[str] = None
+    self._synced_log_seq = 0
+    self._compacted_log_seq = 0
+    self._dirty_uids: Set[str] = set()
+    self._dirty_state_keys: Set[Tuple[str, str]] = set()
+    self._replaced_tables: Set[str] = set()
+    # Held while writing to the catalog file: both saves and compactions
+    # attach it to the in-memory catalog's connection.
+    self._catalog_file_lock = asyncio.Lock()
+    # Held while replacing the renderer state: the staging tables are shared.
+    self._replace_state_lock = asyncio.Lock()
+
+    # Total size of previews (in bytes) the catalog may hold, 0 for no limit.
+    # Larger tiers of the least recently viewed images are evicted first.
+    self._preview_budget = preview_budget
+    # Total size of previews, computed on first use and kept up to date
+    # afterwards.
+    self._preview_bytes: Optional[int] = None
+    # If nothing could be evicted when over the budget, eviction isn't tried
+    # again until previews take this many bytes.
+    self._next_eviction_at = 0
+    # Preview access times (in ms) not yet written to PreviewAccess, by uid.
+    # Only tracked if there's a preview budget, and only written before
+    # evictions and saves (which hold the DB_WRITE slot anyway), so that
+    # reading previews never waits for the slot.
+    self._pending_accesses: Dict[str, int] = {}
+    # Images viewed since the last save: only their PreviewAccess rows have
+    # to be saved.
+    self._accessed_uids: Set[str] = set()
+    # Ongoing renders of evicted previews, by uid.
+    self._regenerating: Dict[str, "asyncio.Future[store_schema.ImageFile]"] = {}
+
+    # Catalog path the attached preview shards belong to, "" for in-memory
+    # shards.
+    self._previews_path = ""
+
+    # Changes made since the last save are also appended to a journal next
+    # to the catalog, so that they survive a crash.
+    self._journal: Optional[store_journal.Journal] = None
+
+  async def _GetConnImpl(
+      self,
+      progress: Optional[store_migration.ProgressCallback] = None) -> aiosqlite.Connection:
     if self._conn is not None:
       return self._conn
 
@@ -59,6 +257,10 @@ class DataStore:
     self._conn = await aiosqlite.connect(self._db_path)
 
     if self._db_path:
+      # Migrations are applied to the catalog file in place: they commit in
+      # batches and can be resumed if interrupted.
+      await self._RunMigrations(self._conn, progress)
+
       logging.info("Reading %s into a temporary db.", self._db_path)
       copy_conn = await aiosqlite.connect("")
 
@@ -77,40 +279,139 @@ class DataStore:
       await self._conn.close()
 
       self._conn = copy_conn
-
-    await store_migration.RunMigrations(self._conn, [
-        migration_0001.Migration0001(),
-        migration_0002.Migration0002(),
-    ])
+      # Previews stay in the shard files.
+      await store_shards.AttachPreviewShards(self._conn, self._db_path)
+      await _CreatePreviewView(self._conn)
+      self._previews_path = self._db_path
+
+      self._synced_path = self._db_path
+      self._synced_log_seq = await self._GetMaxLogSeq(self._conn)
+      await self._OpenJournal(self._conn, self._db_path)
+    else:
+      await self._RunMigrations(self._conn, progress)
+      await store_shards.AttachPreviewShards(self._conn, "")
+      await _CreatePreviewView(self._conn)
 
     return self._conn
-  
+
+  async def _RunMigrations(self, conn: aiosqlite.Connection,
+                           progress: Optional[store_migration.ProgressCallback]) -> None:
+    await store_migration.RunMigrations(conn, Migrations(), progress=progress)
+
+  async def Open(self, progress: Optional[store_migration.ProgressCallback] = None) -> None:
+    """Opens the catalog, reporting progress of the migrations (if any)."""
+    async with self._conn_lock:
+      await self._GetConnImpl(progress)
+
   async def _GetConn(self) -> aiosqlite.Connection:
     async with self._conn_lock:
       return await self._GetConnImpl()
 
   async def Close(self) -> None:
     assert self._conn is not None
+    if self._journal is not None:
+      await self._journal.Close()
     await self._conn.close()
 
+  async def FlushJournal(self) -> None:
+    if self._journal is not None:
+      await self._journal.Flush()
+
+  def _WriteSlot(self) -> AsyncContextManager[None]:
+    """Acquires the DB_WRITE slot.
+
+    Every write to the catalog holds the slot. The scheduler isn't reentrant:
+    code running on behalf of a holder (e.g. SaveStore()) mustn't acquire it
+    again.
+    """
+    return scheduler.SCHEDULER.Acquire(scheduler.Resource.DB_WRITE)
+
+  async def _OpenJournal(self, conn: aiosqlite.Connection, catalog_path: str) -> None:
+    journal = store_journal.Journal(store_journal.JournalPath(catalog_path))
+    records = await asyncio.get_running_loop().run_in_executor(None, journal.Open)
+    if records:
+      logging.info("Replaying %d journal records from %s", len(records), journal.path)
+      for r in records:
+        await self._ApplyJournalRecord(conn, r)
+      await conn.commit()
+
+    self._journal = journal
+
+  async def _SwitchJournal(self, catalog_path: str, saved_size: Optional[int]) -> None:
+    """Drops journal records of changes that were just saved to catalog_path."""
+    journal_path = store_journal.JournalPath(catalog_path)
+    if self._journal is not None and self._journal.path == journal_path:
+      assert saved_size is not None
+      await self._journal.Truncate(saved_size)
+      return
+
+    # Saved to a new file: the changes journaled for the previous file are in
+    # the new one now, while an existing journal of the new file is stale.
+    if self._journal is not None:
+      await self._journal.Close(remove=True)
+    if os.path.exists(journal_path):
+      os.remove(journal_path)
+
+    journal = store_journal.Journal(journal_path)
+    await asyncio.get_running_loop().run_in_executor(None, journal.Open)
+    self._journal = journal
+
+  def _AppendToJournal(self, record: List[Any]) -> None:
+    if self._journal is not None:
+      self._journal.Append(record)
+
+  async def _ApplyJournalRecord(self, conn: aiosqlite.Connection, record: List[Any]) -> None:
+    kind = record[0]
+    if kind == store_journal.RECORD_IMAGE:
+      _, info, previews = record
+      image_file = store_codec.Decode(info)
+      await self._WriteImageData(conn, image_file)
+      if previews is not None:
+        await self._WritePreviews(conn, image_file.uid, previews)
+    elif kind == store_journal.RECORD_STATE_PATCH:
+      await self._ApplyStatePatch(conn, json.loads(record[1]))
+    elif kind == store_journal.RECORD_METADATA_UPDATE:
+      _, uids, values = record
+      await self._ApplyMetadataUpdate(conn, store_metadata.MetadataUpdate(uids=uids, **values))
+    elif kind == store_journal.RECORD_THUMBNAIL_JOB:
+      await self._WriteThumbnailJob(conn, store_jobs.ThumbnailJob(*record[1:]))
+    elif kind == store_journal.RECORD_PRUNE:
+      uids = record[1]
+      for sql, params in _PruneImageStatements(uids):
+        await conn.execute(sql, params)
+      self._dirty_uids.update(uids)
+    else:
+      logging.warning("Skipping unknown journal record type: %r", kind)
+
   # TODO: hold a global lock of some kind while saving the store.
   # At least make sure no new pictures are registered during the save.
-  async def SaveStore(self,
-                      path,
-                      renderer_state_json,
-                      progress: Optional[Callable[[float], Any]] = None):
+  async def SaveStore(self, path, progress: Optional[Callable[[float], Any]] = None):
+    """Saves the catalog to path. The caller holds the DB_WRITE slot.
+
+    A new renderer state is replaced (see ReplaceState) before the slot is
+    taken, as ReplaceState takes it after its own lock.
+    """
     self._db_path = path
 
-    serialized = bson.dumps(renderer_state_json)
     conn = await self._GetConn()
-    await conn.execute_insert(
-        """
-INSERT OR REPLACE INTO RendererState(id, blob)
-VALUES ('state', ?)
-      """, (serialized,))
-    await conn.commit()
+    await self._FlushPreviewAccesses(conn)
+
+    async with self._catalog_file_lock:
+      journal_size = self._journal.size if self._journal is not None else None
+
+      if path == self._synced_path and os.path.exists(path):
+        await self._SaveIncrementally(conn, path)
+        if progress is not None:
+          progress(1.0)
+      else:
+        await self._SaveFully(conn, path, progress)
+
+      await self._SwitchJournal(path, journal_size)
+    await backend_state.BACKEND_STATE.ChangeCatalogPath(path)
 
-    copy_conn = await aiosqlite.connect(self._db_path)
+  async def _SaveFully(self, conn: aiosqlite.Connection, path: str,
+                       progress: Optional[Callable[[float], Any]]) -> None:
+    copy_conn = await aiosqlite.connect(path)
 
     def Progress(status, remaining, total):
       remaining = remaining or 1
@@ -124,7 +425,527 @@ VALUES ('state', ?)
 
     await conn._execute(Backup)
     await copy_conn.close()
-    await backend_state.BACKEND_STATE.ChangeCatalogPath(path)
+
+    if path != self._previews_path:
+      await self._CopyPreviewShards(conn, path)
+
+    self._synced_path = path
+    self._synced_log_seq = await self._GetMaxLogSeq(conn)
+    self._dirty_uids.clear()
+    self._dirty_state_keys.clear()
+    self._replaced_tables.clear()
+    self._accessed_uids.clear()
+
+  async def _CopyPreviewShards(self, conn: aiosqlite.Connection, path: str) -> None:
+    """Copies the preview shards next to the catalog saved to path and uses them."""
+    for i, shard in enumerate(store_shards.PreviewShardSchemas()):
+      shard_path = store_shards.PreviewShardPath(path, i)
+      logging.info("Saving previews shard: %s", shard_path)
+      shard_conn = await aiosqlite.connect(shard_path)
+
+      def Backup():
+        conn._conn.backup(shard_conn._conn, pages=100, name=shard)
+
+      await conn._execute(Backup)
+      await shard_conn.close()
+
+    await store_shards.DetachPreviewShards(conn)
+    await store_shards.AttachPreviewShards(conn, path)
+    self._previews_path = path
+
+  async def _SaveIncrementally(self, conn: aiosqlite.Connection, path: str) -> None:
+    dirty_uids = self._dirty_uids
+    dirty_state_keys = self._dirty_state_keys
+    replaced_tables = self._replaced_tables
+    accessed_uids = self._accessed_uids
+    self._dirty_uids, self._dirty_state_keys, self._replaced_tables = set(), set(), set()
+    self._accessed_uids = set()
+
+    synced_log_seq = self._synced_log_seq
+    compacted_log_seq = self._compacted_log_seq
+    max_log_seq = await self._GetMaxLogSeq(conn)
+
+    def Statements():
+      dirty_uid_filter = "uid IN (SELECT uid FROM temp.DirtyUid)"
+      for t in _PER_IMAGE_TABLES:
+        if t in replaced_tables:
+          yield f"DELETE FROM disk.{t}"
+          yield f"INSERT INTO disk.{t} SELECT * FROM main.{t}"
+        else:
+          uid_filter = dirty_uid_filter
+          if t == "PreviewAccess":
+            uid_filter += " OR uid IN (SELECT uid FROM temp.AccessedUid)"
+          yield f"DELETE FROM disk.{t} WHERE {uid_filter}"
+          yield f"INSERT INTO disk.{t} SELECT * FROM main.{t} WHERE {uid_filter}"
+
+      yield f"""
+DELETE FROM disk.ImageSearch
+WHERE rowid IN (SELECT id FROM disk.ImageSearchDoc WHERE {dirty_uid_filter})"""
+      yield f"DELETE FROM disk.ImageSearchDoc WHERE {dirty_uid_filter}"
+      yield f"INSERT INTO disk.ImageSearchDoc SELECT * FROM main.ImageSearchDoc WHERE {dirty_uid_filter}"
+      yield f"""
+INSERT INTO disk.ImageSearch(rowid, {_SEARCH_COLUMNS})
+SELECT rowid, {_SEARCH_COLUMNS} FROM main.ImageSearch
+WHERE rowid IN (SELECT id FROM main.ImageSearchDoc WHERE {dirty_uid_filter})"""
+
+      if "RendererStateEntry" in replaced_tables:
+        yield "DELETE FROM disk.RendererStateEntry"
+        yield "INSERT INTO disk.RendererStateEntry SELECT * FROM main.RendererStateEntry"
+        yield "DELETE FROM disk.RendererStateLog"
+      else:
+        dirty_key_filter = "(section, key) IN (SELECT section, key FROM temp.DirtyStateKey)"
+        yield f"DELETE FROM disk.RendererStateEntry WHERE {dirty_key_filter}"
+        yield f"""
+INSERT INTO disk.RendererStateEntry
+SELECT * FROM main.RendererStateEntry WHERE {dirty_key_filter}"""
+        yield f"DELETE FROM disk.RendererStateLog WHERE seq <= {compacted_log_seq}"
+      yield f"""
+INSERT INTO disk.RendererStateLog
+SELECT * FROM main.RendererStateLog WHERE seq > {synced_log_seq}"""
+
+    def Save():
+      db: sqlite3.Connection = conn._conn
+      db.execute("ATTACH DATABASE ? AS disk", (path,))
+      try:
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS DirtyUid(uid TEXT PRIMARY KEY)")
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS AccessedUid(uid TEXT PRIMARY KEY)")
+        db.execute("""
+CREATE TEMP TABLE IF NOT EXISTS DirtyStateKey(section TEXT, key TEXT, PRIMARY KEY (section, key))
+          """)
+        db.executemany("INSERT INTO temp.DirtyUid(uid) VALUES (?)", ((u,) for u in dirty_uids))
+        db.executemany("INSERT INTO temp.AccessedUid(uid) VALUES (?)",
+                       ((u,) for u in accessed_uids))
+        db.executemany("INSERT INTO temp.DirtyStateKey(section, key) VALUES (?, ?)",
+                       dirty_state_keys)
+        for sql in Statements():
+          db.execute(sql)
+        db.execute("DELETE FROM temp.DirtyUid")
+        db.execute("DELETE FROM temp.AccessedUid")
+        db.execute("DELETE FROM temp.DirtyStateKey")
+        db.commit()
+      except:
+        db.rollback()
+        raise
+      finally:
+        db.execute("DETACH DATABASE disk")
+
+    logging.info("Saving %d changed images and %d state entries to %s", len(dirty_uids),
+                 len(dirty_state_keys), path)
+    try:
+      await conn._execute(Save)
+    except:
+      # Keep the changes around for the next save attempt.
+      self._dirty_uids.update(dirty_uids)
+      self._dirty_state_keys.update(dirty_state_keys)
+      self._replaced_tables.update(replaced_tables)
+      self._accessed_uids.update(accessed_uids)
+      raise
+
+    self._synced_log_seq = max_log_seq
+
+  async def _GetMaxLogSeq(self, conn: aiosqlite.Connection) -> int:
+    async with conn.execute("SELECT COALESCE(MAX(seq), 0) FROM RendererStateLog") as cursor:
+      async for row in cursor:
+        return row[0]
+    return 0
+
+  async def CompactCatalog(
+      self,
+      prune_missing_files: bool = False,
+      progress: Optional[CompactionProgressCallback] = None) -> CompactionResult:
+    """Prunes orphaned previews, then vacuums.
+
+    Previews are pruned from both the in-memory catalog and the file it was
+    last synced with (if any): the file shrinks right away, while changes
+    that weren't saved yet stay unsaved.
+
+    If prune_missing_files is set, images of removed files (along with their
+    labels and ratings) are also removed from the in-memory catalog. Like
+    other changes, that is only written to the catalog file on save.
+
+    The caller holds the DB_WRITE slot.
+    """
+    start = time.monotonic()
+    result = CompactionResult()
+    conn = await self._GetConn()
+
+    def Progress(status: str, p: float):
+      if progress is not None:
+        progress(status, p)
+
+    shards = store_shards.PreviewShardSchemas()
+
+    def GetSize(db: sqlite3.Connection, schemas: List[str]) -> int:
+      # The in-memory catalog's size only matters if there's no catalog file.
+      return sum(self._GetSizes(db, schemas[-1:] + shards))
+
+    async with self._catalog_file_lock:
+      result.size_before = await self._ExecuteOnCatalogFiles(conn, GetSize)
+
+      Progress("Pruning orphaned previews", 0.0)
+      after_rowids: Optional[List[Optional[int]]] = None
+      while True:
+        after_rowids, pruned, done = await self._ExecuteOnCatalogFiles(
+            conn, lambda db, _: self._PruneOrphanedPreviewsBatch(db, shards, after_rowids))
+        result.pruned_previews += sum(pruned)
+        Progress("Pruning orphaned previews", min(done))
+        if all(r is None for r in after_rowids):
+          break
+
+      if prune_missing_files:
+        result.removed_uids = await self._PruneMissingFiles(conn, Progress)
+
+      Progress("Reclaiming free space", 0.0)
+      await self._ExecuteOnCatalogFiles(
+          conn, lambda db, schemas: self._IncrementalVacuum(db, schemas + shards))
+      result.size_after = await self._ExecuteOnCatalogFiles(conn, GetSize)
+      Progress("Reclaiming free space", 1.0)
+
+    self._preview_bytes = None
+    self._next_eviction_at = 0
+    result.elapsed = time.monotonic() - start
+    logging.info("Compacted the catalog in %.2fs: %d previews and %d images pruned, %d bytes reclaimed",
+                 result.elapsed, result.pruned_previews, len(result.removed_uids),
+                 result.bytes_reclaimed)
+    return result
+
+  async def _ExecuteOnCatalogFiles(self, conn: aiosqlite.Connection,
+                                   fn: Callable[[sqlite3.Connection, List[str]], Any]) -> Any:
+    """Runs fn in a single transaction with the synced catalog file attached.
+
+    fn gets the names of the schemas to work on: "main" for the in-memory
+    catalog followed by "disk" for the catalog file, if there is one.
+    """
+    path = self._synced_path if self._synced_path and os.path.exists(self._synced_path) else None
+
+    def Run():
+      db: sqlite3.Connection = conn._conn
+      schemas = ["main"]
+      if path:
+        db.execute("ATTACH DATABASE ? AS disk", (path,))
+        schemas.append("disk")
+      try:
+        result = fn(db, schemas)
+        db.commit()
+        return result
+      except:
+        db.rollback()
+        raise
+      finally:
+        if path:
+          db.execute("DETACH DATABASE disk")
+
+    return await conn._execute(Run)
+
+  @staticmethod
+  def _GetSizes(db: sqlite3.Connection, schemas: List[str]) -> List[int]:
+    result = []
+    for s in schemas:
+      page_count = db.execute(f"PRAGMA {s}.page_count").fetchone()[0]
+      page_size = db.execute(f"PRAGMA {s}.page_size").fetchone()[0]
+      result.append(page_count * page_size)
+    return result
+
+  @staticmethod
+  def _PruneOrphanedPreviewsBatch(
+      db: sqlite3.Connection, shards: List[str], after_rowids: Optional[List[Optional[int]]]
+  ) -> Tuple[List[Optional[int]], List[int], List[float]]:
+    """Prunes previews in the next batch of ImagePreview rows of every shard.
+
+    A preview is orphaned if its image is not in the (in-memory) catalog or
+    if there's a newer preview of the same image and size. Returns the last
+    rowid of every batch (None if a shard has no rows left), the numbers of
+    pruned previews and the fractions of the rows looked at.
+    """
+    last_rowids: List[Optional[int]] = []
+    pruned = []
+    done = []
+    for i, s in enumerate(shards):
+      after_rowid = after_rowids[i] if after_rowids is not None else 0
+      if after_rowid is None:
+        last_rowids.append(None)
+        pruned.append(0)
+        done.append(1.0)
+        continue
+
+      last_rowid = db.execute(
+          f"""
+SELECT MAX(rowid) FROM (SELECT rowid FROM {s}.ImagePreview WHERE rowid > ? ORDER BY rowid LIMIT ?)
+        """, (after_rowid, _COMPACTION_BATCH_SIZE)).fetchone()[0]
+      if last_rowid is None:
+        last_rowids.append(None)
+        pruned.append(0)
+        done.append(1.0)
+        continue
+
+      cursor = db.execute(
+          f"""
+DELETE FROM {s}.ImagePreview AS p
+WHERE p.rowid > ? AND p.rowid <= ? AND (
+  NOT EXISTS (SELECT 1 FROM main.ImageData AS d WHERE d.uid = p.uid) OR
+  EXISTS (SELECT 1 FROM {s}.ImagePreview AS n
+          WHERE n.uid = p.uid AND n.width = p.width AND n.height = p.height AND n.rowid > p.rowid))
+        """, (after_rowid, last_rowid))
+      max_rowid = db.execute(f"SELECT MAX(rowid) FROM {s}.ImagePreview").fetchone()[0]
+
+      last_rowids.append(last_rowid)
+      pruned.append(cursor.rowcount)
+      done.append(min(1.0, float(last_rowid) / (max_rowid or last_rowid)))
+
+    return last_rowids, pruned, done
+
+  async def _PruneMissingFiles(self, conn: aiosqlite.Connection,
+                               progress: CompactionProgressCallback) -> List[str]:
+    total = 0
+    async with conn.execute("SELECT COUNT(*) FROM ImageData") as cursor:
+      async for row in cursor:
+        total = row[0]
+
+    loop = asyncio.get_running_loop()
+    removed: List[str] = []
+    checked = 0
+    after_uid = ""
+    progress("Looking for removed files", 0.0)
+    while True:
+      rows: List[Tuple[str, str]] = []
+      async with conn.execute("SELECT uid, path FROM ImageData WHERE uid > ? ORDER BY uid LIMIT ?",
+                              (after_uid, _COMPACTION_BATCH_SIZE)) as cursor:
+        async for row in cursor:
+          rows.append((row[0], row[1]))
+      if not rows:
+        break
+
+      after_uid = rows[-1][0]
+      checked += len(rows)
+      missing = await loop.run_in_executor(None, _FindMissingFiles, rows)
+      if missing:
+        for sql, params in _PruneImageStatements(missing):
+          await conn.execute(sql, params)
+        await conn.commit()
+        self._dirty_uids.update(missing)
+        self._AppendToJournal([store_journal.RECORD_PRUNE, missing])
+        removed.extend(missing)
+
+      progress("Looking for removed files", float(checked) / (total or 1))
+
+    return removed
+
+  @staticmethod
+  def _IncrementalVacuum(db: sqlite3.Connection, schemas: List[str]) -> None:
+    for s in schemas:
+      freelist_count = db.execute(f"PRAGMA {s}.freelist_count").fetchone()[0]
+      logging.info("Vacuuming %s: %d free pages", s, freelist_count)
+      # Every step of the statement frees some pages: the rows have to be
+      # fetched for it to run to completion.
+      db.execute(f"PRAGMA {s}.incremental_vacuum").fetchall()
+
+  async def ReplaceStateFromJSON(self, state: Dict[str, Any]) -> None:
+    """Replaces the saved renderer state with a whole state (see ReplaceState)."""
+
+    async def Changes():
+      for change in store_state.ExplodeState(state):
+        yield change
+
+    await self.ReplaceState(Changes())
+
+  async def ReplaceState(self, changes: AsyncIterable[store_state.StateChange]) -> None:
+    """Replaces the saved renderer state with the given entries.
+
+    Entries are written to temporary staging tables as they come, so the
+    state doesn't have to be held in memory. The staged state replaces the
+    current one in a single transaction once all the entries are written.
+    The DB_WRITE slot is only held while writing, not while waiting for
+    entries. It's always taken after the replacement lock: callers must not
+    hold it.
+    """
+    async with self._replace_state_lock:
+      conn = await self._GetConn()
+      try:
+        await self._StageState(conn, changes)
+      except BaseException:
+        # Nothing but the staging tables was written to.
+        async with self._WriteSlot():
+          await conn.execute("DELETE FROM temp.StagedStateEntry")
+          await conn.execute("DELETE FROM temp.StagedImageMetadata")
+          await conn.commit()
+        raise
+
+      metadata_columns = ", ".join(store_metadata.COLUMNS)
+      async with self._WriteSlot():
+        await conn.execute("DELETE FROM RendererStateEntry")
+        await conn.execute("DELETE FROM RendererStateLog")
+        await conn.execute("INSERT INTO RendererStateEntry SELECT * FROM temp.StagedStateEntry")
+        await conn.execute("DELETE FROM ImageMetadata")
+        await conn.execute(f"""
+INSERT INTO ImageMetadata(uid, {metadata_columns})
+SELECT uid, {metadata_columns} FROM temp.StagedImageMetadata
+          """)
+        await conn.execute("DELETE FROM temp.StagedStateEntry")
+        await conn.execute("DELETE FROM temp.StagedImageMetadata")
+        await conn.commit()
+
+      self._replaced_tables.add("RendererStateEntry")
+      self._replaced_tables.add("ImageMetadata")
+
+  async def _StageState(self, conn: aiosqlite.Connection,
+                        changes: AsyncIterable[store_state.StateChange]) -> None:
+    """Writes state entries to the staging tables, a batch at a time.
+
+    Raises store_state.InvalidStateChangeError or
+    store_metadata.InvalidMetadataUpdateError on malformed entries.
+    """
+    metadata_columns = ", ".join(store_metadata.COLUMNS)
+    async with self._WriteSlot():
+      await conn.executescript(f"""
+CREATE TEMP TABLE IF NOT EXISTS StagedStateEntry (
+  section TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value BLOB NOT NULL,
+  PRIMARY KEY (section, key)
+);
+CREATE TEMP TABLE IF NOT EXISTS StagedImageMetadata (
+  uid TEXT PRIMARY KEY,
+  {", ".join(c + " INTEGER" for c in store_metadata.COLUMNS)}
+);
+DELETE FROM temp.StagedStateEntry;
+DELETE FROM temp.StagedImageMetadata;
+      """)
+
+    entries: List[store_state.StateChange] = []
+    metadata: List[Tuple[Any, ...]] = []
+
+    async def Flush():
+      # Committed right away, so that no transaction is left open while
+      # waiting for more entries.
+      async with self._WriteSlot():
+        await conn.executemany(
+            "INSERT OR REPLACE INTO temp.StagedStateEntry(section, key, value) VALUES (?, ?, ?)",
+            entries)
+        await conn.executemany(
+            f"INSERT OR REPLACE INTO temp.StagedImageMetadata(uid, {metadata_columns}) "
+            "VALUES (?, ?, ?, ?, ?, ?)", metadata)
+        await conn.commit()
+      entries.clear()
+      metadata.clear()
+
+    # Per-image metadata is kept in ImageMetadata, not in the state entries.
+    async for section, key, value in changes:
+      if value is None:
+        continue
+      if section == "metadata":
+        metadata.append((key,) + store_metadata.RowFromJSON(json.loads(value)))
+      else:
+        entries.append((section, key, value))
+      if len(entries) + len(metadata) >= _STATE_STAGING_BATCH_SIZE:
+        await Flush()
+    await Flush()
+
+
+  async def AppendStatePatch(self, patch: Dict[str, Any]) -> None:
+    conn = await self._GetConn()
+    async with self._WriteSlot():
+      await self._ApplyStatePatch(conn, patch)
+      self._AppendToJournal([store_journal.RECORD_STATE_PATCH, store_state.Dumps(patch)])
+
+  async def _ApplyStatePatch(self, conn: aiosqlite.Connection, patch: Dict[str, Any]) -> None:
+    patch = dict(patch)
+    await self._UpdateImageMetadata(conn, patch.pop("metadata", None) or {})
+    if patch:
+      await conn.execute("INSERT INTO RendererStateLog(patch) VALUES (?)",
+                         (store_state.Dumps(patch),))
+    await conn.commit()
+
+    async with conn.execute("SELECT COUNT(*) FROM RendererStateLog") as cursor:
+      async for row in cursor:
+        if row[0] > STATE_LOG_COMPACTION_THRESHOLD:
+          await self._CompactStateLog(conn)
+
+  async def _CompactStateLog(self, conn: aiosqlite.Connection) -> None:
+    latest: Dict[Tuple[str, str], Optional[bytes]] = {}
+    last_seq = 0
+    async with conn.execute("SELECT seq, patch FROM RendererStateLog ORDER BY seq") as cursor:
+      async for row in cursor:
+        last_seq = row[0]
+        for section, key, value in store_state.ExplodeState(json.loads(row[1])):
+          latest[(section, key)] = value
+
+    await conn.executemany("DELETE FROM RendererStateEntry WHERE section = ? AND key = ?",
+                           (k for k, v in latest.items() if v is None))
+    await conn.executemany(
+        "INSERT OR REPLACE INTO RendererStateEntry(section, key, value) VALUES (?, ?, ?)",
+        (k + (v,) for k, v in latest.items() if v is not None))
+    await conn.execute("DELETE FROM RendererStateLog WHERE seq <= ?", (last_seq,))
+    await conn.commit()
+
+    logging.info("Compacted renderer state log up to %d (%d entries)", last_seq, len(latest))
+    self._compacted_log_seq = last_seq
+    self._dirty_state_keys.update(latest.keys())
+
+  async def _UpdateImageMetadata(self, conn: aiosqlite.Connection,
+                                 metadata: Dict[str, Any]) -> None:
+    await conn.executemany("DELETE FROM ImageMetadata WHERE uid = ?",
+                           ((uid,) for uid, m in metadata.items() if m is None))
+    await conn.executemany(
+        f"INSERT OR REPLACE INTO ImageMetadata(uid, {', '.join(store_metadata.COLUMNS)}) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((uid,) + store_metadata.RowFromJSON(m) for uid, m in metadata.items() if m is not None))
+    self._dirty_uids.update(metadata.keys())
+
+  async def UpdateImageMetadata(self, update: store_metadata.MetadataUpdate) -> int:
+    conn = await self._GetConn()
+    async with self._WriteSlot():
+      updated = await self._ApplyMetadataUpdate(conn, update)
+      self._AppendToJournal([store_journal.RECORD_METADATA_UPDATE, update.uids, update.Values()])
+    return updated
+
+  async def _ApplyMetadataUpdate(self, conn: aiosqlite.Connection,
+                                 update: store_metadata.MetadataUpdate) -> int:
+    sql, params = store_metadata.BuildUpdate(update)
+    async with conn.execute(sql, params) as cursor:
+      updated = cursor.rowcount
+    await conn.commit()
+
+    self._dirty_uids.update(update.uids)
+    return updated
+
+  async def GetImageMetadata(self) -> Dict[str, Any]:
+    conn = await self._GetConn()
+    result = {}
+    async with conn.execute(
+        f"SELECT uid, {', '.join(store_metadata.COLUMNS)} FROM ImageMetadata") as cursor:
+      async for row in cursor:
+        result[row[0]] = store_metadata.RowToJSON(tuple(row[1:]))
+    return result
+
+  async def ReadMetadataByPath(self, paths: List[str]) -> Dict[str, store_metadata.MetadataRow]:
+    """Returns ImageMetadata rows of the images at paths, if they have one."""
+    conn = await self._GetConn()
+    result = {}
+    async with conn.execute(
+        f"""
+SELECT d.path, {', '.join('m.' + c for c in store_metadata.COLUMNS)}
+FROM ImageData AS d JOIN ImageMetadata AS m ON m.uid = d.uid
+WHERE d.path IN (SELECT value FROM json_each(?))
+      """, (json.dumps(paths),)) as cursor:
+      async for row in cursor:
+        result[row[0]] = cast(store_metadata.MetadataRow, tuple(row[1:]))
+    return result
+
+  async def QueryImages(self, query: store_query.ImageQuery) -> store_query.QueryResult:
+    conn = await self._GetConn()
+    count_sql, page_sql, params = store_query.BuildQuery(query)
+
+    total = 0
+    async with conn.execute(count_sql, params) as cursor:
+      async for row in cursor:
+        total = row[0]
+
+    uids = []
+    async with conn.execute(page_sql, params + [query.limit, query.offset]) as cursor:
+      async for row in cursor:
+        uids.append(row[0])
+
+    return store_query.QueryResult(total=total, uids=uids)
 
   async def GetSchema(self) -> str:
     conn = await self._GetConn()
@@ -136,14 +957,120 @@ VALUES ('state', ?)
 
     return "\n".join(result)
 
-  async def GetSavedState(self) -> Optional[Dict[Any, Any]]:
+  async def GetSavedState(self) -> Optional[Dict[str, Any]]:
+    conn = await self._GetConn()
+
+    changes: List[store_state.StateChange] = []
+    async with conn.execute("SELECT section, key, value FROM RendererStateEntry") as cursor:
+      async for row in cursor:
+        changes.append((row[0], row[1], row[2]))
+    async with conn.execute("SELECT patch FROM RendererStateLog ORDER BY seq") as cursor:
+      async for row in cursor:
+        changes.extend(store_state.ExplodeState(json.loads(row[0])))
+
+    state = store_state.AssembleState(changes)
+    if state is not None:
+      state["metadata"] = await self.GetImageMetadata()
+    return state
+
+  async def StreamSavedState(self) -> AsyncIterator[bytes]:
+    """Yields {"state": <saved state or null>} JSON in small pieces.
+
+    Stored entry values are already JSON and are copied as they are, so the
+    state is never fully materialized in memory.
+    """
+    conn = await self._GetConn()
+    async with conn.execute("SELECT EXISTS(SELECT 1 FROM RendererStateLog)") as cursor:
+      async for row in cursor:
+        if row[0]:
+          async with self._WriteSlot():
+            await self._CompactStateLog(conn)
+
+    async with conn.execute("SELECT EXISTS(SELECT 1 FROM RendererStateEntry)") as cursor:
+      async for row in cursor:
+        has_state = row[0]
+    if not has_state:
+      yield b'{"state":null}'
+      return
+
+    yield b'{"state":{'
+    async with conn.execute(
+        "SELECT key, value FROM RendererStateEntry WHERE section = ? ORDER BY key",
+        (store_state.SCALARS_SECTION,)) as cursor:
+      async for row in cursor:
+        yield store_state.Dumps(row[0]) + b":" + row[1] + b","
+
+    for i, section in enumerate(sorted(store_state.COLLECTIONS)):
+      yield (b"," if i else b"") + store_state.Dumps(section) + b":{"
+      if section == "metadata":
+        query = f"SELECT uid, {', '.join(store_metadata.COLUMNS)} FROM ImageMetadata ORDER BY uid"
+        args: Tuple[Any, ...] = ()
+      else:
+        query = "SELECT key, value FROM RendererStateEntry WHERE section = ? ORDER BY key"
+        args = (section,)
+
+      sep = b""
+      async with conn.execute(query, args) as cursor:
+        async for row in cursor:
+          if section == "metadata":
+            value = store_state.Dumps(store_metadata.RowToJSON(tuple(row[1:])))
+          else:
+            value = row[1]
+          yield sep + store_state.Dumps(row[0]) + b":" + value
+          sep = b","
+      yield b"}"
+    yield b"}}"
+
+  async def _WriteImageData(self, conn: aiosqlite.Connection,
+                            image_file: store_schema.ImageFile) -> None:
+    serialized = store_codec.Encode(image_file)
+
+    # An upsert (as opposed to INSERT OR REPLACE) updates the row in place
+    # instead of deleting and re-inserting it.
+    columns = ("uid", "path", "info") + store_image_data.COLUMNS
+    await conn.execute(
+        f"""
+INSERT INTO ImageData({", ".join(columns)})
+VALUES ({", ".join("?" for _ in columns)})
+ON CONFLICT(uid) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in columns[1:])}
+      """, (image_file.uid, str(image_file.path), serialized) + store_image_data.IndexedColumns(image_file))
+
+    await conn.execute("INSERT OR IGNORE INTO ImageSearchDoc(uid) VALUES (?)", (image_file.uid,))
+    await conn.execute(
+        """
+INSERT OR REPLACE INTO ImageSearch(rowid, path, name, make, model, software, icc_profile_description)
+SELECT id, ?, ?, ?, ?, ?, ? FROM ImageSearchDoc WHERE uid = ?
+      """, (
+            os.path.dirname(image_file.path),
+            os.path.basename(image_file.path),
+            image_file.exif_data.make,
+            image_file.exif_data.model,
+            image_file.exif_data.software,
+            image_file.icc_profile_description,
+            image_file.uid,
+        ))
+    self._dirty_uids.add(image_file.uid)
+
+  async def SearchImages(self, query: store_query.SearchQuery) -> store_query.SearchResult:
+    match = store_query.BuildMatchExpression(query.text)
+    if not match:
+      return store_query.SearchResult(uids=[], has_more=False)
+
     conn = await self._GetConn()
-    cur_state = None
-    async with conn.execute("SELECT blob FROM RendererState", []) as cursor:
+    uids = []
+    # Fetch one extra row to find out whether there's a next page.
+    async with conn.execute(
+        f"""
+SELECT doc.uid FROM ImageSearch
+JOIN ImageSearchDoc AS doc ON doc.id = ImageSearch.rowid
+WHERE ImageSearch MATCH ?
+ORDER BY bm25(ImageSearch, {", ".join(str(w) for w in store_query.SEARCH_COLUMN_WEIGHTS)})
+LIMIT ? OFFSET ?
+      """, (match, query.limit + 1, query.offset)) as cursor:
       async for row in cursor:
-        cur_state = bson.loads(row[0])
+        uids.append(row[0])
 
-    return cast(Optional[Dict[Any, Any]], cur_state)
+    return store_query.SearchResult(uids=uids[:query.limit], has_more=len(uids) > query.limit)
 
   async def RegisterFile(self, path: pathlib.Path) -> store_schema.ImageFile:
     loop = asyncio.get_running_loop()
@@ -153,26 +1080,44 @@ VALUES ('state', ?)
     async with conn.execute("SELECT info FROM ImageData WHERE path = ?",
                             (str(path),)) as cursor:
       async for row in cursor:
-        prev_info = store_schema.ImageFile.FromJSON(bson.loads(row[0]))
-
-    result, preview_bytes = await image_processor.IMAGE_PROCESSOR.GetFileInfo(path, prev_info)
-    serialized = bson.dumps(result.ToJSON())
-
-    await conn.execute_insert(
-        """
-INSERT OR REPLACE INTO ImageData(uid, path, info)
-VALUES (?, ?, ?)
-      """, (result.uid, str(result.path), serialized))
-    if result.previews:
-      await conn.execute_insert(
-          """
-  INSERT OR REPLACE INTO ImagePreview(uid, width, height, blob)
-  VALUES (?, ?, ?, ?)
-        """, (result.uid, result.previews[0].preview_size.width, result.previews[0].preview_size.height, preview_bytes))      
-    await conn.commit()
+        prev_info = store_codec.Decode(row[0])
+
+    async with scheduler.SCHEDULER.Acquire(scheduler.Resource.DISK_IO):
+      result, preview_bytes = await image_processor.IMAGE_PROCESSOR.GetFileInfo(path, prev_info)
+
+    async with self._WriteSlot():
+      await self._WriteImageData(conn, result)
+      previews = None
+      if result.previews:
+        previews = [(result.previews[0].preview_size.width,
+                     result.previews[0].preview_size.height, preview_bytes)]
+        await self._WritePreviews(conn, result.uid, previews)
+      await conn.commit()
+      # Previews are already in their shard, or get rendered again when read.
+      self._AppendToJournal([store_journal.RECORD_IMAGE, store_codec.Encode(result), None])
+      await self._EnforcePreviewBudget(conn, result.uid)
 
     return result
 
+  async def _WritePreviews(self, conn: aiosqlite.Connection, uid: str,
+                           previews: List[Tuple[int, int, bytes]]) -> None:
+    shard = store_shards.PreviewShardOf(uid)
+    if self._preview_bytes is not None:
+      async with conn.execute(
+          f"SELECT COALESCE(SUM(length(blob)), 0) FROM {shard}.ImagePreview WHERE uid = ?",
+          (uid,)) as cursor:
+        async for row in cursor:
+          self._preview_bytes -= row[0]
+      self._preview_bytes += sum(len(p[2]) for p in previews)
+
+    await conn.execute(f"""
+    DELETE FROM {shard}.ImagePreview WHERE uid = ?
+    """, (uid,))
+    await conn.executemany(f"""
+    INSERT INTO {shard}.ImagePreview(uid, width, height, blob)
+    VALUES (?, ?, ?, ?)
+      """, ((uid,) + tuple(p) for p in previews))
+
   async def MoveFile(self, src: pathlib.Path, dest: pathlib.Path) -> store_schema.ImageFile:
     conn = await self._GetConn()
 
@@ -192,8 +1137,7 @@ VALUES (?, ?, ?)
                             (str(src),)) as cursor:
       async for row in cursor:
         uid = row[0]
-        data = bson.loads(row[1])
-        image_file = store_schema.ImageFile.FromJSON(data)
+        image_file = store_codec.Decode(row[1])
 
     logging.info(f"Moving file (uid={uid}): {src} -> {dest}")
     if image_file is None:
@@ -202,62 +1146,251 @@ VALUES (?, ?, ?)
     else:
       os.rename(src, dest)
       image_file.path = str(dest)
-      serialized = bson.dumps(image_file.ToJSON())
-      await conn.execute_insert("UPDATE ImageData SET path = ?, info = ? WHERE uid = ?", (
-          str(dest),
-          serialized,
-          uid,
-      ))
-      await conn.commit()
+      async with self._WriteSlot():
+        await self._WriteImageData(conn, image_file)
+        await conn.commit()
+        self._AppendToJournal([store_journal.RECORD_IMAGE, store_codec.Encode(image_file), None])
       return image_file
 
   async def UpdateFileThumbnail(self, uid: str):
     image_file = await self.ReadFileInfo(uid)
 
-    updated_image_file, preview_blobs = await image_processor.IMAGE_PROCESSOR.ThumbnailFile(image_file)
-    serialized = bson.dumps(updated_image_file.ToJSON())
+    cache = preview_cache.PREVIEW_CACHE
+    cache_key = await cache.Key(image_file) if cache is not None else None
+    cached = None
+    if cache is not None and cache_key is not None:
+      cached = await cache.Get(cache_key, image_file)
+
+    if cached is not None:
+      updated_image_file, preview_blobs = cached
+    else:
+      async with scheduler.SCHEDULER.Acquire(scheduler.Resource.CPU_DECODE):
+        updated_image_file, preview_blobs = await image_processor.IMAGE_PROCESSOR.ThumbnailFile(
+            image_file)
+      if cache is not None and cache_key is not None:
+        await cache.Put(cache_key, updated_image_file, preview_blobs)
 
     conn = await self._GetConn()
-    await conn.execute_insert("""
-UPDATE ImageData
-SET info=?
-WHERE uid=?
-      """, (serialized, uid))
-
-    await conn.execute("""
-    DELETE FROM ImagePreview WHERE uid = ?
-    """, (uid,))
-    for p, p_blob in zip(updated_image_file.previews, preview_blobs):
-      await conn.execute_insert("""
-      INSERT INTO ImagePreview(uid, width, height, blob)
-      VALUES (?, ?, ?, ?)
-        """, (uid, p.preview_size.width, p.preview_size.height, p_blob))
+    async with self._WriteSlot():
+      await self._WriteImageData(conn, updated_image_file)
 
-    await conn.commit()
+      previews = [(p.preview_size.width, p.preview_size.height, p_blob)
+                  for p, p_blob in zip(updated_image_file.previews, preview_blobs)]
+      await self._WritePreviews(conn, uid, previews)
+      # Rendering the thumbnail finishes its job, if there's one.
+      done_job = store_jobs.ThumbnailJob(uid, state=store_jobs.DONE)
+      job_finished = await self._WriteThumbnailJob(conn, done_job)
+
+      await conn.commit()
+      self._AppendToJournal(
+          [store_journal.RECORD_IMAGE, store_codec.Encode(updated_image_file), None])
+      if job_finished:
+        self._AppendToJournal(_ThumbnailJobRecord(done_job))
+      await self._EnforcePreviewBudget(conn, uid)
 
     return updated_image_file
 
+  async def _WriteThumbnailJob(self, conn: aiosqlite.Connection,
+                               job: store_jobs.ThumbnailJob) -> bool:
+    """Writes the job, deleting it if it's done. Returns whether anything changed."""
+    if job.state == store_jobs.DONE:
+      async with conn.execute("DELETE FROM ThumbnailJob WHERE uid = ?", (job.uid,)) as cursor:
+        if cursor.rowcount <= 0:
+          return False
+    else:
+      await conn.execute(
+          """
+INSERT OR REPLACE INTO ThumbnailJob(uid, state, attempts, next_attempt_at, error)
+VALUES (?, ?, ?, ?, ?)
+        """, (job.uid, job.state, job.attempts, job.next_attempt_at, job.error))
+    self._dirty_uids.add(job.uid)
+    return True
+
+  async def WriteThumbnailJobs(self, jobs: List[store_jobs.ThumbnailJob]) -> None:
+    conn = await self._GetConn()
+    async with self._WriteSlot():
+      for job in jobs:
+        await self._WriteThumbnailJob(conn, job)
+      await conn.commit()
+    for job in jobs:
+      self._AppendToJournal(_ThumbnailJobRecord(job))
+
+  async def ReadThumbnailJobs(self, states: List[str]) -> List[store_jobs.ThumbnailJob]:
+    """Returns jobs in any of the states, in the order they were added in."""
+    conn = await self._GetConn()
+    result = []
+    async with conn.execute(
+        """
+SELECT uid, state, attempts, next_attempt_at, error FROM ThumbnailJob
+WHERE state IN (SELECT value FROM json_each(?))
+ORDER BY rowid
+      """, (json.dumps(states),)) as cursor:
+      async for row in cursor:
+        result.append(store_jobs.ThumbnailJob(*row))
+    return result
+
   async def ReadFileInfo(self, uid: str) -> store_schema.ImageFile:
     conn = await self._GetConn()
     async with conn.execute("SELECT info FROM ImageData WHERE uid = ?", (uid,)) as cursor:
       async for row in cursor:
-        data = bson.loads(row[0])
-        return store_schema.ImageFile.FromJSON(data)
+        return store_codec.Decode(row[0])
 
     raise NotFoundError(uid)
 
-  async def ReadFileBlob(self, uid: str):
+  async def ReadFileInfos(self, uids: List[str]) -> List[store_schema.ImageFile]:
+    """Reads infos of the given images in the given order, skipping unknown uids."""
     conn = await self._GetConn()
-    async with conn.execute("SELECT blob FROM ImagePreview WHERE uid = ? LIMIT 1", (uid,)) as cursor:
+    result = []
+    async with conn.execute(
+        """
+SELECT ImageData.info FROM json_each(?) AS u
+JOIN ImageData ON ImageData.uid = u.value
+ORDER BY u.key
+      """, (json.dumps(uids),)) as cursor:
       async for row in cursor:
-        return io.BytesIO(row[0])
+        result.append(store_codec.Decode(row[0]))
+    return result
 
-    raise NotFoundError(uid)
+  async def ReadFileBlob(self, uid: str, max_size: Optional[int] = None) -> io.BytesIO:
+    """Reads the smallest preview at least max_size big (the largest by default).
+
+    Previews evicted to stay within the preview budget are rendered again.
+    """
+    image_file = await self.ReadFileInfo(uid)
+
+    conn = await self._GetConn()
+    if self._preview_budget:
+      # Marks the preview as recently used before it's (possibly) rendered,
+      # so that it's not evicted right away.
+      self._pending_accesses[uid] = int(time.time() * 1000)
+
+    blob = await self._ReadPreview(conn, uid, _PickPreview(image_file.previews, max_size))
+    if blob is None and image_file.previews:
+      image_file = await self._RegeneratePreviews(image_file)
+      blob = await self._ReadPreview(conn, uid, _PickPreview(image_file.previews, max_size))
+    if blob is None:
+      # The largest preview there is, if any.
+      blob = await self._ReadPreview(conn, uid, None)
+    if blob is None:
+      raise NotFoundError(uid)
+
+    return io.BytesIO(blob)
+
+  async def _ReadPreview(self, conn: aiosqlite.Connection, uid: str,
+                         size: Optional[store_schema.Size]) -> Optional[bytes]:
+    shard = store_shards.PreviewShardOf(uid)
+    if size is None:
+      query = f"SELECT blob FROM {shard}.ImagePreview WHERE uid = ? ORDER BY width * height DESC LIMIT 1"
+      params: Tuple[Any, ...] = (uid,)
+    else:
+      query = f"SELECT blob FROM {shard}.ImagePreview WHERE uid = ? AND width = ? AND height = ? LIMIT 1"
+      params = (uid, size.width, size.height)
+
+    async with conn.execute(query, params) as cursor:
+      async for row in cursor:
+        return row[0]
+    return None
+
+  async def _RegeneratePreviews(self, image_file: store_schema.ImageFile) -> store_schema.ImageFile:
+    uid = image_file.uid
+    future = self._regenerating.get(uid)
+    if future is None:
+      logging.info("Rendering evicted previews of %s", image_file.path)
+      future = asyncio.ensure_future(self.UpdateFileThumbnail(uid))
+      self._regenerating[uid] = future
+      future.add_done_callback(lambda _: self._regenerating.pop(uid, None))
+
+    try:
+      return await asyncio.shield(future)
+    except Exception as e:
+      logging.warning("Failed to render previews of %s: %s", image_file.path, e)
+      return image_file
+
+  async def _GetPreviewBytes(self, conn: aiosqlite.Connection) -> int:
+    if self._preview_bytes is None:
+      async with conn.execute("SELECT COALESCE(SUM(length(blob)), 0) FROM ImagePreview") as cursor:
+        async for row in cursor:
+          self._preview_bytes = row[0]
+    return self._preview_bytes or 0
+
+  async def _FlushPreviewAccesses(self, conn: aiosqlite.Connection) -> None:
+    """Writes pending preview accesses. The caller holds the DB_WRITE slot."""
+    if not self._pending_accesses:
+      return
+
+    accesses, self._pending_accesses = self._pending_accesses, {}
+    await conn.executemany("INSERT OR REPLACE INTO PreviewAccess(uid, accessed_at) VALUES (?, ?)",
+                           accesses.items())
+    await conn.commit()
+    self._accessed_uids.update(accesses)
+
+  async def _EnforcePreviewBudget(self, conn: aiosqlite.Connection, written_uid: str) -> None:
+    """Evicts previews when over the budget, except for the ones just written.
+
+    The caller holds the DB_WRITE slot.
+    """
+    if not self._preview_budget:
+      return
+
+    total = await self._GetPreviewBytes(conn)
+    if total <= max(self._preview_budget, self._next_eviction_at):
+      return
+
+    await self._FlushPreviewAccesses(conn)
+    target = int(self._preview_budget * _PREVIEW_BUDGET_LOW_WATERMARK)
+    # Every preview except for the smallest one of each image is a candidate:
+    # never viewed images go first, then the least recently viewed ones,
+    # larger tiers first.
+    candidates = " UNION ALL ".join(f"""
+SELECT '{s}' AS shard, p.rowid AS id, p.uid AS uid, length(p.blob) AS size,
+       p.width * p.height AS area
+FROM {s}.ImagePreview AS p
+JOIN (SELECT uid, MIN(width * height) AS min_area FROM {s}.ImagePreview GROUP BY uid) AS m
+  ON m.uid = p.uid
+WHERE p.uid != ?1 AND p.width * p.height > m.min_area
+      """ for s in store_shards.PreviewShardSchemas())
+
+    num_evicted = 0
+    uids: Set[str] = set()
+    while total > target:
+      evicted: Dict[str, List[Tuple[int]]] = {}
+      async with conn.execute(
+          f"""
+SELECT c.shard, c.id, c.uid, c.size FROM ({candidates}) AS c
+LEFT JOIN PreviewAccess AS a ON a.uid = c.uid
+ORDER BY COALESCE(a.accessed_at, 0), c.area DESC
+LIMIT ?2
+        """, (written_uid, _PREVIEW_EVICTION_BATCH_SIZE)) as cursor:
+        async for row in cursor:
+          if total <= target:
+            break
+          evicted.setdefault(row[0], []).append((row[1],))
+          uids.add(row[2])
+          total -= row[3]
+      if not evicted:
+        break
+
+      for shard, rowids in evicted.items():
+        await conn.executemany(f"DELETE FROM {shard}.ImagePreview WHERE rowid = ?", rowids)
+        num_evicted += len(rowids)
+      await conn.commit()
+      self._preview_bytes = total
+
+    if total > target:
+      self._next_eviction_at = total + int(self._preview_budget *
+                                           (1 - _PREVIEW_BUDGET_LOW_WATERMARK))
+      logging.info("Previews take %d bytes, over the budget of %d, but no more can be evicted",
+                   total, self._preview_budget)
+    else:
+      self._next_eviction_at = 0
+    if num_evicted:
+      logging.info("Evicted %d previews of %d images, previews now take %d bytes", num_evicted,
+                   len(uids), total)
 
 
 DATA_STORE: DataStore
 
 
-def InitDataStore(path: Optional[pathlib.Path] = None) -> None:
+def InitDataStore(path: Optional[pathlib.Path] = None, preview_budget: int = 0) -> None:
   global DATA_STORE
-  DATA_STORE = DataStore(path)
+  DATA_STORE = DataStore(path, preview_budget=preview_budget)
@@ -0,0 +1,256 @@
+import abc
+import dataclasses
+import datetime
+import enum
+import fractions
+import itertools
+import typing
+from typing import Any, Callable, Collection, Dict, Tuple, Type
+
+import msgpack
+
+from newmedia import store_schema
+
+
+class Error(Exception):
+  pass
+
+
+class UnsupportedFormatError(Error):
+  pass
+
+
+EncodeFn = Callable[[Any], Any]
+DecodeFn = Callable[[Any], Any]
+
+_DATETIME_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _EncodeDateTime(v: datetime.datetime) -> int:
+  # EXIF timestamps have a 1 second resolution and no timezone.
+  return (v - _DATETIME_EPOCH) // datetime.timedelta(seconds=1)
+
+
+def _DecodeDateTime(v: int) -> datetime.datetime:
+  return _DATETIME_EPOCH + datetime.timedelta(seconds=v)
+
+
+class _Compiler:
+  """Generates positional encode/decode functions for dataclasses.
+
+  A record is encoded as a tuple of its field values in declaration order,
+  with nested dataclasses, enums, datetimes and fractions converted to
+  msgpack-friendly primitives. The functions are generated from the type
+  hints once, so encoding/decoding doesn't need any per-field introspection.
+
+  Classes passed as "sparse" (all their fields must be optional) are encoded
+  as a {field index: value} map containing only non-None fields instead.
+  """
+
+  def __init__(self, sparse: Collection[type] = ()):
+    self._sparse = frozenset(sparse)
+    self._namespace: Dict[str, Any] = {
+        "_EncodeDateTime": _EncodeDateTime,
+        "_DecodeDateTime": _DecodeDateTime,
+        "_Fraction": fractions.Fraction,
+    }
+    self._compiled: Dict[type, Tuple[EncodeFn, DecodeFn]] = {}
+    self._var_counter = itertools.count()
+
+  def _Var(self) -> str:
+    return f"_v{next(self._var_counter)}"
+
+  def _EncodeExpr(self, tp: Any, v: str) -> str:
+    origin = typing.get_origin(tp)
+    args = typing.get_args(tp)
+
+    if origin is typing.Union:
+      (inner,) = [a for a in args if a is not type(None)]
+      return f"(None if {v} is None else {self._EncodeExpr(inner, v)})"
+    elif origin is list or origin is tuple:
+      i = self._Var()
+      return f"[{self._EncodeExpr(args[0], i)} for {i} in {v}]"
+    elif dataclasses.is_dataclass(tp):
+      self.Compile(tp)
+      return f"_enc_{tp.__name__}({v})"
+    elif isinstance(tp, type) and issubclass(tp, enum.IntEnum):
+      return f"int({v})"
+    elif tp is datetime.datetime:
+      return f"_EncodeDateTime({v})"
+    elif tp is fractions.Fraction:
+      return f"({v}.numerator, {v}.denominator)"
+    elif tp in (str, int, float, bool):
+      return v
+    else:
+      raise TypeError(f"Unsupported field type: {tp}")
+
+  def _DecodeExpr(self, tp: Any, v: str) -> str:
+    origin = typing.get_origin(tp)
+    args = typing.get_args(tp)
+
+    if origin is typing.Union:
+      (inner,) = [a for a in args if a is not type(None)]
+      return f"(None if {v} is None else {self._DecodeExpr(inner, v)})"
+    elif origin is list:
+      i = self._Var()
+      return f"[{self._DecodeExpr(args[0], i)} for {i} in {v}]"
+    elif origin is tuple:
+      i = self._Var()
+      return f"tuple({self._DecodeExpr(args[0], i)} for {i} in {v})"
+    elif dataclasses.is_dataclass(tp):
+      self.Compile(tp)
+      return f"_dec_{tp.__name__}({v})"
+    elif isinstance(tp, type) and issubclass(tp, enum.IntEnum):
+      self._namespace[f"_enum_{tp.__name__}"] = {m.value: m for m in tp}
+      return f"_enum_{tp.__name__}[{v}]"
+    elif tp is datetime.datetime:
+      return f"_DecodeDateTime({v})"
+    elif tp is fractions.Fraction:
+      return f"_Fraction({v}[0], {v}[1])"
+    elif tp in (str, int, float, bool):
+      return v
+    else:
+      raise TypeError(f"Unsupported field type: {tp}")
+
+  def _SparseSource(self, cls: Type[Any], hints: Dict[str, Any],
+                    fields: Tuple[dataclasses.Field, ...]) -> str:
+    name = cls.__name__
+    self._namespace[f"_names_{name}"] = tuple(f.name for f in fields)
+
+    encode_lines = [f"def _enc_{name}(o):", "  r = {}"]
+    decode_lines = [
+        f"def _dec_{name}(d):",
+        f"  o = _cls_{name}(**{{_names_{name}[k]: v for k, v in d.items()}})",
+    ]
+    for i, f in enumerate(fields):
+      if f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING:
+        raise TypeError(f"Sparse class field {name}.{f.name} has no default value")
+
+      tp = _StripOptional(hints[f.name])
+      encode_lines += [
+          f"  v = o.{f.name}",
+          f"  if v is not None: r[{i}] = {self._EncodeExpr(tp, 'v')}",
+      ]
+      # Fields that decode to themselves are already set by the constructor.
+      decode_expr = self._DecodeExpr(tp, "v")
+      if decode_expr != "v":
+        decode_lines += [
+            f"  v = o.{f.name}",
+            f"  if v is not None: o.{f.name} = {decode_expr}",
+        ]
+    encode_lines.append("  return r")
+    decode_lines.append("  return o")
+
+    return "\n".join(encode_lines + decode_lines)
+
+  def Compile(self, cls: Type[Any]) -> Tuple[EncodeFn, DecodeFn]:
+    if cls in self._compiled:
+      return self._compiled[cls]
+
+    name = cls.__name__
+    hints = typing.get_type_hints(cls)
+    fields = dataclasses.fields(cls)
+
+    self._namespace[f"_cls_{name}"] = cls
+    if cls in self._sparse:
+      source = self._SparseSource(cls, hints, fields)
+    else:
+      encode_items = [self._EncodeExpr(hints[f.name], f"o.{f.name}") for f in fields]
+      decode_items = [self._DecodeExpr(hints[f.name], f"d[{i}]") for i, f in enumerate(fields)]
+      source = "\n".join([
+          f"def _enc_{name}(o):",
+          f"  return ({', '.join(encode_items)},)",
+          f"def _dec_{name}(d):",
+          f"  return _cls_{name}({', '.join(decode_items)})",
+      ])
+    exec(compile(source, f"<store_codec:{name}>", "exec"), self._namespace)
+
+    result = (self._namespace[f"_enc_{name}"], self._namespace[f"_dec_{name}"])
+    self._compiled[cls] = result
+    return result
+
+
+def _StripOptional(tp: Any) -> Any:
+  if typing.get_origin(tp) is typing.Union:
+    (inner,) = [a for a in typing.get_args(tp) if a is not type(None)]
+    return inner
+  return tp
+
+
+def CompileRecordFunctions(cls: Type[Any],
+                           sparse: Collection[type] = ()) -> Tuple[EncodeFn, DecodeFn]:
+  return _Compiler(sparse=sparse).Compile(cls)
+
+
+class Codec(abc.ABC):
+  """Binary encoding of ImageFile records stored in ImageData.info.
+
+  Every encoded value starts with the codec's one-byte tag, so that rows
+  written by different codecs can coexist in the same catalog.
+  """
+
+  @property
+  @abc.abstractmethod
+  def tag(self) -> bytes:
+    raise NotImplementedError()
+
+  @abc.abstractmethod
+  def Encode(self, image_file: store_schema.ImageFile) -> bytes:
+    raise NotImplementedError()
+
+  @abc.abstractmethod
+  def Decode(self, data: bytes) -> store_schema.ImageFile:
+    raise NotImplementedError()
+
+
+class RecordCodec(Codec):
+  """msgpack-encoded records, see _Compiler for the layout."""
+
+  def __init__(self,
+               tag: bytes,
+               sparse: Collection[type] = (),
+               record_class: Type[Any] = store_schema.ImageFile):
+    self._tag = tag
+    self._encode, self._decode = CompileRecordFunctions(record_class, sparse=sparse)
+
+  @property
+  def tag(self) -> bytes:
+    return self._tag
+
+  def Encode(self, image_file: store_schema.ImageFile) -> bytes:
+    return self._tag + msgpack.packb(self._encode(image_file), use_bin_type=True)
+
+  def Decode(self, data: bytes) -> store_schema.ImageFile:
+    return self._decode(
+        msgpack.unpackb(memoryview(data)[1:], use_list=False, strict_map_key=False))
+
+
+_CODECS: Dict[bytes, Codec] = {}
+_DEFAULT_CODEC: Codec
+
+
+def RegisterCodec(codec: Codec, default: bool = False) -> None:
+  global _DEFAULT_CODEC
+
+  _CODECS[codec.tag] = codec
+  if default:
+    _DEFAULT_CODEC = codec
+
+
+def Encode(image_file: store_schema.ImageFile) -> bytes:
+  return _DEFAULT_CODEC.Encode(image_file)
+
+
+def Decode(data: bytes) -> store_schema.ImageFile:
+  try:
+    codec = _CODECS[data[:1]]
+  except KeyError:
+    raise UnsupportedFormatError(f"Unknown ImageFile encoding: {data[:1]!r}")
+
+  return codec.Decode(data)
+
+
+# Positional records (catalogs written before sparse EXIF encoding).
+RegisterCodec(RecordCodec(b"\x01"))
+# Records with sparse ExifData: most fields are None for PNGs, screenshots, etc.
+RegisterCodec(RecordCodec(b"\x02", sparse=(store_schema.ExifData,)), default=True)
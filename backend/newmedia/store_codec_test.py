@@ -0,0 +1,127 @@
+import datetime
+import fractions
+
+import aiosqlite
+import bson
+import pytest
+
+from newmedia import store_codec
+from newmedia import store_schema
+from newmedia.migrations import codec_0003
+from newmedia.migrations import migration_0006
+from newmedia.schemas import schema_0002
+from newmedia.schemas import schema_0003
+
+
+def _MakeImageFile() -> store_schema.ImageFile:
+  return store_schema.ImageFile(
+      path="/foo/bar.nef",
+      uid="abc",
+      size=store_schema.Size(6000, 4000),
+      previews=[
+          store_schema.ImageFilePreview(store_schema.Size(3200, 2133), 1600000000000),
+      ],
+      file_size=25000000,
+      file_ctime=1500000000000,
+      file_mtime=1500000001000,
+      file_color_tag=store_schema.FileColorTag.RED,
+      icc_profile_description="sRGB",
+      mime_type="image/x-raw",
+      exif_data=store_schema.ExifData(
+          make="NIKON CORPORATION",
+          model="NIKON D90",
+          exposure_bias_value=1 / 3,
+          date_time=datetime.datetime(2019, 6, 10, 9, 17, 13),
+          date_time_original=datetime.datetime(1969, 12, 31, 23, 59, 59),
+          gpa_latitude=(fractions.Fraction(52), fractions.Fraction(31), fractions.Fraction(1, 3)),
+          gps_altitude=fractions.Fraction(1001, 10),
+      ),
+  )
+
+
+def test_RecordCodecRoundTrip():
+  image_file = _MakeImageFile()
+
+  data = store_codec.Encode(image_file)
+  decoded = store_codec.Decode(data)
+
+  assert decoded == image_file
+  assert decoded.file_color_tag is store_schema.FileColorTag.RED
+
+
+def test_RecordCodecIsMoreCompactThanBSON():
+  image_file = _MakeImageFile()
+
+  assert len(store_codec.Encode(image_file)) < len(bson.dumps(image_file.ToJSON())) / 2
+
+
+def test_PositionalRecordsAreStillDecoded():
+  image_file = _MakeImageFile()
+
+  data = store_codec.RecordCodec(b"\x01").Encode(image_file)
+
+  assert store_codec.Decode(data) == image_file
+  assert len(store_codec.Encode(image_file)) < len(data)
+
+
+def test_SparseRecordOfEmptyExifData():
+  image_file = _MakeImageFile()
+  image_file.exif_data = store_schema.ExifData()
+
+  assert store_codec.Decode(store_codec.Encode(image_file)) == image_file
+
+
+def test_ExifDataToJSONSkipsUnsetTags():
+  exif_data = store_schema.ExifData(
+      make="Canon",
+      date_time=datetime.datetime(2008, 7, 31, 10, 38, 11),
+      gps_altitude=fractions.Fraction(1001, 10),
+  )
+
+  json_data = exif_data.ToJSON()
+
+  assert json_data == {
+      "make": "Canon",
+      "date_time": "2008:07:31 10:38:11",
+      "gps_altitude": "1001/10",
+  }
+  assert store_schema.ExifData.FromJSON(json_data) == exif_data
+
+
+def test_DecodeRaisesOnUnknownFormat():
+  with pytest.raises(store_codec.UnsupportedFormatError):
+    store_codec.Decode(b"\xff\x00")
+
+
+@pytest.mark.asyncio
+async def test_Migration0006ConvertsBSONRows():
+  v2 = schema_0002.ImageFile(
+      path="/foo/bar.jpg",
+      uid="abc",
+      size=schema_0002.Size(100, 200),
+      previews=[schema_0002.ImageFilePreview(schema_0002.Size(10, 20), 42)],
+      file_size=1,
+      file_ctime=2,
+      file_mtime=3,
+      file_color_tag=schema_0002.FileColorTag.GREEN,
+      icc_profile_description="",
+      mime_type="JPEG",
+      exif_data=schema_0002.ExifData(make="Canon",
+                                     date_time=datetime.datetime(2008, 7, 31, 10, 38, 11)),
+  )
+
+  async with aiosqlite.connect("") as conn:
+    await conn.execute("CREATE TABLE ImageData (uid TEXT PRIMARY KEY, path TEXT, info BLOB)")
+    await conn.execute("INSERT INTO ImageData(uid, path, info) VALUES (?, ?, ?)",
+                       (v2.uid, v2.path, bson.dumps(v2.ToJSON())))
+
+    await migration_0006.Migration0006().Migrate(conn)
+
+    async with conn.execute("SELECT info FROM ImageData") as cursor:
+      rows = [r async for r in cursor]
+
+  # Rows are written in the schema_0003 layout, whatever the current one is.
+  image_file = codec_0003.Decode(rows[0][0])
+  assert image_file.previews == [schema_0003.ImageFilePreview(schema_0003.Size(10, 20), 42)]
+  assert image_file.exif_data.make == "Canon"
+  assert image_file.exif_data.date_time == datetime.datetime(2008, 7, 31, 10, 38, 11)
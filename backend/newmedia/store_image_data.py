@@ -0,0 +1,31 @@
+import os
+from typing import Any, Optional, Tuple, Union
+
+from newmedia.schemas import schema_0002
+from newmedia.schemas import schema_0003
+
+# Hot ImageFile fields are copied into indexed ImageData columns, so that
+# images can be filtered and sorted without decoding ImageData.info. These
+# are the columns, in the order used by IndexedColumns(). They're shared by
+# the store and the migration backfilling them (migration_0003.py).
+COLUMNS = ("file_size", "file_ctime", "file_mtime", "date_time_original", "make", "model",
+           "mime_type", "dir")
+
+
+def IndexedColumns(
+    image_file: Union[schema_0002.ImageFile, schema_0003.ImageFile]) -> Tuple[Any, ...]:
+  """Returns values of the indexed ImageData columns for an ImageFile."""
+  date_time_original: Optional[str] = None
+  if image_file.exif_data.date_time_original:
+    date_time_original = image_file.exif_data.date_time_original.strftime("%Y-%m-%d %H:%M:%S")
+
+  return (
+      image_file.file_size,
+      image_file.file_ctime,
+      image_file.file_mtime,
+      date_time_original,
+      image_file.exif_data.make,
+      image_file.exif_data.model,
+      image_file.mime_type,
+      os.path.dirname(image_file.path),
+  )
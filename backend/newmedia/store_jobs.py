@@ -0,0 +1,45 @@
+import dataclasses
+from typing import Optional
+
+# Thumbnails of registered images are rendered by jobs kept in the
+# ThumbnailJob table, so that the ones left over when the app is closed
+# mid-scan are rendered on the next start. A job is pending until its
+# thumbnail is rendered, which deletes it (in the same transaction), or it
+# fails. Failed jobs are retried with an exponential backoff until they run
+# out of attempts.
+
+PENDING = "pending"
+# Never stored: writing a done job deletes it.
+DONE = "done"
+FAILED = "failed"
+
+# Number of times a job is run before it's given up on.
+MAX_ATTEMPTS = 5
+# Delay (in seconds) before the first retry, doubled with every next one...
+RETRY_BASE_DELAY = 30
+# ...up to this much.
+RETRY_MAX_DELAY = 3600
+
+
+@dataclasses.dataclass
+class ThumbnailJob:
+  uid: str
+  state: str = PENDING
+  # Number of failed runs so far.
+  attempts: int = 0
+  # Time (in seconds since the epoch) a failed job may be retried at.
+  next_attempt_at: int = 0
+  error: Optional[str] = None
+
+  def Failed(self, error: str, now: int) -> "ThumbnailJob":
+    attempts = self.attempts + 1
+    return dataclasses.replace(self,
+                               state=FAILED,
+                               attempts=attempts,
+                               next_attempt_at=now + RetryDelay(attempts),
+                               error=error)
+
+
+def RetryDelay(attempts: int) -> int:
+  """Returns the delay before retrying a job that has failed this many times."""
+  return min(RETRY_BASE_DELAY * 2**(attempts - 1), RETRY_MAX_DELAY)
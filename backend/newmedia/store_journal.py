@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+from typing import Any, BinaryIO, Iterator, List, Optional, Set, Tuple
+
+import msgpack
+
+# The journal is an append-only file next to the catalog recording changes
+# made since the catalog was last saved. It's replayed when the catalog is
+# opened and truncated when the changes are saved.
+#
+# File layout: MAGIC followed by records, each one framed as
+# <payload length: uint32><CRC32 of payload: uint32><msgpack payload>.
+# A torn or corrupted record (e.g. after a crash mid-write) ends the journal.
+
+MAGIC = b"NMJOURNAL1\n"
+_FRAME_HEADER = struct.Struct("<II")
+
+# Pending records are written and fsync-ed in batches: at most this long
+# after the first of them was appended...
+FLUSH_DELAY = 0.2
+# ...or as soon as this many bytes are pending.
+MAX_PENDING_BYTES = 4 * 1024 * 1024
+
+# Record types. A record is a msgpack array starting with its type.
+RECORD_IMAGE = 1
+RECORD_STATE_PATCH = 2
+RECORD_METADATA_UPDATE = 3
+RECORD_PRUNE = 4
+RECORD_THUMBNAIL_JOB = 5
+
+
+class Error(Exception):
+  pass
+
+
+class InvalidJournalError(Error):
+  pass
+
+
+def JournalPath(catalog_path: str) -> str:
+  return catalog_path + ".nmjournal"
+
+
+def EncodeRecord(record: List[Any]) -> bytes:
+  payload = msgpack.packb(record, use_bin_type=True)
+  return _FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _ReadRecords(fd: BinaryIO) -> Iterator[Tuple[List[Any], int]]:
+  """Yields (record, offset of the record's end) for every valid record."""
+  if fd.read(len(MAGIC)) != MAGIC:
+    raise InvalidJournalError("Not a journal file")
+
+  offset = len(MAGIC)
+  while True:
+    header = fd.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+      return
+
+    length, crc = _FRAME_HEADER.unpack(header)
+    payload = fd.read(length)
+    if len(payload) < length or zlib.crc32(payload) != crc:
+      logging.warning("Journal ends with a torn record at offset %d", offset)
+      return
+
+    offset += _FRAME_HEADER.size + length
+    yield msgpack.unpackb(payload, raw=False, strict_map_key=False), offset
+
+
+def _FsyncDir(path: str) -> None:
+  """Makes a rename in the directory durable."""
+  dir_fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(dir_fd)
+  finally:
+    os.close(dir_fd)
+
+
+class Journal:
+  """Appends records to a journal file, fsync-ing them in batches."""
+
+  def __init__(self, path: str):
+    self.path = path
+    self._fd: Optional[BinaryIO] = None
+    self._pending = bytearray()
+    # Offset of the end of the last record, including pending ones.
+    self._size = 0
+    self._lock = asyncio.Lock()
+    self._flush_scheduled = False
+    self._flush_tasks: Set[asyncio.Task] = set()
+
+  def Open(self) -> List[List[Any]]:
+    """Opens (or creates) the journal, returns records to be replayed."""
+    records = []
+    valid_size = 0
+    if os.path.exists(self.path):
+      with open(self.path, "rb") as fd:
+        try:
+          valid_size = len(MAGIC)
+          for record, valid_size in _ReadRecords(fd):
+            records.append(record)
+        except InvalidJournalError:
+          logging.warning("Ignoring invalid journal: %s", self.path)
+          valid_size = 0
+
+    self._fd = open(self.path, "r+b" if valid_size else "w+b")
+    if not valid_size:
+      self._fd.write(MAGIC)
+      valid_size = len(MAGIC)
+    # Drops the torn tail (if any), new records are appended after the
+    # last valid one.
+    self._fd.truncate(valid_size)
+    self._fd.seek(valid_size)
+    self._fd.flush()
+    os.fsync(self._fd.fileno())
+    self._size = valid_size
+
+    return records
+
+  @property
+  def size(self) -> int:
+    return self._size
+
+  def Append(self, record: List[Any]) -> None:
+    data = EncodeRecord(record)
+    self._pending += data
+    self._size += len(data)
+
+    if len(self._pending) >= MAX_PENDING_BYTES:
+      self._StartFlush()
+    elif not self._flush_scheduled:
+      self._flush_scheduled = True
+      self._StartFlush(FLUSH_DELAY)
+
+  def _StartFlush(self, delay: float = 0) -> None:
+
+    async def FlushLater():
+      if delay:
+        await asyncio.sleep(delay)
+        self._flush_scheduled = False
+      await self.Flush()
+
+    task = asyncio.create_task(FlushLater())
+    self._flush_tasks.add(task)
+    task.add_done_callback(self._flush_tasks.discard)
+
+  async def Flush(self) -> None:
+    async with self._lock:
+      if not self._pending or self._fd is None:
+        return
+
+      data = bytes(self._pending)
+      self._pending.clear()
+      fd = self._fd
+
+      def Write():
+        fd.write(data)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+      await asyncio.get_running_loop().run_in_executor(None, Write)
+
+  async def Truncate(self, offset: int) -> None:
+    """Drops the records up to the given offset (see size).
+
+    The remaining records are written to a new file which then replaces the
+    journal, so a crash leaves either the old or the new journal intact.
+    """
+    await self.Flush()
+    async with self._lock:
+      fd = self._fd
+      if fd is None:
+        return
+      path = self.path
+
+      def Rewrite() -> BinaryIO:
+        fd.seek(offset)
+        tail = fd.read()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as tmp_fd:
+          tmp_fd.write(MAGIC + tail)
+          tmp_fd.flush()
+          os.fsync(tmp_fd.fileno())
+        os.replace(tmp_path, path)
+        _FsyncDir(os.path.dirname(os.path.abspath(path)))
+
+        fd.close()
+        new_fd = open(path, "r+b")
+        new_fd.seek(0, os.SEEK_END)
+        return new_fd
+
+      self._fd = await asyncio.get_running_loop().run_in_executor(None, Rewrite)
+      self._size = len(MAGIC) + self._size - offset
+
+  async def Close(self, remove: bool = False) -> None:
+    await self.Flush()
+    # Nothing is pending anymore: scheduled flushes would be no-ops.
+    for task in list(self._flush_tasks):
+      task.cancel()
+    if self._fd is not None:
+      self._fd.close()
+      self._fd = None
+    if remove:
+      os.remove(self.path)
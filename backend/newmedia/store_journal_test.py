@@ -0,0 +1,101 @@
+import os
+import pathlib
+from unittest import mock
+
+import pytest
+
+from newmedia import store_journal
+
+
+@pytest.mark.asyncio
+async def test_RecordsAreReadBackAfterReopening(tmp_path: pathlib.Path):
+  path = str(tmp_path / "journal")
+  journal = store_journal.Journal(path)
+  assert journal.Open() == []
+
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"{}"])
+  journal.Append([store_journal.RECORD_IMAGE, b"\x02", [[1, 2, b"blob"]]])
+  await journal.Close()
+
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [
+      [store_journal.RECORD_STATE_PATCH, b"{}"],
+      [store_journal.RECORD_IMAGE, b"\x02", [[1, 2, b"blob"]]],
+  ]
+  await journal.Close()
+
+
+@pytest.mark.asyncio
+async def test_TornRecordIsDropped(tmp_path: pathlib.Path):
+  path = str(tmp_path / "journal")
+  journal = store_journal.Journal(path)
+  journal.Open()
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"1"])
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"2"])
+  await journal.Close()
+
+  # Simulates a crash in the middle of writing the last record.
+  with open(path, "r+b") as fd:
+    fd.truncate(os.path.getsize(path) - 1)
+
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [[store_journal.RECORD_STATE_PATCH, b"1"]]
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"3"])
+  await journal.Close()
+
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [
+      [store_journal.RECORD_STATE_PATCH, b"1"],
+      [store_journal.RECORD_STATE_PATCH, b"3"],
+  ]
+  await journal.Close()
+
+
+@pytest.mark.asyncio
+async def test_TruncateKeepsRecordsAppendedAfterOffset(tmp_path: pathlib.Path):
+  path = str(tmp_path / "journal")
+  journal = store_journal.Journal(path)
+  journal.Open()
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"1"])
+  saved_size = journal.size
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"2"])
+
+  await journal.Truncate(saved_size)
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"3"])
+  await journal.Close()
+
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [
+      [store_journal.RECORD_STATE_PATCH, b"2"],
+      [store_journal.RECORD_STATE_PATCH, b"3"],
+  ]
+  await journal.Close()
+
+
+@pytest.mark.asyncio
+async def test_InterruptedTruncateLeavesJournalIntact(tmp_path: pathlib.Path):
+  path = str(tmp_path / "journal")
+  journal = store_journal.Journal(path)
+  journal.Open()
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"1"])
+  saved_size = journal.size
+  journal.Append([store_journal.RECORD_STATE_PATCH, b"2"])
+
+  # As if the process crashed before the rewritten journal was put in place.
+  with mock.patch.object(os, "replace", side_effect=OSError("crash")):
+    with pytest.raises(OSError):
+      await journal.Truncate(saved_size)
+  await journal.Close()
+
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [
+      [store_journal.RECORD_STATE_PATCH, b"1"],
+      [store_journal.RECORD_STATE_PATCH, b"2"],
+  ]
+  await journal.Truncate(saved_size)
+  await journal.Close()
+
+  assert not os.path.exists(path + ".tmp")
+  journal = store_journal.Journal(path)
+  assert journal.Open() == [[store_journal.RECORD_STATE_PATCH, b"2"]]
+  await journal.Close()
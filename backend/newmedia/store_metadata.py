@@ -0,0 +1,120 @@
+import dataclasses
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from newmedia.utils.json_type import JSON
+
+
+class Error(Exception):
+  pass
+
+
+class InvalidMetadataUpdateError(Error):
+  pass
+
+
+# Per-image user metadata is stored in the ImageMetadata table, one row per
+# uid. These are its columns, in the order used by the functions below.
+COLUMNS = ("label", "rating", "rotation", "horizontal_flip", "vertical_flip")
+
+_LABELS = range(0, 10)
+_RATINGS = range(0, 6)
+_ROTATIONS = (0, 90, 180, 270)
+
+MetadataRow = Tuple[int, int, int, int, int]
+
+
+def RowFromJSON(data: Any) -> MetadataRow:
+  """Converts renderer's ImageMetadata JSON into an ImageMetadata row."""
+  if not isinstance(data, dict):
+    raise InvalidMetadataUpdateError(f"Invalid metadata: {data!r}")
+  adjustments = data.get("adjustments") or {}
+  if not isinstance(adjustments, dict):
+    raise InvalidMetadataUpdateError(f"Invalid adjustments: {adjustments!r}")
+
+  return (
+      data.get("label") or 0,
+      data.get("rating") or 0,
+      adjustments.get("rotation") or 0,
+      int(bool(adjustments.get("horizontalFlip"))),
+      int(bool(adjustments.get("verticalFlip"))),
+  )
+
+
+def RowToJSON(row: MetadataRow) -> JSON:
+  label, rating, rotation, horizontal_flip, vertical_flip = row
+  return {
+      "label": label,
+      "rating": rating,
+      "adjustments": {
+          "rotation": rotation,
+          "horizontalFlip": bool(horizontal_flip),
+          "verticalFlip": bool(vertical_flip),
+      },
+  }
+
+
+@dataclasses.dataclass
+class MetadataUpdate:
+  """Sets the same metadata values on a set of images.
+
+  Only the fields that are not None are changed. Images without an
+  ImageMetadata row get one, with defaults for the remaining fields.
+  """
+  uids: List[str]
+
+  label: Optional[int] = None
+  rating: Optional[int] = None
+  rotation: Optional[int] = None
+  horizontal_flip: Optional[bool] = None
+  vertical_flip: Optional[bool] = None
+
+  @classmethod
+  def FromJSON(cls, json_data: JSON) -> "MetadataUpdate":
+    data: Any = json_data or {}
+    values = data.get("set") or {}
+    adjustments = values.get("adjustments") or {}
+
+    result = MetadataUpdate(
+        uids=[str(i) for i in data.get("uids") or []],
+        label=values.get("label"),
+        rating=values.get("rating"),
+        rotation=adjustments.get("rotation"),
+        horizontal_flip=adjustments.get("horizontalFlip"),
+        vertical_flip=adjustments.get("verticalFlip"),
+    )
+
+    if result.label is not None and result.label not in _LABELS:
+      raise InvalidMetadataUpdateError(f"Invalid label: {result.label}")
+    if result.rating is not None and result.rating not in _RATINGS:
+      raise InvalidMetadataUpdateError(f"Invalid rating: {result.rating}")
+    if result.rotation is not None and result.rotation not in _ROTATIONS:
+      raise InvalidMetadataUpdateError(f"Invalid rotation: {result.rotation}")
+    if not result.Values():
+      raise InvalidMetadataUpdateError("Nothing to update")
+
+    return result
+
+  def Values(self) -> Dict[str, int]:
+    result = {}
+    for c in COLUMNS:
+      v = getattr(self, c)
+      if v is not None:
+        result[c] = int(v)
+    return result
+
+
+def BuildUpdate(update: MetadataUpdate) -> Tuple[str, List[Any]]:
+  """Builds a single upsert statement covering all the update's uids."""
+  values = update.Values()
+  columns = ", ".join(values.keys())
+  placeholders = ", ".join("?" for _ in values)
+  assignments = ", ".join(f"{c} = excluded.{c}" for c in values.keys())
+
+  # "WHERE true" disambiguates the ON CONFLICT clause of an INSERT ... SELECT.
+  sql = f"""
+INSERT INTO ImageMetadata(uid, {columns})
+SELECT value, {placeholders} FROM json_each(?) WHERE true
+ON CONFLICT(uid) DO UPDATE SET {assignments}
+  """
+  return sql, list(values.values()) + [json.dumps(update.uids)]
@@ -1,7 +1,10 @@
 import logging
-from typing import Iterable, Optional
+from typing import Any, Callable, Iterable, Optional
 import aiosqlite
 
+# Called with (migration version, fraction of its rows migrated).
+ProgressCallback = Callable[[int, float], Any]
+
 
 class Migration:
   async def Migrate(self, conn: aiosqlite.Connection) -> None:
@@ -12,7 +15,107 @@ class Migration:
     raise NotImplementedError
 
 
-async def RunMigrations(conn: aiosqlite.Connection, migrations: Iterable[Migration]):
+class BatchedMigration(Migration):
+  """A migration rewriting table rows in batches, one transaction per batch.
+
+  The key of the last migrated row is committed together with every batch
+  (in MigrationProgress), so an interrupted migration continues from the
+  last committed batch when it's run again.
+
+  Prepare(), MigrateBatch() and Finish() must not commit: RunMigrations
+  commits their changes together with the migration progress. Finish() is
+  committed together with the version bump, but should still be idempotent:
+  catalogs migrated by earlier versions of this code may have it applied
+  without the version bumped.
+  """
+
+  batch_size = 1000
+
+  async def Prepare(self, conn: aiosqlite.Connection) -> None:
+    """Makes schema changes needed before the rows are migrated."""
+
+  async def CountRows(self, conn: aiosqlite.Connection) -> int:
+    raise NotImplementedError()
+
+  async def MigrateBatch(self, conn: aiosqlite.Connection, after_key: Optional[str],
+                         limit: int) -> Optional[str]:
+    """Migrates up to limit rows following after_key.
+
+    Returns the key of the last migrated row or None if no rows were left.
+    """
+    raise NotImplementedError()
+
+  async def Finish(self, conn: aiosqlite.Connection) -> None:
+    """Makes schema changes needed after all the rows are migrated."""
+
+  async def Migrate(self, conn: aiosqlite.Connection) -> None:
+    await _RunBatchedMigration(conn, self, None)
+
+
+async def _RunBatchedMigration(conn: aiosqlite.Connection, m: BatchedMigration,
+                               progress: Optional[ProgressCallback]) -> None:
+  await conn.execute("""
+  CREATE TABLE IF NOT EXISTS MigrationProgress (
+    version INTEGER PRIMARY KEY,
+    last_key TEXT,
+    migrated INTEGER NOT NULL DEFAULT 0
+  )
+  """)
+
+  prepared = False
+  last_key: Optional[str] = None
+  migrated = 0
+  async with conn.execute("SELECT last_key, migrated FROM MigrationProgress WHERE version = ?",
+                          (m.version,)) as cursor:
+    async for row in cursor:
+      prepared = True
+      last_key, migrated = row
+
+  if prepared:
+    logging.info("Resuming migration (version=%d) after %d rows", m.version, migrated)
+  else:
+    await conn.execute("INSERT INTO MigrationProgress(version) VALUES (?)", (m.version,))
+    await m.Prepare(conn)
+    await conn.commit()
+
+  total = await m.CountRows(conn)
+  while True:
+    key = await m.MigrateBatch(conn, last_key, m.batch_size)
+    if key is None:
+      break
+
+    last_key = key
+    migrated = min(migrated + m.batch_size, total)
+    await conn.execute("UPDATE MigrationProgress SET last_key = ?, migrated = ? WHERE version = ?",
+                       (last_key, migrated, m.version))
+    await conn.commit()
+
+    if progress is not None:
+      progress(m.version, float(migrated) / (total or 1))
+
+  # DDL statements are only part of a transaction if one is open already:
+  # otherwise they are committed right away, before the version is bumped.
+  await conn.execute("BEGIN")
+  await m.Finish(conn)
+  await conn.execute("DELETE FROM MigrationProgress WHERE version = ?", (m.version,))
+  # Bumped in the same transaction, so that a finished migration is never
+  # prepared again.
+  await conn.execute(f"PRAGMA user_version = {m.version}")
+  await conn.commit()
+
+
+async def HasColumn(conn: aiosqlite.Connection, table: str, column: str) -> bool:
+  async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+    async for row in cursor:
+      if row[1] == column:
+        return True
+  return False
+
+
+async def RunMigrations(conn: aiosqlite.Connection,
+                        migrations: Iterable[Migration],
+                        progress: Optional[ProgressCallback] = None) -> int:
+  """Runs pending migrations, returns the number of migrations applied."""
   migrations = sorted(migrations, key=lambda m: m.version)
 
   user_version = await conn.execute("PRAGMA user_version")
@@ -22,10 +125,17 @@ async def RunMigrations(conn: aiosqlite.Connection, migrations: Iterable[Migrati
 
   assert version is not None
 
+  applied = 0
   for m in migrations:
     if version >= m.version:
       continue
     logging.info("Running migration (version=%d)", m.version)
-    await m.Migrate(conn)
+    if isinstance(m, BatchedMigration):
+      await _RunBatchedMigration(conn, m, progress)
+    else:
+      await m.Migrate(conn)
     await conn.executescript(f"PRAGMA user_version = {m.version}")
     await conn.commit()
+    applied += 1
+
+  return applied
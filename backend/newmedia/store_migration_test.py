@@ -0,0 +1,155 @@
+import pathlib
+
+import aiosqlite
+import bson
+import pytest
+
+from newmedia import store
+from newmedia import store_migration
+from newmedia.migrations import migration_0001
+from newmedia.migrations import migration_0002
+from newmedia.migrations import migration_0003
+from newmedia.migrations import migration_0004
+from newmedia.migrations import migration_0005
+from newmedia.schemas import schema_0001
+
+
+class _Interrupted(Exception):
+  pass
+
+
+async def _CreateV1Catalog(path: str, num_rows: int) -> None:
+  async with aiosqlite.connect(path) as conn:
+    await store_migration.RunMigrations(conn, [migration_0001.Migration0001()])
+    await conn.executemany(
+        "INSERT INTO ImageData(uid, path, info, blob) VALUES (?, ?, ?, ?)",
+        ((f"{i:04d}", f"/foo/{i}.jpg",
+          bson.dumps(
+              schema_0001.ImageFile(f"/foo/{i}.jpg", f"{i:04d}", schema_0001.Size(60, 40),
+                                    schema_0001.Size(6, 4), 42).ToJSON()), b"preview")
+         for i in range(num_rows)))
+    await conn.commit()
+
+
+@pytest.mark.asyncio
+async def test_InterruptedBatchedMigrationIsResumed(tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await _CreateV1Catalog(path, 10)
+
+  migration = migration_0002.Migration0002()
+  migration.batch_size = 3
+
+  progress = []
+
+  def InterruptAfterSecondBatch(version: int, p: float):
+    progress.append((version, p))
+    if len(progress) == 2:
+      raise _Interrupted()
+
+  async with aiosqlite.connect(path) as conn:
+    with pytest.raises(_Interrupted):
+      await store_migration.RunMigrations(conn, [migration], progress=InterruptAfterSecondBatch)
+  assert progress == [(2, 0.3), (2, 0.6)]
+
+  async with aiosqlite.connect(path) as conn:
+    await store_migration.RunMigrations(conn, [migration])
+
+    async with conn.execute("PRAGMA user_version") as cursor:
+      assert [r[0] async for r in cursor] == [2]
+    async with conn.execute("SELECT COUNT(*), COUNT(DISTINCT uid) FROM ImagePreview") as cursor:
+      assert [tuple(r) async for r in cursor] == [(10, 10)]
+    async with conn.execute("SELECT COUNT(*) FROM MigrationProgress") as cursor:
+      assert [r[0] async for r in cursor] == [0]
+    async with conn.execute("SELECT info FROM ImageData") as cursor:
+      infos = [bson.loads(r[0]) async for r in cursor]
+
+  assert all("previews" in i for i in infos)
+
+
+class _InterruptedAfterFinish(migration_0002.Migration0002):
+
+  async def Finish(self, conn: aiosqlite.Connection) -> None:
+    await super().Finish(conn)
+    raise _Interrupted()
+
+
+@pytest.mark.asyncio
+async def test_MigrationInterruptedAfterFinishIsResumed(tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await _CreateV1Catalog(path, 10)
+
+  async with aiosqlite.connect(path) as conn:
+    with pytest.raises(_Interrupted):
+      await store_migration.RunMigrations(conn, [_InterruptedAfterFinish()])
+
+  async with aiosqlite.connect(path) as conn:
+    async with conn.execute("PRAGMA user_version") as cursor:
+      assert [r[0] async for r in cursor] == [1]
+    # Finish() was rolled back together with the version bump.
+    assert await store_migration.HasColumn(conn, "ImageData", "blob")
+
+    await store_migration.RunMigrations(conn, [migration_0002.Migration0002()])
+
+    async with conn.execute("PRAGMA user_version") as cursor:
+      assert [r[0] async for r in cursor] == [2]
+    assert not await store_migration.HasColumn(conn, "ImageData", "blob")
+    # Finish() may be run again on catalogs migrated before it was atomic.
+    await migration_0002.Migration0002().Finish(conn)
+
+
+@pytest.mark.asyncio
+async def test_Migration0005IndexesEveryImageInBatches(tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await _CreateV1Catalog(path, 10)
+
+  migration = migration_0005.Migration0005()
+  migration.batch_size = 3
+
+  migrations = [
+      migration_0002.Migration0002(),
+      migration_0003.Migration0003(),
+      migration_0004.Migration0004(),
+      migration,
+  ]
+  progress = []
+  async with aiosqlite.connect(path) as conn:
+    await store_migration.RunMigrations(conn, migrations,
+                                        progress=lambda v, p: progress.append((v, p)))
+
+    async with conn.execute("PRAGMA user_version") as cursor:
+      assert [r[0] async for r in cursor] == [5]
+    async with conn.execute("""
+    SELECT ImageSearchDoc.uid FROM ImageSearch
+    JOIN ImageSearchDoc ON ImageSearchDoc.id = ImageSearch.rowid
+    WHERE ImageSearch MATCH 'name:"7"'
+    """) as cursor:
+      assert [r[0] async for r in cursor] == ["0007"]
+    async with conn.execute("SELECT COUNT(*) FROM ImageSearch") as cursor:
+      assert [r[0] async for r in cursor] == [10]
+
+  assert [p for v, p in progress if v == 5] == [0.3, 0.6, 0.9, 1.0]
+
+
+@pytest.mark.asyncio
+async def test_CatalogIsVacuumedAfterPreviewsAreMovedOut(tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await _CreateV1Catalog(path, 10)
+
+  statements = []
+  async with aiosqlite.connect(path) as conn:
+    await conn.set_trace_callback(statements.append)
+    await store_migration.RunMigrations(conn, store.Migrations())
+
+    vacuums = [i for i, s in enumerate(statements) if s.startswith("VACUUM")]
+    [drop_previews] = [
+        i for i, s in enumerate(statements) if "DROP TABLE IF EXISTS main.ImagePreview" in s
+    ]
+    assert len(vacuums) == 1 and vacuums[0] > drop_previews
+    async with conn.execute("PRAGMA main.auto_vacuum") as cursor:
+      assert [r[0] async for r in cursor] == [2]
+
+    # Catalogs that were vacuumed by the former migration 0010 aren't again.
+    await conn.execute("PRAGMA user_version = 13")
+    statements.clear()
+    await store_migration.RunMigrations(conn, store.Migrations())
+    assert not [s for s in statements if s.startswith("VACUUM")]
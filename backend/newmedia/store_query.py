@@ -0,0 +1,260 @@
+import dataclasses
+import enum
+from typing import Any, Dict, List, Mapping, Tuple
+
+from newmedia.utils.json_type import JSON
+
+
+class Error(Exception):
+  pass
+
+
+class InvalidQueryError(Error):
+  pass
+
+
+class SortKey(enum.Enum):
+  FILE_NAME = "file_name"
+  ORIGIN_TIME = "origin_time"
+  FILE_CREATION_TIME = "file_ctime"
+  FILE_MODIFICATION_TIME = "file_mtime"
+  FILE_SIZE = "file_size"
+
+
+class SortOrder(enum.Enum):
+  ASC = "asc"
+  DESC = "desc"
+
+
+# Maps sort keys to SQL expressions over the ImageData/ImageMetadata join.
+# ORIGIN_TIME mirrors the renderer's sort: EXIF DateTimeOriginal with a
+# fallback to the file creation time.
+_SORT_EXPRESSIONS: Dict[SortKey, str] = {
+    SortKey.FILE_NAME: "d.path",
+    SortKey.ORIGIN_TIME:
+        "COALESCE(d.date_time_original, datetime(d.file_ctime / 1000, 'unixepoch'))",
+    SortKey.FILE_CREATION_TIME: "d.file_ctime",
+    SortKey.FILE_MODIFICATION_TIME: "d.file_mtime",
+    SortKey.FILE_SIZE: "d.file_size",
+}
+
+# Columns that can be used in range filters.
+_RANGE_COLUMNS: Dict[str, str] = {
+    "date_time_original": "d.date_time_original",
+    "file_size": "d.file_size",
+    "file_ctime": "d.file_ctime",
+    "file_mtime": "d.file_mtime",
+}
+
+MAX_LIMIT = 10000
+
+
+def _Object(data: Any, name: str) -> Dict[str, Any]:
+  if data is None:
+    return {}
+  if not isinstance(data, dict):
+    raise InvalidQueryError(f"Invalid {name}: expected an object")
+  return data
+
+
+def _IsScalar(data: Any) -> bool:
+  # bool is an int subclass, but True isn't a sensible label or bound.
+  return isinstance(data, (int, float, str)) and not isinstance(data, bool)
+
+
+def _List(data: Any, name: str, item_type: type) -> List[Any]:
+  if data is None:
+    return []
+  if not isinstance(data, list) or not all(_IsScalar(i) for i in data):
+    raise InvalidQueryError(f"Invalid {name}: expected a list of values")
+  try:
+    return [item_type(i) for i in data]
+  except (TypeError, ValueError) as e:
+    raise InvalidQueryError(f"Invalid {name}: {e}")
+
+
+def _Int(data: Any, name: str, default: int) -> int:
+  if data is None:
+    return default
+  if not _IsScalar(data):
+    raise InvalidQueryError(f"Invalid {name}: {data!r}")
+  try:
+    return int(data)
+  except ValueError as e:
+    raise InvalidQueryError(e)
+
+
+@dataclasses.dataclass
+class Range:
+  min: Any = None
+  max: Any = None
+
+  @classmethod
+  def FromJSON(cls, data: Any) -> "Range":
+    data = _Object(data, "range")
+    for k in ("min", "max"):
+      if data.get(k) is not None and not _IsScalar(data.get(k)):
+        raise InvalidQueryError(f"Invalid range {k}: {data.get(k)!r}")
+    return Range(data.get("min"), data.get("max"))
+
+
+@dataclasses.dataclass
+class ImageQuery:
+  labels: List[int] = dataclasses.field(default_factory=list)
+  ratings: List[int] = dataclasses.field(default_factory=list)
+  paths: List[str] = dataclasses.field(default_factory=list)
+  makes: List[str] = dataclasses.field(default_factory=list)
+  models: List[str] = dataclasses.field(default_factory=list)
+  ranges: Dict[str, Range] = dataclasses.field(default_factory=dict)
+
+  sort_key: SortKey = SortKey.FILE_NAME
+  sort_order: SortOrder = SortOrder.ASC
+
+  offset: int = 0
+  limit: int = 1000
+
+  @classmethod
+  def FromJSON(cls, json_data: JSON) -> "ImageQuery":
+    data = _Object(json_data, "query")
+    filter_data = _Object(data.get("filter"), "filter")
+    sort_data = _Object(data.get("sort"), "sort")
+
+    ranges = {}
+    for k, v in _Object(filter_data.get("ranges"), "ranges").items():
+      if k not in _RANGE_COLUMNS:
+        raise InvalidQueryError(f"Unsupported range attribute: {k}")
+      ranges[k] = Range.FromJSON(v)
+
+    try:
+      sort_key = SortKey(sort_data.get("key", SortKey.FILE_NAME.value))
+      sort_order = SortOrder(sort_data.get("order", SortOrder.ASC.value))
+    except (TypeError, ValueError) as e:
+      raise InvalidQueryError(e)
+    offset = _Int(data.get("offset"), "offset", 0)
+    limit = _Int(data.get("limit"), "limit", 1000)
+
+    if offset < 0 or limit < 0 or limit > MAX_LIMIT:
+      raise InvalidQueryError(f"Invalid pagination: offset={offset}, limit={limit}")
+
+    return ImageQuery(
+        labels=_List(filter_data.get("labels"), "labels", int),
+        ratings=_List(filter_data.get("ratings"), "ratings", int),
+        paths=_List(filter_data.get("paths"), "paths", str),
+        makes=_List(filter_data.get("makes"), "makes", str),
+        models=_List(filter_data.get("models"), "models", str),
+        ranges=ranges,
+        sort_key=sort_key,
+        sort_order=sort_order,
+        offset=offset,
+        limit=limit,
+    )
+
+
+@dataclasses.dataclass
+class QueryResult:
+  total: int
+  uids: List[str]
+
+  def ToJSON(self) -> JSON:
+    return {
+        "total": self.total,
+        "uids": self.uids,
+    }
+
+
+def _InClause(expr: str, values: List[Any], conditions: List[str], params: List[Any]) -> None:
+  if values:
+    conditions.append(f"{expr} IN ({', '.join('?' for _ in values)})")
+    params.extend(values)
+
+
+def BuildWhereClause(query: ImageQuery) -> Tuple[str, List[Any]]:
+  conditions: List[str] = []
+  params: List[Any] = []
+
+  # Images without an ImageMetadata row have the default label/rating (0).
+  _InClause("COALESCE(m.label, 0)", query.labels, conditions, params)
+  _InClause("COALESCE(m.rating, 0)", query.ratings, conditions, params)
+  _InClause("d.dir", query.paths, conditions, params)
+  _InClause("d.make", query.makes, conditions, params)
+  _InClause("d.model", query.models, conditions, params)
+
+  for k, r in sorted(query.ranges.items()):
+    column = _RANGE_COLUMNS[k]
+    if r.min is not None:
+      conditions.append(f"{column} >= ?")
+      params.append(r.min)
+    if r.max is not None:
+      conditions.append(f"{column} <= ?")
+      params.append(r.max)
+
+  if conditions:
+    return "WHERE " + " AND ".join(conditions), params
+  else:
+    return "", params
+
+
+def BuildQuery(query: ImageQuery) -> Tuple[str, str, List[Any]]:
+  """Returns (count SQL, page SQL, params) for the given query.
+
+  Page SQL expects two extra trailing parameters: limit and offset.
+  """
+  where, params = BuildWhereClause(query)
+  from_clause = "FROM ImageData AS d LEFT JOIN ImageMetadata AS m ON m.uid = d.uid"
+
+  order = "DESC" if query.sort_order == SortOrder.DESC else "ASC"
+  # uid is used as a tie-breaker to keep pagination stable.
+  order_by = f"ORDER BY {_SORT_EXPRESSIONS[query.sort_key]} {order}, d.uid {order}"
+
+  count_sql = f"SELECT COUNT(*) {from_clause} {where}"
+  page_sql = f"SELECT d.uid {from_clause} {where} {order_by} LIMIT ? OFFSET ?"
+  return count_sql, page_sql, params
+
+
+# bm25() weights for ImageSearch columns: path, name, make, model, software,
+# icc_profile_description. File name matches rank highest.
+SEARCH_COLUMN_WEIGHTS = (2.0, 4.0, 2.0, 2.0, 1.0, 1.0)
+
+
+@dataclasses.dataclass
+class SearchQuery:
+  text: str
+  offset: int = 0
+  limit: int = 1000
+
+  @classmethod
+  def FromQueryParams(cls, params: Mapping[str, str]) -> "SearchQuery":
+    try:
+      offset = int(params.get("offset", 0))
+      limit = int(params.get("limit", 1000))
+    except ValueError as e:
+      raise InvalidQueryError(e)
+
+    if offset < 0 or limit < 0 or limit > MAX_LIMIT:
+      raise InvalidQueryError(f"Invalid pagination: offset={offset}, limit={limit}")
+
+    return SearchQuery(text=params.get("q", ""), offset=offset, limit=limit)
+
+
+@dataclasses.dataclass
+class SearchResult:
+  uids: List[str]
+  has_more: bool
+
+  def ToJSON(self) -> JSON:
+    return {
+        "uids": self.uids,
+        "has_more": self.has_more,
+    }
+
+
+def BuildMatchExpression(text: str) -> str:
+  """Converts free-form user input into an FTS5 MATCH expression.
+
+  Every whitespace-separated term is quoted (so that FTS5 syntax characters
+  are taken literally) and matched as a prefix. Terms are AND-ed.
+  """
+  terms = []
+  for t in text.split():
+    terms.append('"' + t.replace('"', '""') + '"*')
+  return " ".join(terms)
@@ -1,7 +1,7 @@
-from newmedia.schemas import schema_0002
+from newmedia.schemas import schema_0003
 
-Size = schema_0002.Size
-ImageFile = schema_0002.ImageFile
-ImageFilePreview = schema_0002.ImageFilePreview
-ExifData = schema_0002.ExifData
-FileColorTag = schema_0002.FileColorTag
+Size = schema_0003.Size
+ImageFile = schema_0003.ImageFile
+ImageFilePreview = schema_0003.ImageFilePreview
+ExifData = schema_0003.ExifData
+FileColorTag = schema_0003.FileColorTag
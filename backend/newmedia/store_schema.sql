@@ -1,18 +1,67 @@
-CREATE TABLE RendererState (
-      id TEXT PRIMARY KEY,
-      blob BLOB
-    )
 CREATE TABLE ImageData (
         uid TEXT PRIMARY KEY,
         path TEXT,
-        info BLOB NOT NULL)
+        info BLOB NOT NULL, file_size INTEGER, file_ctime INTEGER, file_mtime INTEGER, date_time_original TEXT, make TEXT, model TEXT, mime_type TEXT, dir TEXT)
+CREATE TABLE MigrationProgress (
+    version INTEGER PRIMARY KEY,
+    last_key TEXT,
+    migrated INTEGER NOT NULL DEFAULT 0
+  )
+CREATE TABLE ImageMetadata (
+      uid TEXT PRIMARY KEY,
+      label INTEGER NOT NULL DEFAULT 0,
+      rating INTEGER NOT NULL DEFAULT 0
+    , rotation INTEGER NOT NULL DEFAULT 0, horizontal_flip INTEGER NOT NULL DEFAULT 0, vertical_flip INTEGER NOT NULL DEFAULT 0)
+CREATE TABLE ImageSearchDoc (
+      id INTEGER PRIMARY KEY,
+      uid TEXT NOT NULL UNIQUE
+    )
+CREATE TABLE 'ImageSearch_data'(id INTEGER PRIMARY KEY, block BLOB)
+CREATE TABLE 'ImageSearch_idx'(segid, term, pgno, PRIMARY KEY(segid, term)) WITHOUT ROWID
+CREATE TABLE 'ImageSearch_content'(id INTEGER PRIMARY KEY, c0, c1, c2, c3, c4, c5)
+CREATE TABLE 'ImageSearch_docsize'(id INTEGER PRIMARY KEY, sz BLOB)
+CREATE TABLE 'ImageSearch_config'(k PRIMARY KEY, v) WITHOUT ROWID
+CREATE TABLE RendererStateEntry (
+      section TEXT NOT NULL,
+      key TEXT NOT NULL,
+      value BLOB NOT NULL,
+      PRIMARY KEY (section, key)
+    )
+CREATE TABLE RendererStateLog (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      patch BLOB NOT NULL
+    )
+CREATE TABLE sqlite_sequence(name,seq)
 CREATE UNIQUE INDEX ImageData_path_index
     ON ImageData(path)
-CREATE TABLE ImagePreview (
-      uid TEXT NOT NULL,
-      width INTEGER NOT NULL,
-      height INTEGER NOT NULL,
-      blob BLOB
+CREATE INDEX ImageData_file_mtime_index ON ImageData(file_mtime)
+CREATE INDEX ImageData_file_size_index ON ImageData(file_size)
+CREATE INDEX ImageData_date_time_original_index ON ImageData(date_time_original)
+CREATE INDEX ImageData_make_model_index ON ImageData(make, model)
+CREATE INDEX ImageData_mime_type_index ON ImageData(mime_type)
+CREATE INDEX ImageData_dir_index ON ImageData(dir)
+CREATE INDEX ImageMetadata_label_index ON ImageMetadata(label)
+CREATE INDEX ImageMetadata_rating_index ON ImageMetadata(rating)
+CREATE VIRTUAL TABLE ImageSearch USING fts5(
+      path,
+      name,
+      make,
+      model,
+      software,
+      icc_profile_description,
+      tokenize = 'unicode61',
+      prefix = '2 3'
+    )
+CREATE TABLE PreviewAccess (
+      uid TEXT PRIMARY KEY,
+      accessed_at INTEGER NOT NULL
+    )
+CREATE INDEX PreviewAccess_accessed_at_index ON PreviewAccess(accessed_at)
+CREATE TABLE ThumbnailJob (
+      uid TEXT PRIMARY KEY,
+      state TEXT NOT NULL,
+      attempts INTEGER NOT NULL DEFAULT 0,
+      next_attempt_at INTEGER NOT NULL DEFAULT 0,
+      error TEXT
     )
-CREATE INDEX ImagePreview_uid
-    ON ImagePreview(uid)
\ No newline at end of file
+CREATE INDEX ThumbnailJob_state_index ON ThumbnailJob(state, next_attempt_at)
\ No newline at end of file
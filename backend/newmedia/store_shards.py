@@ -0,0 +1,96 @@
+import zlib
+from typing import List, Optional
+
+import aiosqlite
+
+# Previews make up the bulk of a catalog, so they're kept in separate
+# database files (shards) next to the catalog file, attached to the catalog's
+# connection. The catalog file itself only holds metadata and the renderer
+# state: opening and saving it doesn't copy previews around, while
+# maintenance (e.g. vacuuming) is done shard by shard.
+#
+# An image's previews are all kept in the same shard, picked by a hash of its
+# uid. Previews of an unsaved catalog are kept in in-memory shards.
+
+PREVIEW_SHARD_COUNT = 4
+
+_PREVIEW_SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.ImagePreview (
+  uid TEXT NOT NULL,
+  width INTEGER NOT NULL,
+  height INTEGER NOT NULL,
+  blob BLOB
+);
+CREATE INDEX IF NOT EXISTS {schema}.ImagePreview_uid ON ImagePreview(uid);
+"""
+
+
+def PreviewShardSchema(shard: int) -> str:
+  return f"preview_{shard}"
+
+
+def PreviewShardSchemas() -> List[str]:
+  return [PreviewShardSchema(i) for i in range(PREVIEW_SHARD_COUNT)]
+
+
+def PreviewShardIndex(uid: str) -> int:
+  return zlib.crc32(uid.encode("utf-8")) % PREVIEW_SHARD_COUNT
+
+
+def PreviewShardOf(uid: str) -> str:
+  """Returns the schema name of the shard holding the image's previews."""
+  return PreviewShardSchema(PreviewShardIndex(uid))
+
+
+def PreviewShardPath(catalog_path: str, shard: int) -> str:
+  return f"{catalog_path}.nmpreviews-{shard}"
+
+
+def PreviewShardPaths(catalog_path: str) -> List[str]:
+  return [PreviewShardPath(catalog_path, i) for i in range(PREVIEW_SHARD_COUNT)]
+
+
+async def _AttachedSchemas(conn: aiosqlite.Connection) -> List[str]:
+  result = []
+  async with conn.execute("PRAGMA database_list") as cursor:
+    async for row in cursor:
+      result.append(row[1])
+  return result
+
+
+async def _MainFilePath(conn: aiosqlite.Connection) -> str:
+  async with conn.execute("PRAGMA database_list") as cursor:
+    async for row in cursor:
+      if row[1] == "main":
+        return row[2]
+  return ""
+
+
+async def AttachPreviewShards(conn: aiosqlite.Connection,
+                              catalog_path: Optional[str] = None) -> None:
+  """Attaches the preview shards of the catalog, creating them if needed.
+
+  Shards of the connection's main database are attached if catalog_path is
+  not given. Does nothing if the shards are already attached.
+  """
+  if PreviewShardSchema(0) in await _AttachedSchemas(conn):
+    return
+
+  if catalog_path is None:
+    catalog_path = await _MainFilePath(conn)
+
+  await conn.commit()
+  for i, schema in enumerate(PreviewShardSchemas()):
+    path = PreviewShardPath(catalog_path, i) if catalog_path else ":memory:"
+    await conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    # Only takes effect when the shard is created.
+    await conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+    await conn.executescript(_PREVIEW_SHARD_SCHEMA.format(schema=schema))
+
+
+async def DetachPreviewShards(conn: aiosqlite.Connection) -> None:
+  await conn.commit()
+  attached = await _AttachedSchemas(conn)
+  for schema in PreviewShardSchemas():
+    if schema in attached:
+      await conn.execute(f"DETACH DATABASE {schema}")
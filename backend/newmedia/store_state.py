@@ -0,0 +1,75 @@
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+
+class Error(Exception):
+  pass
+
+
+class InvalidStateChangeError(Error):
+  pass
+
+
+# Renderer state is stored as one RendererStateEntry row per entry of its
+# dictionary-valued sections and one row per remaining top-level key (with
+# an empty section name). Values are kept as JSON so that they can be sent
+# back to the renderer without re-encoding.
+#
+# A patch has the same shape as the state: top-level keys replace the stored
+# values, while entries of the collection sections are upserted one by one
+# (null means "delete the entry").
+
+COLLECTIONS = frozenset(["images", "metadata", "lists", "paths"])
+SCALARS_SECTION = ""
+
+# (section, key, JSON value or None if the entry has to be deleted).
+StateChange = Tuple[str, str, Optional[bytes]]
+
+
+def Dumps(value: Any) -> bytes:
+  return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def ExplodeState(state: Dict[str, Any]) -> Iterator[StateChange]:
+  for k, v in state.items():
+    if k in COLLECTIONS:
+      for ck, cv in (v or {}).items():
+        yield k, ck, None if cv is None else Dumps(cv)
+    else:
+      yield SCALARS_SECTION, k, Dumps(v)
+
+
+def ChangeFromJSON(data: Any) -> StateChange:
+  """Converts a [section, key, value] triple into a StateChange."""
+  if not isinstance(data, list) or len(data) != 3:
+    raise InvalidStateChangeError(f"Expected a [section, key, value] triple, got: {data!r}")
+  section, key, value = data
+  if not isinstance(section, str) or not isinstance(key, str):
+    raise InvalidStateChangeError(f"Invalid section or key: {section!r}, {key!r}")
+  if value is None and section != SCALARS_SECTION:
+    return section, key, None
+  return section, key, Dumps(value)
+
+
+def ApplyChanges(state: Dict[str, Any], changes: Iterable[StateChange]) -> None:
+  for section, key, value in changes:
+    if section == SCALARS_SECTION:
+      state[key] = None if value is None else json.loads(value)
+      continue
+
+    collection = state.setdefault(section, {})
+    if value is None:
+      collection.pop(key, None)
+    else:
+      collection[key] = json.loads(value)
+
+
+def AssembleState(changes: Iterable[StateChange]) -> Optional[Dict[str, Any]]:
+  state: Dict[str, Any] = {}
+  ApplyChanges(state, changes)
+  if not state:
+    return None
+
+  for c in COLLECTIONS:
+    state.setdefault(c, {})
+  return state
@@ -1,13 +1,33 @@
+import asyncio
+import json
 import os
+import pathlib
+import shutil
+from typing import Any, Optional
 from unittest import mock
 
+import aiosqlite
+
 from newmedia import backend_state
+from newmedia import image_processor
+from newmedia import scheduler
 from newmedia import store
+from newmedia import store_jobs
+from newmedia import store_journal
+from newmedia import store_metadata
+from newmedia import store_migration
+from newmedia import store_query
+from newmedia import store_shards
+from newmedia import store_state
 
 import pytest
 import pytest_asyncio
+from PIL import Image
 
 from newmedia import communicator
+from newmedia.long_operation import LogMessage, Status
+from newmedia.long_operations import save
+from newmedia.long_operations import thumbnail_jobs
 
 
 @pytest_asyncio.fixture
@@ -34,3 +54,814 @@ async def test_SchemaIsUpToDate(db: store.DataStore):
     assert schema == expected_schema
   except AssertionError:
     print(schema)
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_RegisterFilePopulatesIndexedColumns(db: store.DataStore):
+  im_path = pathlib.Path(os.path.dirname(__file__)) / "test_data/jpeg_with_exif.jpeg"
+  image_file = await db.RegisterFile(im_path)
+
+  conn = await db._GetConn()
+  async with conn.execute(
+      "SELECT file_size, file_mtime, make, model, mime_type, dir FROM ImageData WHERE uid = ?",
+      (image_file.uid,)) as cursor:
+    rows = [tuple(r) async for r in cursor]
+
+  assert rows == [(image_file.file_size, image_file.file_mtime, "Canon", "Canon EOS 40D", "JPEG",
+                   str(im_path.parent))]
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_ReadFileInfosKeepsOrderAndSkipsUnknownUids(db: store.DataStore,
+                                                          tmp_path: pathlib.Path):
+  image_files = []
+  for i in range(2):
+    path = tmp_path / f"{i}.jpg"
+    Image.new("RGB", (60, 40)).save(path)
+    image_files.append(await db.RegisterFile(path))
+
+  infos = await db.ReadFileInfos([image_files[1].uid, "unknown", image_files[0].uid])
+
+  assert infos == [image_files[1], image_files[0]]
+
+
+async def _InsertImageData(db: store.DataStore, uid: str, path: str, file_size: int,
+                           date_time_original: Optional[str], label: int, rating: int):
+  conn = await db._GetConn()
+  await conn.execute(
+      """
+INSERT INTO ImageData(uid, path, info, file_size, file_ctime, file_mtime, date_time_original, dir)
+VALUES (?, ?, x'', ?, 0, 0, ?, ?)
+      """, (uid, path, file_size, date_time_original, os.path.dirname(path)))
+  await conn.execute("INSERT INTO ImageMetadata(uid, label, rating) VALUES (?, ?, ?)",
+                     (uid, label, rating))
+  await conn.commit()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_QueryImagesFiltersSortsAndPaginates(db: store.DataStore):
+  await _InsertImageData(db, "a", "/foo/a.jpg", 300, "2020-01-01 10:00:00", 1, 5)
+  await _InsertImageData(db, "b", "/foo/b.jpg", 100, "2021-01-01 10:00:00", 1, 3)
+  await _InsertImageData(db, "c", "/bar/c.jpg", 200, "2019-01-01 10:00:00", 2, 5)
+  await _InsertImageData(db, "d", "/foo/d.jpg", 400, None, 1, 5)
+
+  result = await db.QueryImages(
+      store_query.ImageQuery.FromJSON({
+          "filter": {
+              "labels": [1],
+              "paths": ["/foo"],
+          },
+          "sort": {
+              "key": "file_size",
+              "order": "desc"
+          },
+          "offset": 1,
+          "limit": 2,
+      }))
+  assert result.total == 3
+  assert result.uids == ["a", "b"]
+
+  result = await db.QueryImages(
+      store_query.ImageQuery.FromJSON({
+          "filter": {
+              "ratings": [5],
+              "ranges": {
+                  "date_time_original": {
+                      "min": "2019-06-01 00:00:00"
+                  }
+              },
+          },
+          "sort": {
+              "key": "origin_time"
+          },
+      }))
+  assert result.total == 1
+  assert result.uids == ["a"]
+
+
+def test_ImageQueryRejectsUnknownRangeAttribute():
+  with pytest.raises(store_query.InvalidQueryError):
+    store_query.ImageQuery.FromJSON({"filter": {"ranges": {"path": {"min": "a"}}}})
+
+
+@pytest.mark.parametrize("data", [
+    [1],
+    {"filter": []},
+    {"filter": {"ranges": {"file_size": 5}}},
+    {"filter": {"labels": [{}]}},
+    {"sort": {"key": []}},
+    {"offset": "a"},
+    {"limit": [10]},
+])
+def test_ImageQueryRejectsMalformedJSON(data: Any):
+  with pytest.raises(store_query.InvalidQueryError):
+    store_query.ImageQuery.FromJSON(data)
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_SearchImagesMatchesPathAndExifPrefixes(db: store.DataStore, tmp_path: pathlib.Path):
+  src_path = pathlib.Path(os.path.dirname(__file__)) / "test_data/jpeg_with_exif.jpeg"
+  (tmp_path / "wedding-2020").mkdir()
+  im_path = tmp_path / "wedding-2020" / "IMG_0001.jpeg"
+  shutil.copy(src_path, im_path)
+  image_file = await db.RegisterFile(im_path)
+
+  result = await db.SearchImages(store_query.SearchQuery("wedd can"))
+  assert result.uids == [image_file.uid]
+
+  result = await db.SearchImages(store_query.SearchQuery("wedd nikon"))
+  assert result.uids == []
+
+  (tmp_path / "party").mkdir()
+  await db.MoveFile(im_path, tmp_path / "party" / "IMG_0001.jpeg")
+
+  result = await db.SearchImages(store_query.SearchQuery("wedding"))
+  assert result.uids == []
+  result = await db.SearchImages(store_query.SearchQuery("party img_0001"))
+  assert result.uids == [image_file.uid]
+
+
+def test_BuildMatchExpressionQuotesTerms():
+  assert store_query.BuildMatchExpression('fuji "wed') == '"fuji"* """wed"*'
+  assert store_query.BuildMatchExpression("   ") == ""
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_StatePatchesAreAppliedOnTopOfSavedState(db: store.DataStore):
+  conn = await db._GetConn()
+  await db.ReplaceStateFromJSON({
+      "version": 3,
+      "images": {},
+      "metadata": {
+          "a": {"label": 1, "rating": 0},
+          "b": {"label": 2, "rating": 5},
+      },
+      "lists": {},
+      "paths": {"/foo": True},
+  })
+
+  await db.AppendStatePatch({
+      "metadata": {
+          "a": {
+              "label": 3,
+              "rating": 1,
+              "adjustments": {
+                  "rotation": 90,
+                  "horizontalFlip": True,
+                  "verticalFlip": False,
+              },
+          },
+          "b": None,
+      }
+  })
+  await db.AppendStatePatch({"paths": {"/bar": True}, "filterSettings": {"selectedLabels": [3]}})
+
+  state = await db.GetSavedState()
+  assert state["metadata"] == {
+      "a": {
+          "label": 3,
+          "rating": 1,
+          "adjustments": {
+              "rotation": 90,
+              "horizontalFlip": True,
+              "verticalFlip": False,
+          },
+      }
+  }
+  assert state["paths"] == {"/foo": True, "/bar": True}
+  assert state["filterSettings"] == {"selectedLabels": [3]}
+  assert state["version"] == 3
+
+  async with conn.execute("SELECT uid, label, rating, rotation FROM ImageMetadata") as cursor:
+    assert [tuple(r) async for r in cursor] == [("a", 3, 1, 90)]
+  streamed = b"".join([piece async for piece in db.StreamSavedState()])
+  assert json.loads(streamed) == {"state": state}
+
+  # Per-image metadata is only stored in ImageMetadata.
+  async with conn.execute(
+      "SELECT COUNT(*) FROM RendererStateEntry WHERE section = 'metadata'") as cursor:
+    assert [r[0] async for r in cursor] == [0]
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_StateLogIsCompacted(db: store.DataStore):
+  for i in range(store.STATE_LOG_COMPACTION_THRESHOLD + 1):
+    await db.AppendStatePatch({"paths": {f"/{i}": True, f"/{i - 1}": None}})
+
+  conn = await db._GetConn()
+  async with conn.execute("SELECT COUNT(*) FROM RendererStateLog") as cursor:
+    assert [r[0] async for r in cursor] == [0]
+
+  state = await db.GetSavedState()
+  assert state["paths"] == {f"/{store.STATE_LOG_COMPACTION_THRESHOLD}": True}
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_SavingToSyncedCatalogWritesOnlyChanges(db: store.DataStore,
+                                                       tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await _InsertImageData(db, "a", "/foo/a.jpg", 1, None, 0, 0)
+  await db.ReplaceStateFromJSON({"version": 3, "metadata": {"a": {"label": 0, "rating": 0}}})
+  await db.SaveStore(path)
+
+  with mock.patch.object(db, "_SaveFully", side_effect=AssertionError("full save")):
+    await _InsertImageData(db, "b", "/foo/b.jpg", 2, None, 0, 0)
+    # _InsertImageData bypasses the DataStore's write path.
+    db._dirty_uids.add("b")
+    await db.AppendStatePatch({"metadata": {"a": {"label": 2, "rating": 4}}})
+    await db.SaveStore(path)
+
+    for i in range(store.STATE_LOG_COMPACTION_THRESHOLD + 1):
+      await db.AppendStatePatch({"paths": {f"/{i}": True}})
+    await db.SaveStore(path)
+
+  reopened = store.DataStore(pathlib.Path(path))
+  try:
+    conn = await reopened._GetConn()
+    async with conn.execute("SELECT uid, file_size FROM ImageData ORDER BY uid") as cursor:
+      assert [tuple(r) async for r in cursor] == [("a", 1), ("b", 2)]
+    async with conn.execute("SELECT uid, label, rating FROM ImageMetadata ORDER BY uid") as cursor:
+      assert [tuple(r) async for r in cursor] == [("a", 2, 4), ("b", 0, 0)]
+
+    state = await reopened.GetSavedState()
+    assert (state["metadata"]["a"]["label"], state["metadata"]["a"]["rating"]) == (2, 4)
+    assert len(state["paths"]) == store.STATE_LOG_COMPACTION_THRESHOLD + 1
+  finally:
+    await reopened.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_UpdateImageMetadataUpsertsRows(db: store.DataStore):
+  await _InsertImageData(db, "a", "/foo/a.jpg", 1, None, 2, 1)
+
+  updated = await db.UpdateImageMetadata(
+      store_metadata.MetadataUpdate.FromJSON({
+          "uids": ["a", "b"],
+          "set": {
+              "rating": 3,
+              "adjustments": {
+                  "verticalFlip": True
+              }
+          },
+      }))
+
+  assert updated == 2
+  conn = await db._GetConn()
+  async with conn.execute(
+      "SELECT uid, label, rating, vertical_flip FROM ImageMetadata ORDER BY uid") as cursor:
+    assert [tuple(r) async for r in cursor] == [("a", 2, 3, 1), ("b", 0, 3, 1)]
+
+
+def test_MetadataUpdateRejectsInvalidValues():
+  with pytest.raises(store_metadata.InvalidMetadataUpdateError):
+    store_metadata.MetadataUpdate.FromJSON({"uids": ["a"], "set": {"rating": 6}})
+  with pytest.raises(store_metadata.InvalidMetadataUpdateError):
+    store_metadata.MetadataUpdate.FromJSON({"uids": ["a"], "set": {}})
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_StreamSavedStateOfEmptyCatalog(db: store.DataStore):
+  streamed = b"".join([piece async for piece in db.StreamSavedState()])
+  assert json.loads(streamed) == {"state": None}
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_ReplaceStateFromStreamedEntries(db: store.DataStore):
+  await db.AppendStatePatch({"paths": {"/old": True}})
+
+  async def Changes():
+    for line in [
+        ["", "version", 3],
+        ["", "selection", None],
+        ["paths", "/foo", True],
+        ["lists", "x", {"items": ["a"]}],
+        ["metadata", "a", {"label": 2, "rating": 3}],
+        ["metadata", "b", None],
+    ]:
+      yield store_state.ChangeFromJSON(line)
+
+  await db.ReplaceState(Changes())
+
+  state = await db.GetSavedState()
+  assert state["version"] == 3
+  assert state["selection"] is None
+  assert state["paths"] == {"/foo": True}
+  assert state["lists"] == {"x": {"items": ["a"]}}
+  assert list(state["metadata"].keys()) == ["a"]
+  assert (state["metadata"]["a"]["label"], state["metadata"]["a"]["rating"]) == (2, 3)
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_ConcurrentStateReplacementsDoNotInterleave(db: store.DataStore):
+  release = asyncio.Event()
+
+  async def Changes(name: str, wait: bool):
+    yield store_state.ChangeFromJSON(["paths", f"/{name}1", True])
+    if wait:
+      await release.wait()
+    yield store_state.ChangeFromJSON(["paths", f"/{name}2", True])
+
+  first = asyncio.create_task(db.ReplaceState(Changes("a", True)))
+  await asyncio.sleep(0.01)
+  second = asyncio.create_task(db.ReplaceState(Changes("b", False)))
+  await asyncio.sleep(0.01)
+  release.set()
+  await asyncio.gather(first, second)
+
+  state = await db.GetSavedState()
+  assert state["paths"] == {"/b1": True, "/b2": True}
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(store, "_STATE_STAGING_BATCH_SIZE", 1)
+async def test_CatalogWritesHoldTheWriteSlot(db: store.DataStore):
+  release = asyncio.Event()
+
+  async def Changes():
+    yield store_state.ChangeFromJSON(["paths", "/a", True])
+    await release.wait()
+    yield store_state.ChangeFromJSON(["paths", "/b", True])
+
+  # The slot isn't held while waiting for more of the streamed state.
+  replacement = asyncio.create_task(db.ReplaceState(Changes()))
+  await asyncio.sleep(0.01)
+  await asyncio.wait_for(db.AppendStatePatch({"paths": {"/c": True}}), 1)
+
+  async def StreamState():
+    return b"".join([p async for p in db.StreamSavedState()])
+
+  async with scheduler.SCHEDULER.Acquire(scheduler.Resource.DB_WRITE):
+    writes = [
+        asyncio.create_task(db.UpdateImageMetadata(store_metadata.MetadataUpdate(uids=["a"], rating=4))),
+        asyncio.create_task(db.AppendStatePatch({"paths": {"/d": True}})),
+        # Compacts the state log before streaming the state.
+        asyncio.create_task(StreamState()),
+        replacement,
+    ]
+    release.set()
+    await asyncio.sleep(0.01)
+    assert not any(w.done() for w in writes)
+  await asyncio.gather(*writes)
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_SaveWithStateAndStreamedStateDoNotDeadlock(db: store.DataStore,
+                                                          tmp_path: pathlib.Path):
+  release = asyncio.Event()
+
+  async def Changes():
+    yield store_state.ChangeFromJSON(["paths", "/streamed1", True])
+    await release.wait()
+    yield store_state.ChangeFromJSON(["paths", "/streamed2", True])
+
+  async def StatusCallback(status: Status):
+    pass
+
+  async def LogCallback(log: LogMessage):
+    pass
+
+  # The streamed state holds the replacement lock while waiting for entries,
+  # a save of a whole state is started meanwhile.
+  streamed = asyncio.create_task(db.ReplaceState(Changes()))
+  await asyncio.sleep(0.01)
+  with mock.patch.object(store, "DATA_STORE", db, create=True):
+    operation = save.SaveOperation({"version": 3, "paths": {"/whole": True}},
+                                   str(tmp_path / "catalog.nmcatalog"))
+    saved = asyncio.create_task(operation.Run(StatusCallback, LogCallback))
+    await asyncio.sleep(0.01)
+    release.set()
+    await asyncio.wait_for(asyncio.gather(streamed, saved), 5)
+
+  state = await db.GetSavedState()
+  assert state["paths"] == {"/whole": True}
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_MalformedStreamedStateIsRejected(db: store.DataStore):
+  await db.AppendStatePatch({"paths": {"/old": True}})
+
+  async def Changes():
+    yield store_state.ChangeFromJSON(["paths", "/foo", True])
+    yield store_state.ChangeFromJSON(["metadata", "a", [2]])
+
+  with pytest.raises(store_metadata.InvalidMetadataUpdateError):
+    await db.ReplaceState(Changes())
+  with pytest.raises(store_state.InvalidStateChangeError):
+    store_state.ChangeFromJSON(["paths", "/foo"])
+
+  state = await db.GetSavedState()
+  assert state["paths"] == {"/old": True}
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_UnsavedChangesAreReplayedFromJournal(db: store.DataStore, tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await db.ReplaceStateFromJSON({"version": 3, "metadata": {"a": {"label": 1}}})
+  await db.SaveStore(path)
+
+  await db.AppendStatePatch({"paths": {"/foo": True}})
+  await db.UpdateImageMetadata(
+      store_metadata.MetadataUpdate(uids=["a", "b"], rating=4))
+  await db.FlushJournal()
+
+  # The changes were never saved to the catalog itself.
+  reopened = store.DataStore(pathlib.Path(path))
+  try:
+    state = await reopened.GetSavedState()
+    assert state["paths"] == {"/foo": True}
+    assert state["metadata"]["a"]["label"] == 1
+    assert state["metadata"]["a"]["rating"] == 4
+    assert state["metadata"]["b"]["rating"] == 4
+
+    # Saving folds the journal into the catalog.
+    await reopened.SaveStore(path)
+    assert os.path.getsize(store_journal.JournalPath(path)) == len(store_journal.MAGIC)
+  finally:
+    await reopened.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_CompactCatalogPrunesOrphansAndRemovedFiles(db: store.DataStore,
+                                                         tmp_path: pathlib.Path):
+  (tmp_path / "kept.jpg").write_bytes(b"")
+  (tmp_path / "removed.jpg").write_bytes(b"")
+  await _InsertImageData(db, "kept", str(tmp_path / "kept.jpg"), 1, None, 0, 0)
+  await _InsertImageData(db, "removed", str(tmp_path / "removed.jpg"), 1, None, 0, 0)
+  # The directory is gone altogether, e.g. a disconnected volume.
+  await _InsertImageData(db, "offline", "/no/such/volume/a.jpg", 1, None, 0, 0)
+
+  conn = await db._GetConn()
+  blob = os.urandom(64 * 1024)
+  for uid, width in (("kept", 10), ("kept", 10), ("kept", 20), ("removed", 10), ("orphan", 10)):
+    await conn.execute(
+        f"INSERT INTO {store_shards.PreviewShardOf(uid)}.ImagePreview(uid, width, height, blob) "
+        "VALUES (?, ?, ?, ?)", (uid, width, width, blob))
+  await conn.commit()
+
+  path = str(tmp_path / "catalog.nmcatalog")
+  await db.ReplaceStateFromJSON({"version": 3})
+  await db.SaveStore(path)
+  os.remove(tmp_path / "removed.jpg")
+
+  result = await db.CompactCatalog()
+
+  assert result.pruned_previews == 2
+  assert result.removed_uids == []
+  assert result.bytes_reclaimed > 0
+
+  async def ReadCatalogFile():
+    reopened = store.DataStore(pathlib.Path(path))
+    try:
+      conn = await reopened._GetConn()
+      async with conn.execute("SELECT uid FROM ImageData ORDER BY uid") as cursor:
+        uids = [r[0] async for r in cursor]
+      async with conn.execute(
+          "SELECT uid, width FROM ImagePreview ORDER BY uid, width") as cursor:
+        previews = [tuple(r) async for r in cursor]
+      return uids, previews
+    finally:
+      await reopened.Close()
+
+  # Pruned previews are gone from the catalog file too, without saving.
+  assert await ReadCatalogFile() == (["kept", "offline", "removed"], [("kept", 10), ("kept", 20),
+                                                                      ("removed", 10)])
+
+  # Removed files are only pruned when asked for, and only from the
+  # in-memory catalog.
+  result = await db.CompactCatalog(prune_missing_files=True)
+  assert result.removed_uids == ["removed"]
+  async with conn.execute("SELECT COUNT(*) FROM ImageData WHERE uid = 'removed'") as cursor:
+    assert [r[0] async for r in cursor] == [0]
+  assert (await ReadCatalogFile())[0] == ["kept", "offline", "removed"]
+
+  await db.SaveStore(path)
+  await db.CompactCatalog()
+  assert await ReadCatalogFile() == (["kept", "offline"], [("kept", 10), ("kept", 20)])
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+@pytest.mark.parametrize("batch_size", [1, 256])
+async def test_PreviewsOverBudgetAreEvictedAndRenderedAgain(tmp_path: pathlib.Path,
+                                                            batch_size: int):
+  mock.patch.object(store, "_PREVIEW_EVICTION_BATCH_SIZE", batch_size).start()
+  # Nothing but the smallest previews fits.
+  db = store.DataStore(preview_budget=1)
+  try:
+    uids = []
+    for i in range(3):
+      path = tmp_path / f"{i}.jpg"
+      Image.effect_noise((2000, 1500), 64).convert("RGB").save(path)
+      image_file = await db.RegisterFile(path)
+      await db.UpdateFileThumbnail(image_file.uid)
+      uids.append(image_file.uid)
+
+    conn = await db._GetConn()
+
+    async def PreviewCounts():
+      counts = dict.fromkeys(uids, 0)
+      async with conn.execute("SELECT uid, COUNT(*) FROM ImagePreview GROUP BY uid") as cursor:
+        async for row in cursor:
+          counts[row[0]] = row[1]
+      return [counts[u] for u in uids]
+
+    # Previews that were just rendered are kept.
+    assert await PreviewCounts() == [1, 1, 3]
+
+    with Image.open(await db.ReadFileBlob(uids[0])) as im:
+      assert im.size == (2000, 1500)
+    assert await PreviewCounts() == [3, 1, 1]
+
+    # The smallest preview is good enough, nothing has to be rendered.
+    with Image.open(await db.ReadFileBlob(uids[1], max_size=300)) as im:
+      assert im.size == (400, 300)
+    assert await PreviewCounts() == [3, 1, 1]
+  finally:
+    await db.Close()
+    mock.patch.stopall()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+@pytest.mark.parametrize("preview_budget", [0, 1024 * 1024 * 1024])
+async def test_PreviewAccessesAreOnlyWrittenWithBudget(tmp_path: pathlib.Path, preview_budget: int):
+  db = store.DataStore(preview_budget=preview_budget)
+  try:
+    image_file = await db.RegisterFile(
+        pathlib.Path(os.path.dirname(__file__)) / "test_data/jpeg_with_exif.jpeg")
+    await db.UpdateFileThumbnail(image_file.uid)
+    conn = await db._GetConn()
+
+    async def AccessedUids():
+      async with conn.execute("SELECT uid FROM PreviewAccess") as cursor:
+        return [r[0] async for r in cursor]
+
+    for _ in range(3):
+      await db.ReadFileBlob(image_file.uid)
+    # Accesses are batched in memory.
+    assert await AccessedUids() == []
+
+    await db.SaveStore(str(tmp_path / "catalog.nmcatalog"))
+    assert await AccessedUids() == ([image_file.uid] if preview_budget else [])
+  finally:
+    await db.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_PreviewsAreNotJournaled(db: store.DataStore, tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await db.SaveStore(path)
+
+  image_path = tmp_path / "noise.jpg"
+  Image.effect_noise((2000, 1500), 64).convert("RGB").save(image_path)
+  image_file = await db.RegisterFile(image_path)
+  await db.UpdateFileThumbnail(image_file.uid)
+  await db.FlushJournal()
+
+  # Previews are written to their shard right away.
+  assert os.path.getsize(store_journal.JournalPath(path)) < 16 * 1024
+
+  reopened = store.DataStore(pathlib.Path(path))
+  try:
+    with Image.open(await reopened.ReadFileBlob(image_file.uid)) as im:
+      assert im.size == (2000, 1500)
+  finally:
+    await reopened.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+@mock.patch.object(store_jobs, "RETRY_BASE_DELAY", 0)
+async def test_UnfinishedThumbnailJobsAreResumed(db: store.DataStore, tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  await db.SaveStore(path)
+
+  uids = []
+  for i in range(2):
+    image_path = tmp_path / f"{i}.jpg"
+    Image.effect_noise((400, 300), 64).convert("RGB").save(image_path)
+    uids.append((await db.RegisterFile(image_path)).uid)
+  # The second file can't be read anymore.
+  with open(tmp_path / "1.jpg", "wb") as fd:
+    fd.write(b"garbage")
+
+  # The app is closed before the thumbnails are rendered.
+  await db.WriteThumbnailJobs([store_jobs.ThumbnailJob(uid) for uid in uids])
+  await db.FlushJournal()
+
+  reopened = store.DataStore(pathlib.Path(path))
+  try:
+    logs = []
+
+    async def StatusCallback(status: Status):
+      pass
+
+    async def LogCallback(log: LogMessage):
+      logs.append(log)
+
+    with mock.patch.object(store, "DATA_STORE", reopened, create=True):
+      assert [j.uid for j in await thumbnail_jobs.UnfinishedJobs()] == uids
+      await thumbnail_jobs.ThumbnailJobsOperation(communicator.CommunicatorStub()).Run(
+          StatusCallback, LogCallback)
+      assert not await thumbnail_jobs.UnfinishedJobs()
+
+    # The done job was deleted, the failed one is kept.
+    [failed] = await reopened.ReadThumbnailJobs([store_jobs.PENDING, store_jobs.FAILED])
+    assert (await reopened.ReadFileInfo(uids[0])).previews
+    assert (failed.uid, failed.state) == (uids[1], store_jobs.FAILED)
+    assert failed.attempts == store_jobs.MAX_ATTEMPTS
+    assert [l.kind for l in logs] == [LogMessage.Kind.ERROR]
+    await reopened.FlushJournal()
+  finally:
+    await reopened.Close()
+
+  # The deletion is replayed from the journal.
+  reopened = store.DataStore(pathlib.Path(path))
+  try:
+    jobs = await reopened.ReadThumbnailJobs([store_jobs.PENDING, store_jobs.FAILED])
+    assert [j.uid for j in jobs] == [uids[1]]
+  finally:
+    await reopened.Close()
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+@mock.patch.object(image_processor, "IMAGE_PROCESSOR", image_processor.ImageProcessor(), create=True)
+async def test_ThumbnailJobsOperationDoesNotWaitForRetries(db: store.DataStore,
+                                                           tmp_path: pathlib.Path):
+  image_path = tmp_path / "broken.jpg"
+  Image.new("RGB", (60, 40)).save(image_path)
+  uid = (await db.RegisterFile(image_path)).uid
+  with open(image_path, "wb") as fd:
+    fd.write(b"garbage")
+  await db.WriteThumbnailJobs([store_jobs.ThumbnailJob(uid)])
+
+  async def StatusCallback(status: Status):
+    pass
+
+  async def LogCallback(log: LogMessage):
+    pass
+
+  with mock.patch.object(store, "DATA_STORE", db, create=True):
+    assert await thumbnail_jobs.NextAttemptDelay() == 0
+    await asyncio.wait_for(
+        thumbnail_jobs.ThumbnailJobsOperation(communicator.CommunicatorStub()).Run(
+            StatusCallback, LogCallback), 5)
+
+    # The failed job is left to be retried by a later operation.
+    [job] = await thumbnail_jobs.UnfinishedJobs()
+    assert (job.state, job.attempts) == (store_jobs.FAILED, 1)
+    assert 0 < await thumbnail_jobs.NextAttemptDelay() <= store_jobs.RETRY_BASE_DELAY
+
+
+@pytest.mark.asyncio
+@mock.patch.object(
+    backend_state,
+    "BACKEND_STATE",
+    backend_state.BackendState(communicator.CommunicatorStub()),
+    create=True)
+async def test_PreviewsAreMovedToShardsNextToTheCatalog(tmp_path: pathlib.Path):
+  path = str(tmp_path / "catalog.nmcatalog")
+  async with aiosqlite.connect(path) as conn:
+    await store_migration.RunMigrations(conn, [m for m in store.Migrations() if m.version < 12])
+    await conn.executemany("INSERT INTO ImagePreview(uid, width, height, blob) VALUES (?, ?, ?, ?)",
+                           [(f"{i:02d}", 10, 10, b"preview %d" % i) for i in range(20)])
+    await conn.commit()
+
+  db = store.DataStore(pathlib.Path(path))
+  try:
+    conn = await db._GetConn()
+    async with conn.execute("SELECT uid, blob FROM ImagePreview ORDER BY uid") as cursor:
+      assert [tuple(r) async for r in cursor] == [(f"{i:02d}", b"preview %d" % i) for i in range(20)]
+    for shard in store_shards.PreviewShardSchemas():
+      async with conn.execute(f"SELECT COUNT(*) FROM {shard}.ImagePreview") as cursor:
+        assert [r[0] async for r in cursor] != [0]
+
+    # Saving the catalog elsewhere copies the shards.
+    copy_path = str(tmp_path / "copy.nmcatalog")
+    await db.ReplaceStateFromJSON({"version": 3})
+    await db.SaveStore(copy_path)
+  finally:
+    await db.Close()
+
+  async with aiosqlite.connect(path) as conn:
+    async with conn.execute(
+        "SELECT COUNT(*) FROM sqlite_schema WHERE name = 'ImagePreview'") as cursor:
+      assert [r[0] async for r in cursor] == [0]
+
+  reopened = store.DataStore(pathlib.Path(copy_path))
+  try:
+    conn = await reopened._GetConn()
+    async with conn.execute("SELECT COUNT(*) FROM ImagePreview") as cursor:
+      assert [r[0] async for r in cursor] == [20]
+  finally:
+    await reopened.Close()
+  assert all(os.path.exists(p) for p in store_shards.PreviewShardPaths(copy_path))
@@ -0,0 +1,88 @@
+import abc
+import json
+from typing import AnyStr, Generic, List, Union
+
+import msgpack
+
+try:
+  import orjson
+except ImportError:  # Optional (the "speedups" extra): only makes encoding faster.
+  orjson = None
+
+from newmedia.utils.json_type import JSON
+
+# Events sent over WebSockets are encoded once, no matter how many renderers
+# they're sent to. Batches are then put together from already encoded events.
+#
+# Encoded events and batches are str for text messages (JSON) and bytes for
+# binary ones, as aiohttp encodes text messages itself.
+Message = Union[str, bytes]
+
+
+class Error(Exception):
+  pass
+
+
+class UnknownFormatError(Error):
+  pass
+
+
+class WebSocketCodec(abc.ABC, Generic[AnyStr]):
+
+  # Whether batches are sent as binary (as opposed to text) messages.
+  binary = False
+
+  @abc.abstractmethod
+  def EncodeEvent(self, data: JSON) -> AnyStr:
+    raise NotImplementedError()
+
+  @abc.abstractmethod
+  def EncodeBatch(self, seq: int, events: List[AnyStr]) -> AnyStr:
+    """Returns a {"action": "BATCH", "seq": seq, "actions": [...]} message of encoded events."""
+    raise NotImplementedError()
+
+
+class JSONCodec(WebSocketCodec[str]):
+
+  def EncodeEvent(self, data: JSON) -> str:
+    if orjson is not None:
+      # Decoded once per event, rather than once per batch and renderer.
+      return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data, separators=(",", ":"))
+
+  def EncodeBatch(self, seq: int, events: List[str]) -> str:
+    return '{"action":"BATCH","seq":%d,"actions":[' % seq + ",".join(events) + "]}"
+
+
+class MsgpackCodec(WebSocketCodec[bytes]):
+
+  binary = True
+
+  def __init__(self):
+    self._packer = msgpack.Packer(use_bin_type=True)
+
+  def EncodeEvent(self, data: JSON) -> bytes:
+    return self._packer.pack(data)
+
+  def EncodeBatch(self, seq: int, events: List[bytes]) -> bytes:
+    # A msgpack array is its header followed by its encoded items.
+    return (self._packer.pack_map_header(3) + self._packer.pack("action") +
+            self._packer.pack("BATCH") + self._packer.pack("seq") + self._packer.pack(seq) +
+            self._packer.pack("actions") + self._packer.pack_array_header(len(events)) +
+            b"".join(events))
+
+
+JSON_FORMAT = "json"
+MSGPACK_FORMAT = "msgpack"
+
+_CODECS = {
+    JSON_FORMAT: JSONCodec(),
+    MSGPACK_FORMAT: MsgpackCodec(),
+}
+
+
+def CodecForFormat(name: str) -> WebSocketCodec:
+  try:
+    return _CODECS[name]
+  except KeyError:
+    raise UnknownFormatError(name)
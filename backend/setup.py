@@ -16,6 +16,7 @@ setup_args = dict(
         "bson==0.5.10",
         "ExifRead==3.0.0",
         "imagecodecs==2024.1.1",  # implicit dependency of tifffile
+        "msgpack==1.0.7",
         "numpy==1.26.3",
         "pillow==10.2.0",
         "pyobjc-core==10.1",
@@ -33,6 +34,10 @@ setup_args = dict(
             "pytest==8.0.0",
             "pytest-asyncio==0.19.0",
         ],
+        # Faster JSON encoding of WebSocket events (see ws_codec.py).
+        "speedups": [
+            "orjson==3.9.12",
+        ],
     },
     data_files=[],
 )